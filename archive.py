@@ -0,0 +1,705 @@
+import gzip
+import hashlib
+import json
+import lzma
+import mmap
+import os
+import re
+import struct
+import tarfile
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from io import BytesIO
+import crypto
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Maximum size of a single tar member when a stream of unknown length is added to a backup
+CHUNK_SIZE = 64 * 1024 * 1024
+
+# PAX header marking the last member of a streamed file
+LAST_PART = 'NEXTCLOUD_DOCKER_SCRIPTS.last_part'
+
+# Size of the blocks the parallel compressors work on
+BLOCK_SIZE = 1024 * 1024
+
+# File extension and default compression level of each supported format
+FORMATS = {
+    'gzip': {'extension': '.tar.gz', 'level': 9},
+    'pgzip': {'extension': '.tar.gz', 'level': 6},
+    'igzip': {'extension': '.tar.gz', 'level': 6},
+    'zstd': {'extension': '.tar.zst', 'level': 3},
+    'xz': {'extension': '.tar.xz', 'level': 6},
+}
+
+EXTENSIONS = tuple(sorted({values['extension'] + suffix for values in FORMATS.values()
+                            for suffix in ('', crypto.EXTENSION)}))
+
+# Magic bytes at the start of a compressed file
+MAGIC = {
+    b'\x1f\x8b': 'gzip',
+    b'\x28\xb5\x2f\xfd': 'zstd',
+    b'\xfd7zXZ\x00': 'xz',
+}
+
+
+# Name of the n-th member a streamed file is split into
+def part_name(arcname: str, index: int) -> str:
+    return F"{arcname}.part{index:04d}"
+
+
+# Read a stream of unknown length and add it to the tarball as numbered members of at most chunk_size bytes.
+# Only one chunk is held in memory at a time. If several streams are added concurrently, pass a lock that guards the
+# tarball. The last member is marked, so a reader knows when a stream is complete without reading the whole archive.
+# Returns the number of members written.
+def add_stream(tarball: tarfile.TarFile, arcname: str, stream, chunk_size: int = CHUNK_SIZE, lock=None) -> int:
+    parts = 0
+    next_data = stream.read(chunk_size)
+    while True:
+        data = next_data
+        next_data = stream.read(chunk_size) if len(data) == chunk_size else b''
+        with lock or nullcontext():
+            add_bytes(tarball, part_name(arcname, parts), data, {LAST_PART: '1'} if not next_data else None)
+        parts += 1
+        if not next_data:
+            break
+    return parts
+
+
+# Add a member with the given content to the tarball
+def add_bytes(tarball: tarfile.TarFile, arcname: str, data: bytes, pax_headers: dict = None):
+    info = tarfile.TarInfo(arcname)
+    if pax_headers:
+        info.pax_headers = pax_headers
+    info.size = len(data)
+    info.mtime = int(time.time())
+    info.mode = 0o600
+    tarball.addfile(info, BytesIO(data))
+
+
+# Stream that returns some already consumed bytes before reading on from the underlying stream
+class PrefixedStream:
+
+    def __init__(self, prefix: bytes, stream) -> None:
+        self.__prefix = prefix
+        self.__stream = stream
+
+    def read(self, size=-1) -> bytes:
+        if not self.__prefix:
+            return self.__stream.read(size)
+        if size is None or size < 0:
+            data, self.__prefix = self.__prefix + self.__stream.read(), b''
+            return data
+        data, self.__prefix = self.__prefix[:size], self.__prefix[size:]
+        if len(data) < size:
+            data += self.__stream.read(size - len(data))
+        return data
+
+    def readline(self, size=-1) -> bytes:
+        if not self.__prefix:
+            return self.__stream.readline(size)
+        end = self.__prefix.find(b'\n') + 1 or len(self.__prefix)
+        if size is not None and 0 <= size < end:
+            end = size
+        data, self.__prefix = self.__prefix[:end], self.__prefix[end:]
+        if not data.endswith(b'\n') and not self.__prefix and (size is None or size < 0 or len(data) < size):
+            data += self.__stream.readline(-1 if size is None or size < 0 else size - len(data))
+        return data
+
+
+# Strip the part number from the name of a member a streamed file was split into
+def strip_part(name: str) -> str:
+    return re.sub(r'\.part[0-9]{4}$', '', name)
+
+
+# Check whether a member is the last part of a streamed file
+def is_last_part(member: tarfile.TarInfo) -> bool:
+    return member.pax_headers.get(LAST_PART) == '1'
+
+
+# Pass the content of a member to write() in chunks of at most size bytes
+def copy_member(tarball: tarfile.TarFile, member: tarfile.TarInfo, write, size: int = 1024 * 1024):
+    file = tarball.extractfile(member)
+    while True:
+        data = file.read(size)
+        if not data:
+            break
+        write(data)
+
+
+# Name of a member below arcname instead of the top level directory it was archived with
+def rebase_name(name: str, arcname: str) -> str:
+    name = name.lstrip('/')
+    return arcname + name[len(name.split('/', 1)[0]):]
+
+
+# Copy all members of a tarball that is read sequentially into another one, below arcname instead of their top
+# level directory. Returns the number of members copied.
+def copy_members(source: tarfile.TarFile, target: tarfile.TarFile, arcname: str) -> int:
+    count = 0
+    for member in source:
+        member.name = rebase_name(member.name, arcname)
+        target.addfile(member, source.extractfile(member) if member.isfile() else None)
+        count += 1
+    return count
+
+
+# Check whether a file name looks like a backup archive
+def is_backup(file_name: str) -> bool:
+    return file_name.endswith(EXTENSIONS)
+
+
+# Strip the archive extension from a backup file name
+def strip_extension(file_name: str) -> str:
+    for extension in EXTENSIONS:
+        if file_name.endswith(extension):
+            return file_name[:-len(extension)]
+    return file_name
+
+
+# Check whether a backup is encrypted
+def is_encrypted(path: str) -> bool:
+    with open(path, 'rb') as file:
+        return crypto.is_encrypted(file.read(len(crypto.MAGIC)))
+
+
+# Open a backup for reading. Encrypted backups are decrypted on the way, which needs their encryption settings.
+def open_file(path: str, encryption: crypto.Encryption = None):
+    file = open(path, 'rb')
+    if not crypto.is_encrypted(file.read(len(crypto.MAGIC))):
+        file.seek(0)
+        return file
+    file.seek(0)
+    if encryption is None:
+        file.close()
+        raise Exception(F"{path} is encrypted, configure the encryption key of its instance to read it")
+    try:
+        return encryption.reader(file)
+    except Exception:
+        file.close()
+        raise
+
+
+# Detect the compression format of a backup by its magic bytes
+def detect_format(path: str, encryption: crypto.Encryption = None) -> str:
+    with open_file(path, encryption) as file:
+        head = file.read(6)
+    for magic, compression_format in MAGIC.items():
+        if head.startswith(magic):
+            return compression_format
+    raise Exception(F"Unknown compression format: {path}")
+
+
+# Compresses fixed size blocks on a thread pool and writes them in order. zlib, lzma and zstd release the GIL while
+# compressing, so the blocks are really compressed in parallel.
+class BlockParallelWriter:
+
+    def __init__(self, fileobj, level, threads, block_size=BLOCK_SIZE):
+        self.fileobj = fileobj
+        self.level = level
+        self.block_size = block_size
+        self.closed = False
+        self.__previous = b''
+        self.__buffer = bytearray()
+        self.__pending = deque()
+        self.__max_pending = threads * 2
+        self.__executor = ThreadPoolExecutor(max_workers=threads)
+        self.fileobj.write(self._header())
+
+    def _header(self) -> bytes:
+        return b''
+
+    def _trailer(self) -> bytes:
+        return b''
+
+    def _compress(self, block: bytes, previous: bytes, last: bool) -> bytes:
+        raise NotImplementedError
+
+    def _update(self, data):
+        pass
+
+    # Called with every compressed block in the order the blocks are written
+    def _written(self, data: bytes):
+        pass
+
+    def write(self, data) -> int:
+        self._update(data)
+        self.__buffer += data
+        while len(self.__buffer) >= self.block_size:
+            self.__submit(bytes(self.__buffer[:self.block_size]), last=False)
+            del self.__buffer[:self.block_size]
+        return len(data)
+
+    def __submit(self, block: bytes, last: bool):
+        self.__pending.append(self.__executor.submit(self._compress, block, self.__previous, last))
+        self.__previous = block
+        # Keep the memory footprint bounded if the disk is slower than the compression
+        while len(self.__pending) > self.__max_pending:
+            self.__write_block(self.__pending.popleft().result())
+
+    def __write_block(self, data: bytes):
+        self._written(data)
+        self.fileobj.write(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self.__submit(bytes(self.__buffer), last=True)
+            self.__buffer.clear()
+            while self.__pending:
+                self.__write_block(self.__pending.popleft().result())
+            self.fileobj.write(self._trailer())
+        finally:
+            self.__executor.shutdown(cancel_futures=True)
+            self.closed = True
+
+
+# pigz style gzip: every block is a raw deflate stream primed with the last 32 KB of the previous block and ended with
+# a sync flush, so the output is one ordinary gzip member that any gzip implementation can read
+class ParallelGzipWriter(BlockParallelWriter):
+
+    def __init__(self, fileobj, level, threads, block_size=BLOCK_SIZE):
+        self.__crc = 0
+        self.__size = 0
+        super().__init__(fileobj, level, threads, block_size)
+
+    def _header(self) -> bytes:
+        return b'\x1f\x8b\x08\x00' + struct.pack('<I', int(time.time())) + b'\x00\xff'
+
+    def _trailer(self) -> bytes:
+        return struct.pack('<II', self.__crc, self.__size & 0xffffffff)
+
+    def _update(self, data):
+        self.__crc = zlib.crc32(data, self.__crc)
+        self.__size += len(data)
+
+    def _compress(self, block: bytes, previous: bytes, last: bool) -> bytes:
+        if previous:
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=previous[-32768:])
+        else:
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        return compressor.compress(block) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+# Every block becomes a complete xz stream; concatenated xz streams are a valid xz file
+class ParallelXzWriter(BlockParallelWriter):
+
+    def _compress(self, block: bytes, previous: bytes, last: bool) -> bytes:
+        if not block:
+            return b''
+        return lzma.compress(block, format=lzma.FORMAT_XZ, preset=self.level)
+
+
+# Lines of a mysqldump that start a database, a table or another object. The byte ranges between them are recorded
+# while a dump is written into an indexed archive, so a single table can be restored without reading the whole dump.
+DUMP_SECTION = re.compile(rb'^-- (Current Database: |Table structure for table |Temporary view structure for view |'
+                          rb'Final view structure for view |Dumping routines for database |'
+                          rb'Dumping events for database )`((?:[^`]|``)+)`', re.MULTILINE)
+SECTION_KINDS = {b'Current Database: ': 'database', b'Table structure for table ': 'table'}
+
+
+# Records the offsets of the sections of a dump that is passed through scan() piece by piece
+class DumpScanner:
+
+    def __init__(self) -> None:
+        self.offset = 0
+        self.sections = []
+        self.__tail = b''
+
+    def scan(self, data: bytes):
+        # The unfinished last line of the previous piece is scanned again, so markers split between pieces are found
+        buffer = self.__tail + data
+        start = self.offset - len(self.__tail)
+        for match in DUMP_SECTION.finditer(buffer):
+            position = start + match.start()
+            if self.sections and position <= self.sections[-1][2]:
+                continue
+            name = match.group(2).replace(b'``', b'`').decode('utf-8', 'replace')
+            self.sections.append([SECTION_KINDS.get(match.group(1), 'other'), name, position])
+        self.offset += len(data)
+        line_start = buffer.rfind(b'\n') + 1
+        self.__tail = buffer[line_start:] if len(buffer) - line_start < 4096 else b''
+
+
+# File object that passes everything read through a DumpScanner
+class ScanningReader:
+
+    def __init__(self, fileobj, scanner: DumpScanner) -> None:
+        self.fileobj = fileobj
+        self.scanner = scanner
+
+    def read(self, size=-1) -> bytes:
+        data = self.fileobj.read(size)
+        self.scanner.scan(data)
+        return data
+
+
+# TarFile that keeps an index of where the data of each member starts in the uncompressed archive. The sections of
+# SQL dumps are scanned on the way; the parts of a streamed dump are scanned as one stream.
+class IndexedTarFile(tarfile.TarFile):
+
+    def __init__(self, *args, **kwargs) -> None:
+        self.index = []
+        self.scanners = {}
+        super().__init__(*args, **kwargs)
+
+    def addfile(self, tarinfo, fileobj=None):
+        name = strip_part(tarinfo.name.lstrip('/'))
+        if fileobj is not None and name.endswith('.sql'):
+            fileobj = ScanningReader(fileobj, self.scanners.setdefault(name, DumpScanner()))
+        super().addfile(tarinfo, fileobj)
+        size = tarinfo.size if fileobj is not None else 0
+        self.index.append([tarinfo.name.lstrip('/'), self.offset - -(-size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE,
+                           size, tarinfo.mode, tarinfo.uid, tarinfo.gid, tarinfo.isdir()])
+
+    def dumps(self) -> dict:
+        return {name: scanner.sections for name, scanner in self.scanners.items()}
+
+
+# An empty gzip member that carries data in a subfield of its extra field. Gzip readers skip it.
+def gzip_extra_member(subfield_id: bytes, payload: bytes) -> bytes:
+    extra = subfield_id + struct.pack('<H', len(payload)) + payload
+    return (b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff' + struct.pack('<H', len(extra)) + extra +
+            b'\x03\x00' + struct.pack('<II', 0, 0))
+
+
+INDEX_SUBFIELD = b'NI'
+FOOTER_SUBFIELD = b'NF'
+FOOTER_SIZE = len(gzip_extra_member(FOOTER_SUBFIELD, struct.pack('<QQ', 0, 0)))
+INDEX_PAYLOAD_SIZE = 65000
+
+
+# Gzip made of independently compressed members of one block each, followed by an index of the blocks and of the tar
+# members, stored in empty gzip members. Any gzip implementation reads it as an ordinary gzip file, but a single
+# member can be read by decompressing only the blocks it lies in.
+class IndexedGzipWriter(BlockParallelWriter):
+
+    def __init__(self, fileobj, level, threads, block_size=BLOCK_SIZE):
+        self.__block_offsets = []
+        self.__position = 0
+        self.index = {}
+        super().__init__(fileobj, level, threads, block_size)
+
+    def _compress(self, block: bytes, previous: bytes, last: bool) -> bytes:
+        if not block:
+            return b''
+        return gzip.compress(block, self.level, mtime=0)
+
+    def _written(self, data: bytes):
+        if data:
+            self.__block_offsets.append(self.__position)
+        self.__position += len(data)
+
+    def _trailer(self) -> bytes:
+        index = dict(self.index, version=1, block_size=self.block_size, blocks=self.__block_offsets)
+        payload = zlib.compress(json.dumps(index, separators=(',', ':')).encode('utf-8'))
+        members = b''.join(gzip_extra_member(INDEX_SUBFIELD, payload[i:i + INDEX_PAYLOAD_SIZE])
+                           for i in range(0, len(payload), INDEX_PAYLOAD_SIZE))
+        return members + gzip_extra_member(FOOTER_SUBFIELD, struct.pack('<QQ', self.__position, len(members)))
+
+
+# Random access to the members of an archive written with the igzip format. The file is memory mapped and only the
+# blocks that hold the requested data are decompressed, and of an encrypted archive only the chunks they are in are
+# decrypted.
+class IndexedArchive:
+
+    def __init__(self, path: str, encryption: crypto.Encryption = None) -> None:
+        self.__file = open(path, 'rb')
+        self.__raw_map = None
+        try:
+            self.__raw_map = self.__map = mmap.mmap(self.__file.fileno(), 0, access=mmap.ACCESS_READ)
+            if crypto.is_encrypted(self.__map[:len(crypto.MAGIC)]):
+                if encryption is None:
+                    raise ValueError("Archive is encrypted")
+                self.__map = encryption.view(self.__map)
+            self.index = self.__read_index()
+        except Exception:
+            if self.__raw_map is not None:
+                self.__raw_map.close()
+            self.__file.close()
+            raise
+        self.block_size = self.index['block_size']
+        self.__blocks = self.index['blocks'] + [self.__index_offset]
+        self.members = {member[0]: member for member in self.index['members']}
+
+    # Open an archive if it has an index, otherwise return None
+    @staticmethod
+    def open(path: str, encryption: crypto.Encryption = None):
+        try:
+            return IndexedArchive(path, encryption)
+        except (ValueError, OSError, struct.error, zlib.error):
+            return None
+
+    def __read_index(self) -> dict:
+        size = len(self.__map)
+        footer = self.__map[size - FOOTER_SIZE:]
+        if size < FOOTER_SIZE or footer[:4] != b'\x1f\x8b\x08\x04' or footer[12:14] != FOOTER_SUBFIELD:
+            raise ValueError("Archive has no index")
+        self.__index_offset, length = struct.unpack('<QQ', footer[16:32])
+        payload = bytearray()
+        position = self.__index_offset
+        while position < self.__index_offset + length:
+            extra_length, = struct.unpack('<H', self.__map[position + 10:position + 12])
+            payload += self.__map[position + 16:position + 12 + extra_length]
+            position += 12 + extra_length + 10
+        return json.loads(zlib.decompress(payload))
+
+    def close(self):
+        self.__raw_map.close()
+        self.__file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    # Read size bytes at offset of the uncompressed archive
+    def read(self, offset: int, size: int) -> bytes:
+        data = bytearray()
+        block = offset // self.block_size
+        skip = offset - block * self.block_size
+        while len(data) < size + skip and block < len(self.__blocks) - 1:
+            data += zlib.decompress(self.__map[self.__blocks[block]:self.__blocks[block + 1]], 16 + zlib.MAX_WBITS)
+            block += 1
+        return bytes(data[skip:skip + size])
+
+    # Byte ranges of a file in the uncompressed archive, one per part for streamed files
+    def ranges(self, name: str) -> list:
+        if name in self.members:
+            return [(self.members[name][1], self.members[name][2])]
+        return [(member[1], member[2]) for member in self.index['members'] if strip_part(member[0]) == name]
+
+    # Read size bytes at offset of a file, counted over all its parts
+    def read_file(self, name: str, offset: int = 0, size: int = None) -> bytes:
+        data = bytearray()
+        position = 0
+        for start, length in self.ranges(name):
+            end = position + length
+            if end > offset and (size is None or position < offset + size):
+                first = max(offset - position, 0)
+                last = length if size is None else min(length, offset + size - position)
+                data += self.read(start + first, last - first)
+            position = end
+        return bytes(data)
+
+    def file_size(self, name: str) -> int:
+        return sum(length for start, length in self.ranges(name))
+
+    # Names of the files in the archive, the parts of streamed files are listed once
+    def names(self) -> list:
+        return list(dict.fromkeys(strip_part(member[0]) for member in self.index['members']))
+
+    # Yield the content of a file in pieces of at most piece_size bytes, only the given (offset, size) ranges of it
+    # if ranges are passed
+    def iter_file(self, name: str, ranges: list = None, piece_size: int = 8 * 1024 * 1024):
+        for offset, size in ranges if ranges is not None else [(0, self.file_size(name))]:
+            for start in range(offset, offset + size, piece_size):
+                yield self.read_file(name, start, min(piece_size, offset + size - start))
+
+    # Database and byte ranges of the head and of the section of a table in a dump, None if it has no such table
+    def table_ranges(self, dump: str, database: str, table: str):
+        sections = self.index.get('dumps', {}).get(dump)
+        if not sections:
+            return None
+        return table_ranges(sections, self.file_size(dump), database, table)
+
+
+# The head of a dump with its session settings and the section of a table are all that is needed to restore the
+# table. Returns the database of the table and the (offset, size) ranges of both, or None if there is no such table.
+def table_ranges(sections: list, dump_size: int, database: str, table: str):
+    current_database = None
+    for index, (kind, name, offset) in enumerate(sections):
+        if kind == 'database':
+            current_database = name
+        elif kind == 'table' and name == table and (database is None or current_database == database):
+            end = sections[index + 1][2] if index + 1 < len(sections) else dump_size
+            return current_database, [(0, sections[0][2]), (offset, end - offset)]
+    return None
+
+
+# Passes the head of a dump and the section of one table to write(), for dumps without an index. The dump is fed in
+# pieces of any size; the database of the table is known once found is set.
+class TableFilter:
+
+    def __init__(self, database: str, table: str, write) -> None:
+        self.database = database
+        self.table = table
+        self.write = write
+        self.found = False
+        self.__in_head = True
+        self.__capturing = False
+        self.__current_database = None
+        self.__rest = b''
+
+    def feed(self, data: bytes):
+        data = self.__rest + data
+        end = data.rfind(b'\n') + 1
+        self.__rest = data[end:]
+        self.__process(data[:end])
+
+    def close(self):
+        self.__process(self.__rest)
+        self.__rest = b''
+
+    def __process(self, data: bytes):
+        position = 0
+        for match in DUMP_SECTION.finditer(data):
+            self.__emit(data[position:match.start()])
+            position = match.start()
+            self.__in_head = False
+            kind = SECTION_KINDS.get(match.group(1), 'other')
+            name = match.group(2).replace(b'``', b'`').decode('utf-8', 'replace')
+            if kind == 'database':
+                self.__current_database = name
+            self.__capturing = (not self.found and kind == 'table' and name == self.table and
+                                (self.database is None or self.__current_database == self.database))
+            if self.__capturing:
+                self.found = True
+                self.database = self.__current_database
+        self.__emit(data[position:])
+
+    def __emit(self, data: bytes):
+        if data and (self.__in_head or self.__capturing):
+            self.write(data)
+
+
+class Compression:
+
+    def __init__(self, compression_format='gzip', level=None, threads=None) -> None:
+        if compression_format not in FORMATS:
+            raise Exception(F"Unknown compression format '{compression_format}', "
+                            F"choose one of: {', '.join(FORMATS.keys())}")
+        if compression_format == 'zstd' and zstandard is None:
+            raise Exception("Compression format 'zstd' requires the zstandard package: pip3 install zstandard")
+        self.format = compression_format
+        self.level = level if level is not None else FORMATS[compression_format]['level']
+        self.threads = threads if threads else os.cpu_count() or 1
+        self.extension = FORMATS[compression_format]['extension']
+
+    # Wrap a binary file object into a compressing writer
+    def writer(self, fileobj):
+        if self.format == 'gzip':
+            return gzip.GzipFile(fileobj=fileobj, mode='wb', compresslevel=self.level)
+        elif self.format == 'pgzip':
+            return ParallelGzipWriter(fileobj, self.level, self.threads)
+        elif self.format == 'igzip':
+            return IndexedGzipWriter(fileobj, self.level, self.threads)
+        elif self.format == 'xz':
+            return ParallelXzWriter(fileobj, self.level, self.threads)
+        elif self.format == 'zstd':
+            compressor = zstandard.ZstdCompressor(level=self.level, threads=self.threads)
+            return compressor.stream_writer(fileobj, closefd=False)
+
+    @staticmethod
+    def from_config(values) -> 'Compression':
+        values = values or {}
+        return Compression(values.get('format', 'gzip'), values.get('level'), values.get('threads'))
+
+
+# Wrap a binary file object into a decompressing reader for the given format
+def reader(fileobj, compression_format):
+    if compression_format == 'gzip':
+        return gzip.GzipFile(fileobj=fileobj, mode='rb')
+    elif compression_format == 'xz':
+        return lzma.LZMAFile(fileobj, mode='rb')
+    elif compression_format == 'zstd':
+        if zstandard is None:
+            raise Exception("Reading zstd compressed backups requires the zstandard package: pip3 install zstandard")
+        return zstandard.ZstdDecompressor().stream_reader(fileobj, read_across_frames=True, closefd=False)
+
+
+# Passes writes through to a file and feeds them into a hash on the way
+class HashingWriter:
+
+    def __init__(self, fileobj, digest) -> None:
+        self.fileobj = fileobj
+        self.digest = digest
+
+    def write(self, data) -> int:
+        self.digest.update(data)
+        return self.fileobj.write(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+
+# Open a new compressed backup archive for writing. If a hashlib object is passed as digest, everything written to the
+# file is fed into it, so the checksum of the archive is known without reading it again. wrap is applied to the file
+# before anything is written to it, e.g. to limit the write rate. With encryption, the compressed stream is encrypted
+# on its way to the file.
+@contextmanager
+def open_backup(path: str, compression: Compression, digest=None, wrap=None, encryption: crypto.Encryption = None):
+    with open(path, 'wb') as file:
+        target = wrap(file) if wrap else file
+        target = HashingWriter(target, digest) if digest is not None else target
+        with backup_writer(target, compression, encryption) as tarball:
+            yield tarball
+
+
+# Open a new backup archive that is compressed, and encrypted if requested, into a file object, e.g. a channel to the
+# stage that writes the file
+@contextmanager
+def backup_writer(fileobj, compression: Compression, encryption: crypto.Encryption = None):
+    encrypter = encryption.writer(fileobj) if encryption else None
+    compressor = compression.writer(encrypter or fileobj)
+    try:
+        with IndexedTarFile.open(fileobj=compressor, mode='w|') as tarball:
+            yield tarball
+        if isinstance(compressor, IndexedGzipWriter):
+            compressor.index = {'members': tarball.index, 'dumps': tarball.dumps()}
+    finally:
+        compressor.close()
+        if encrypter:
+            encrypter.close()
+
+
+# SHA-256 of a file
+def file_checksum(path: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for data in iter(lambda: file.read(1024 * 1024), b''):
+            sha256.update(data)
+    return sha256.hexdigest()
+
+
+# Path of the checksum file stored next to a backup
+def checksum_path(path: str) -> str:
+    return path + '.sha256'
+
+
+# Write the checksum file of a backup in the format of sha256sum
+def write_checksum(path: str, checksum: str):
+    with open(checksum_path(path), 'w') as file:
+        file.write(F"{checksum}  {os.path.basename(path)}\n")
+
+
+# Read the checksum of a backup from its checksum file, None if there is none
+def read_checksum(path: str):
+    try:
+        with open(checksum_path(path)) as file:
+            return file.read().split()[0]
+    except (FileNotFoundError, IndexError):
+        return None
+
+
+# Open a backup archive for sequential reading, whatever compression format it was written with
+@contextmanager
+def open_tar(path: str, encryption: crypto.Encryption = None):
+    with open_file(path, encryption) as file:
+        decompressor = reader(file, detect_format(path, encryption))
+        try:
+            with tarfile.open(fileobj=decompressor, mode='r|') as tarball:
+                yield tarball
+        finally:
+            decompressor.close()
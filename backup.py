@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 
+import contextlib
 import datetime
+import os
 import sys
 from pathlib import Path
 import yaml
@@ -9,11 +11,12 @@ import utils
 from utils import _print
 from models import Container
 from models import Log
+from jobs import JobRunner
+import metrics
 from simple_term_menu import TerminalMenu
 
 
 def backup():
-    backup_status = True
 
     # Set flags
     utils.set_flags(sys.argv)
@@ -38,32 +41,64 @@ def backup():
         choice_index = terminal_menu.show()
         containers = {containers_to_choose_from[choice_index]: containers.get(containers_to_choose_from[choice_index])}
 
-    # Loop through Nextcloud container instances
-    container: Container
-    for container in containers.values():
+    # With --binlog only the binary logs closed since the last binlog backup are backed up
+    binlog = "--binlog" in sys.argv
+    if binlog:
+        containers = {name: container for name, container in containers.items() if container.binlog}
+        if not containers:
+            _print(F"{Fore.YELLOW}None of the chosen instances is in binlog mode{Style.RESET_ALL}")
+            return False
+
+    # Back up the Nextcloud container instances, several at once if --jobs is set. Two jobs never share a backup
+    # directory or a database host unless the limits in the config allow it.
+    concurrency = config_list.get('concurrency') or {}
+    runner = JobRunner(utils.jobs, {
+        'backup_dir': concurrency.get('backup_dir', 1),
+        'db_host': concurrency.get('db_host', 1),
+    })
+    results = runner.run(
+        containers.values(),
+        lambda container: backup_container(container, config_list, log, binlog),
+        lambda container: [('backup_dir', os.path.realpath(container.backup_dir)), ('db_host', container.db_host)])
+
+    return all(result is True for result in results.values())
+
+
+def backup_container(container: Container, config_list: dict, log: Log, binlog: bool = False) -> bool:
+    with utils.buffered_output() if utils.jobs > 1 else contextlib.nullcontext():
+        kind = "Binlog backup" if binlog else "Backup"
+        backup_file_path = container.binlog_file_path if binlog else container.archive_file_path
 
         # Start backup
         _print("----------------------------------------------")
-        _print(F"Start backup for {container.name} at {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-        result = container.create_backup()
-        if result:
-            _print(F"{Fore.GREEN}Backup for {container.name} successfully created under "
-                   F"{container.tar_gz_file_path} [{result} MB]{Style.RESET_ALL}")
+        _print(F"Start {kind.lower()} for {container.name} at {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+        result = container.backup_binlogs() if binlog else container.create_backup()
+        # A failed backup doesn't always leave an exception behind
+        backup_status = result is not False
+        if backup_status:
+            _print(F"{Fore.GREEN}{kind} for {container.name} successfully created under "
+                   F"{backup_file_path} [{result} MB]{Style.RESET_ALL}")
+            if not binlog:
+                _print(F"Maintenance mode was enabled for {round(container.maintenance_duration, 1)} seconds")
         else:
-            _print(F"{Fore.RED}Backup for {container.name} failed{Style.RESET_ALL}")
+            _print(F"{Fore.RED}{kind} for {container.name} failed{Style.RESET_ALL}")
             for func, traceback in container.exceptions.items():
                 _print()
                 _print(F"{Fore.YELLOW}Exception occurred in method: Container.{func}(){Style.RESET_ALL}")
                 _print(traceback)
                 _print()
-                backup_status = False
 
         # Log backup
         if not utils.no_log and config_list['log']['logging']:
-            if backup_status:
-                log.log(F"Created a backup ; {container.name} ; {container.tar_gz_file_path} ; {result} MB")
+            if backup_status and binlog:
+                log.log(F"Created a binlog backup ; {container.name} ; {backup_file_path} ; {result} MB ; "
+                        F"total {round(container.metrics.duration, 1)} s")
+            elif backup_status:
+                log.log(F"Created a backup ; {container.name} ; {backup_file_path} ; {result} MB ; "
+                        F"maintenance mode {round(container.maintenance_duration, 1)} s ; "
+                        F"total {round(container.metrics.duration, 1)} s")
             else:
-                log.log(F"Backup for {container.name} failed")
+                log.log(F"{kind} for {container.name} failed")
                 if len(log.exceptions) > 0:
                     for func, traceback in log.exceptions.items():
                         _print()
@@ -71,10 +106,24 @@ def backup():
                         _print(traceback)
                         _print()
 
+        # Write the run report
+        write_metrics(container, config_list)
+
         # Clean up backup folder
         container.cleanup()
 
     return backup_status
 
+
+# Write the JSON report and Prometheus metrics of the last run of a container if configured
+def write_metrics(container: Container, config_list: dict):
+    if container.metrics is None or not config_list.get('metrics'):
+        return
+    try:
+        metrics.write(container.metrics, config_list['metrics'])
+    except Exception as e:
+        _print(F"{Fore.YELLOW}Could not write metrics for {container.name}: {e}{Style.RESET_ALL}")
+
+
 if __name__ == '__main__':
     backup()
@@ -0,0 +1,756 @@
+#!/usr/bin/env python3
+
+import datetime
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import socketserver
+import struct
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import uuid
+from urllib.parse import unquote, urlparse, parse_qs
+from colorama import Fore, Style
+import utils
+from utils import _print
+import docker_api
+from models import Container
+from retention import parse_size
+
+# Instance the benchmark backs up and restores, and the containers the fake Docker Engine pretends to run
+INSTANCE = 'benchmark'
+APP_CONTAINER = 'benchmark-app'
+DB_CONTAINER = 'benchmark-db'
+DATABASE = 'nextcloud'
+INSTANCE_ID = 'oc8f3a2c91d7e4'
+
+# Scenarios are instance settings as in the config.yml, so every backup mode can be measured
+SCENARIOS = {
+    'spool': {},
+    'stream': {'stream_dump': True, 'compression': {'format': 'pgzip'}},
+    'online': {'stream_dump': True, 'online_snapshot': True, 'compression': {'format': 'pgzip'}},
+    'parallel': {'parallel_dump': 4, 'compression': {'format': 'pgzip'}},
+    'indexed': {'stream_dump': True, 'compression': {'format': 'igzip'}},
+    'zstd': {'stream_dump': True, 'compression': {'format': 'zstd'}},
+    'xz': {'stream_dump': True, 'compression': {'format': 'xz'}},
+    'repository': {'layout': 'repository'},
+    'encrypted': {'stream_dump': True, 'compression': {'format': 'pgzip'}, 'encryption': {'cipher': 'aes-256-gcm'}},
+}
+DEFAULT_SCENARIOS = ['spool', 'stream', 'parallel', 'repository']
+
+# Share of the dump each table gets. oc_filecache dominates real Nextcloud databases, followed by the activity stream.
+TABLES = [
+    ('oc_filecache', 0.62),
+    ('oc_activity', 0.16),
+    ('oc_filecache_extended', 0.06),
+    ('oc_authtoken', 0.04),
+    ('oc_share', 0.04),
+    ('oc_preferences', 0.03),
+    ('oc_mounts', 0.03),
+    ('oc_appconfig', 0.02),
+]
+
+# Distinct rows generated per table. Rows are drawn from the pool in a random order with fresh ids, which keeps the
+# generator fast enough to not be the bottleneck while the dump compresses like a real one.
+POOL_SIZE = 20000
+
+# mysqldump starts a new INSERT statement once one gets longer than net_buffer_length
+NET_BUFFER_LENGTH = 1024 * 1024
+
+# Seconds between two samples of the memory and tmp folder usage
+SAMPLE_INTERVAL = 0.05
+
+# Figures compared against the baseline and whether a higher value is better
+COMPARED = [('duration', False), ('throughput', True), ('peak_rss', False), ('tmp_peak', False)]
+
+FOLDERS = ['Documents', 'Photos', 'Camera', 'Projects', 'Invoices', 'Shared', 'Music', 'Videos', 'Backup', 'Notes',
+           'Work', 'Private', '2019', '2020', '2021', '2022', '2023', '2024', 'Archive', 'Scans', 'Talk', 'Templates']
+WORDS = ['report', 'IMG', 'scan', 'invoice', 'holiday', 'meeting', 'draft', 'final', 'notes', 'budget', 'photo',
+         'contract', 'letter', 'presentation', 'screenshot', 'recording', 'export', 'summary', 'plan', 'VID']
+# Extension, mimetype id, mimepart id and weight of the files in oc_filecache
+FILE_TYPES = [
+    ('jpg', 11, 10, 30), ('png', 12, 10, 8), ('heic', 13, 10, 6), ('pdf', 6, 5, 12), ('docx', 7, 5, 6),
+    ('xlsx', 8, 5, 4), ('txt', 15, 14, 6), ('md', 16, 14, 4), ('mp4', 18, 17, 6), ('mp3', 20, 19, 5),
+    ('zip', 9, 5, 3), ('odt', 10, 5, 3),
+]
+ACTIVITY_TYPES = ['file_created', 'file_changed', 'file_deleted', 'shared', 'file_restored', 'calendar_event']
+
+
+def _etag(rng: random.Random) -> str:
+    return F"{rng.getrandbits(52):013x}"
+
+
+# Tail of an oc_filecache row after its fileid. About a third of the rows are previews in the appdata folder, the rest
+# are files and folders of users with a long tailed distribution of files per storage and of file sizes.
+def _filecache_row(rng: random.Random) -> bytes:
+    storage = min(int(rng.paretovariate(1.1)), 500)
+    mtime = 1500000000 + rng.randrange(250000000)
+    if rng.random() < 0.35:
+        fileid = rng.randrange(1, 50000000)
+        hashed = hashlib.md5(str(fileid).encode()).hexdigest()
+        name = F"{rng.choice([64, 256, 1024, 4096])}-{rng.choice([64, 256, 1024, 4096])}-max.jpg"
+        path = F"appdata_{INSTANCE_ID}/preview/{'/'.join(hashed[:7])}/{fileid}/{name}"
+        storage, mimetype, mimepart, size = 1, 11, 10, int(rng.lognormvariate(10, 1.2))
+    else:
+        depth = min(int(rng.expovariate(0.5)), 10)
+        folders = '/'.join(rng.choice(FOLDERS) for _ in range(depth))
+        if rng.random() < 0.12:
+            name = rng.choice(FOLDERS)
+            mimetype, mimepart, size = 2, 1, int(rng.lognormvariate(18, 3))
+        else:
+            extension, mimetype, mimepart, _ = rng.choices(FILE_TYPES, [t[3] for t in FILE_TYPES])[0]
+            name = F"{rng.choice(WORDS)}_{rng.randrange(100000):05d}.{extension}"
+            size = int(rng.lognormvariate(12, 2.5))
+        path = '/'.join(part for part in ('files', folders, name) if part)
+    return (F"{storage},'{path}','{hashlib.md5(path.encode()).hexdigest()}',{rng.randrange(1, 50000000)},"
+            F"'{name}',{mimetype},{mimepart},{size},{mtime},{mtime},0,0,'{_etag(rng)}',"
+            F"{rng.choice([1, 19, 27, 31])},''").encode()
+
+
+def _activity_row(rng: random.Random) -> bytes:
+    user = F"user{int(rng.paretovariate(1.1)) % 1000}"
+    activity_type = rng.choice(ACTIVITY_TYPES)
+    fileid = rng.randrange(1, 50000000)
+    file = F"/{rng.choice(FOLDERS)}/{rng.choice(WORDS)}_{rng.randrange(100000):05d}.jpg"
+    params = json.dumps([{str(fileid): file}]).replace('"', '\\"')
+    return (F"{1500000000 + rng.randrange(250000000)},30,'{activity_type.split('_')[0]}','{user}','{user}','files',"
+            F"'{activity_type}_self','{params}','','[]','{file}',"
+            F"'https://cloud.example.com/index.php/apps/files/?dir=/{rng.choice(FOLDERS)}','files',{fileid}").encode()
+
+
+def _filecache_extended_row(rng: random.Random) -> bytes:
+    created = 1500000000 + rng.randrange(250000000)
+    return F"NULL,{created},{created + rng.randrange(1000)}".encode()
+
+
+def _authtoken_row(rng: random.Random) -> bytes:
+    user = F"user{rng.randrange(1000)}"
+    return (F"'{user}','{user}','{rng.getrandbits(512):0128x}','{rng.getrandbits(1024):0256x}',"
+            F"'{rng.choice(['Firefox', 'Chrome', 'Nextcloud Android', 'Nextcloud Desktop'])} "
+            F"({rng.choice(['Linux', 'Windows', 'macOS', 'Android'])})',0,{1500000000 + rng.randrange(250000000)},"
+            F"{1700000000 + rng.randrange(100000000)},0,0,NULL,NULL,'{rng.getrandbits(256):064x}',2,NULL").encode()
+
+
+def _share_row(rng: random.Random) -> bytes:
+    return (F"{rng.choice([0, 3])},'user{rng.randrange(1000)}','user{rng.randrange(1000)}','user{rng.randrange(1000)}',"
+            F"NULL,'file',{rng.randrange(1, 50000000)},NULL,{rng.randrange(1, 50000000)},'/{rng.choice(FOLDERS)}',"
+            F"{rng.choice([1, 17, 19, 31])},{1500000000 + rng.randrange(250000000)},NULL,NULL,"
+            F"'{rng.getrandbits(90):015x}',0,NULL,0").encode()
+
+
+def _preferences_row(rng: random.Random) -> bytes:
+    app = rng.choice(['core', 'settings', 'login', 'files'])
+    key = rng.choice(['lastLogin', 'email', 'lang', 'timezone', 'quota', 'firstLoginAccomplished', 'enabled'])
+    return F"'user{rng.randrange(1000)}','{app}','{key}','{_etag(rng)}'".encode()
+
+
+def _mounts_row(rng: random.Random) -> bytes:
+    user = F"user{rng.randrange(1000)}"
+    return (F"{rng.randrange(1, 1000)},{rng.randrange(1, 50000000)},'{user}','/{user}/',"
+            F"NULL,'OC\\\\Files\\\\Mount\\\\LocalHomeMountProvider'").encode()
+
+
+def _appconfig_row(rng: random.Random) -> bytes:
+    return (F"'{rng.choice(['core', 'files', 'activity', 'theming', 'dav', 'text', 'photos'])}',"
+            F"'setting_{rng.randrange(100000)}','{rng.getrandbits(128):032x}'").encode()
+
+
+ROWS = {
+    'oc_filecache': _filecache_row,
+    'oc_activity': _activity_row,
+    'oc_filecache_extended': _filecache_extended_row,
+    'oc_authtoken': _authtoken_row,
+    'oc_share': _share_row,
+    'oc_preferences': _preferences_row,
+    'oc_mounts': _mounts_row,
+    'oc_appconfig': _appconfig_row,
+}
+
+
+# Deterministic mysqldump output of a Nextcloud database of about the given size. The same seed gives the same dump.
+class SyntheticDump:
+
+    def __init__(self, size: int, seed: int = 0) -> None:
+        self.size = size
+        self.seed = seed
+        self.__pools = {}
+        self.__pools_lock = threading.Lock()
+
+    # Tables with the number of bytes of INSERT statements each, largest first
+    def tables(self) -> list:
+        return [(name, int(self.size * share)) for name, share in TABLES]
+
+    def __pool(self, table: str) -> tuple:
+        with self.__pools_lock:
+            if table not in self.__pools:
+                rng = random.Random(F"{self.seed}:{table}")
+                rows = [ROWS[table](rng) for _ in range(POOL_SIZE)]
+                # A prime length keeps the order from lining up with the pool
+                order = [rng.randrange(POOL_SIZE) for _ in range(65521)]
+                self.__pools[table] = (rows, order)
+            return self.__pools[table]
+
+    @staticmethod
+    def __structure(table: str) -> bytes:
+        return (F"\n--\n-- Table structure for table `{table}`\n--\n\n"
+                F"DROP TABLE IF EXISTS `{table}`;\n"
+                F"CREATE TABLE `{table}` (\n  `id` bigint(20) NOT NULL AUTO_INCREMENT,\n  PRIMARY KEY (`id`)\n"
+                F") ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_bin;\n\n"
+                F"--\n-- Dumping data for table `{table}`\n--\n\n"
+                F"LOCK TABLES `{table}` WRITE;\n").encode()
+
+    # Dump of one table, as written by "mysqldump database table", in pieces of about 1 MB
+    def table(self, table: str, extended: bool = True):
+        yield self.__structure(table)
+        rows, order = self.__pool(table)
+        budget = dict(self.tables())[table]
+        prefix = F"INSERT INTO `{table}` VALUES ".encode()
+        row_id, written = 1, 0
+        while written < budget:
+            pieces, length = [], 0
+            while length < NET_BUFFER_LENGTH and written + length < budget:
+                row = b'(%d,%s)' % (row_id, rows[order[row_id % len(order)]])
+                pieces.append(row)
+                length += len(row) + (len(prefix) + 3 if not extended else 1)
+                row_id += 1
+            if extended:
+                piece = prefix + b','.join(pieces) + b';\n'
+            else:
+                piece = b''.join(prefix + row + b';\n' for row in pieces)
+            written += len(piece)
+            yield piece
+        yield b"UNLOCK TABLES;\n"
+
+    # Dump of all databases, as written by "mysqldump --all-databases"
+    def database(self, extended: bool = True, dump_date: bool = True):
+        yield (F"-- MySQL dump 10.19  Distrib 10.11.6-MariaDB, for debian-linux-gnu (x86_64)\n--\n"
+               F"-- Host: localhost    Database: \n"
+               F"-- ------------------------------------------------------\n\n"
+               F"--\n-- Current Database: `{DATABASE}`\n--\n\n"
+               F"CREATE DATABASE /*!32312 IF NOT EXISTS*/ `{DATABASE}` /*!40100 DEFAULT CHARACTER SET utf8mb4 */;\n\n"
+               F"USE `{DATABASE}`;\n").encode()
+        for table, _ in self.tables():
+            yield from self.table(table, extended)
+        yield b"\n-- Dump completed" + (b" on 2024-01-01  0:00:00\n" if dump_date else b"\n")
+
+
+# The config folder of the app container: a config.php and generated *.config.php files up to the given size
+def config_files(size: int, seed: int = 0):
+    rng = random.Random(F"{seed}:config")
+    config = (F"<?php\n$CONFIG = array (\n  'instanceid' => '{INSTANCE_ID}',\n"
+              F"  'passwordsalt' => '{rng.getrandbits(128):032x}',\n  'secret' => '{rng.getrandbits(256):064x}',\n"
+              F"  'trusted_domains' => array (0 => 'cloud.example.com'),\n  'datadirectory' => '/var/www/html/data',\n"
+              F"  'dbtype' => 'mysql',\n  'dbname' => '{DATABASE}',\n  'dbhost' => 'db',\n"
+              F"  'installed' => true,\n);\n").encode()
+    yield "config/config.php", config
+    remaining, index = size - len(config), 0
+    while remaining > 0:
+        lines = [F"  '{rng.choice(WORDS)}_{rng.randrange(100000)}' => '{rng.getrandbits(256):064x}',\n"
+                 for _ in range(1000)]
+        data = ("<?php\n$CONFIG = array (\n" + ''.join(lines) + ");\n").encode()[:remaining]
+        yield F"config/generated{index}.config.php", data
+        remaining, index = remaining - len(data), index + 1
+
+
+# Body of an HTTP response sent with chunked transfer encoding
+class ChunkedWriter:
+
+    def __init__(self, fileobj) -> None:
+        self.fileobj = fileobj
+
+    def write(self, data) -> int:
+        if data:
+            self.fileobj.write(b'%x\r\n' % len(data) + bytes(data) + b'\r\n')
+        return len(data)
+
+    def close(self):
+        self.fileobj.write(b'0\r\n\r\n')
+        self.fileobj.flush()
+
+
+# Stand-in for the Docker Engine API of a Nextcloud app and database container. It answers the requests the scripts
+# send: execs of occ, mysqldump and mysql with a synthetic dump, and the config folder as a tar archive.
+class FakeDockerHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        try:
+            self.__handle()
+        except ConnectionError:
+            # The client dropped the connection, e.g. a killed dump
+            pass
+
+    def __handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line.strip():
+                return
+            method, target, _ = line.decode('ascii').split()
+            headers = {}
+            for line in iter(self.rfile.readline, b'\r\n'):
+                if not line:
+                    return
+                key, _, value = line.decode('latin-1').partition(':')
+                headers[key.strip().lower()] = value.strip()
+            url = urlparse(target)
+            path = url.path.split('/')[2:]
+            params = {key: values[0] for key, values in parse_qs(url.query).items()}
+            if method == 'POST' and path[0] == 'exec' and path[2] == 'start':
+                self.__read_body(headers)
+                self.__exec_start(self.server.execs[path[1]])
+                return
+            body = self.__read_body(headers)
+            if method == 'POST' and path[0] == 'containers' and path[2] == 'exec':
+                exec_id = uuid.uuid4().hex
+                self.server.execs[exec_id] = dict(json.loads(body), Running=False, ExitCode=None)
+                self.__reply(201, {'Id': exec_id})
+            elif method == 'GET' and path[0] == 'exec' and path[2] == 'json':
+                execution = self.server.execs[path[1]]
+                self.__reply(200, {'Running': execution['Running'], 'ExitCode': execution['ExitCode']})
+            elif method == 'GET' and path[0] == 'containers' and path[2] == 'archive':
+                self.__get_archive(unquote(params['path']))
+            elif method == 'PUT' and path[0] == 'containers' and path[2] == 'archive':
+                if self.server.uploads is not None:
+                    self.server.uploads.append((path[1], params['path'], body))
+                self.__reply(200, None)
+            elif method == 'GET' and path[0] == 'containers' and path[2] == 'json':
+                self.__reply(200, {'Id': path[1], 'Name': '/' + path[1], 'NetworkSettings': {'Networks': {}}})
+            else:
+                self.__reply(404, {'message': F"{method} {url.path} is not supported by the benchmark"})
+
+    # Read the request body. Uploads are dropped unless the server records them.
+    def __read_body(self, headers: dict) -> bytes:
+        if 'content-length' in headers:
+            return self.rfile.read(int(headers['content-length']))
+        body = bytearray()
+        if headers.get('transfer-encoding') == 'chunked':
+            while True:
+                size = int(self.rfile.readline().split(b';')[0], 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                while size > 0:
+                    data = self.rfile.read(min(size, 1024 * 1024))
+                    size -= len(data)
+                    if self.server.uploads is not None:
+                        body += data
+                self.rfile.readline()
+        return bytes(body)
+
+    def __reply(self, status: int, body):
+        data = json.dumps(body).encode() if body is not None else b''
+        self.wfile.write(F"HTTP/1.1 {status} OK\r\nContent-Type: application/json\r\n"
+                         F"Content-Length: {len(data)}\r\n\r\n".encode() + data)
+        self.wfile.flush()
+
+    def __get_archive(self, path: str):
+        if path.rstrip('/') != '/var/www/html/config':
+            self.__reply(404, {'message': F"Could not find the file {path} in container"})
+            return
+        self.wfile.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/x-tar\r\nTransfer-Encoding: chunked\r\n\r\n")
+        body = ChunkedWriter(self.wfile)
+        try:
+            with tarfile.open(fileobj=body, mode='w|') as tarball:
+                for name, data in config_files(self.server.config_size, self.server.seed):
+                    info = tarfile.TarInfo(name)
+                    info.size, info.mode, info.mtime = len(data), 0o640, 1700000000
+                    tarball.addfile(info, io.BytesIO(data))
+            body.close()
+        except OSError:
+            # tarfile stops reading at the end of the archive and the client drops the rest of the response
+            pass
+
+    # Run the command of an exec on the hijacked connection and send its output as multiplexed frames
+    def __exec_start(self, execution: dict):
+        execution['Running'] = True
+        self.wfile.write(b"HTTP/1.1 101 UPGRADED\r\nContent-Type: application/vnd.docker.raw-stream\r\n"
+                         b"Connection: Upgrade\r\nUpgrade: tcp\r\n\r\n")
+
+        def output(data: bytes, stream=docker_api.STDOUT):
+            self.wfile.write(struct.pack('>BxxxI', stream, len(data)) + data)
+
+        try:
+            execution['ExitCode'] = self.__run(execution['Cmd'], execution.get('AttachStdin'), output)
+        except OSError:
+            # The client dropped the connection
+            execution['ExitCode'] = 137
+        finally:
+            execution['Running'] = False
+        try:
+            self.wfile.flush()
+        except OSError:
+            pass
+
+    def __run(self, command: list, stdin: bool, output) -> int:
+        # Priorities set by the throttle don't matter here
+        while command and command[0] in ('nice', 'ionice'):
+            command = command[1:]
+            while command and command[0].startswith('-'):
+                command = command[2:] if command[0] in ('-n', '-c') else command[1:]
+        dump = self.server.dump
+        if command[:2] == ['php', 'occ']:
+            output(b"Maintenance mode enabled\n" if command[-1] == '--on' else b"Maintenance mode disabled\n")
+        elif command[0] == 'mysqldump':
+            arguments = [argument for argument in command[1:] if not argument.startswith('--')]
+            extended = '--skip-extended-insert' not in command
+            pieces = dump.table(arguments[1], extended) if len(arguments) == 2 else \
+                dump.database(extended, '--skip-dump-date' not in command)
+            for piece in pieces:
+                output(piece)
+        elif command[0] == 'mysql' and '--execute' in command:
+            query = command[command.index('--execute') + 1]
+            if 'information_schema.schemata' in query:
+                output(F"{DATABASE}\tutf8mb4\tutf8mb4_general_ci\n".encode())
+            elif 'information_schema.tables' in query:
+                # Like InnoDB on MariaDB, the tables have no update time unless one is set
+                output(''.join(F"{DATABASE}\t{table}\t{self.server.update_times.get(table, 'NULL')}\n"
+                               for table, _ in dump.tables()).encode())
+            elif query.startswith('CHECKSUM TABLE'):
+                name = query.split()[-1].replace('`', '')
+                output(F"{name}\t{self.server.checksums.get(name.split('.')[-1], 'NULL')}\n".encode())
+            elif query == 'SELECT NOW()':
+                output(F"{self.server.now}\n".encode())
+        elif command[0] == 'mysql':
+            # Imports are read and dropped unless the server records them
+            data = bytearray()
+            while stdin:
+                piece = self.rfile.read1(1024 * 1024)
+                if not piece:
+                    break
+                if self.server.imports is not None:
+                    data += piece
+            if self.server.imports is not None:
+                self.server.imports.append((command, bytes(data)))
+        elif command[0] not in ('rm', 'test', 'chown'):
+            output(F"{command[0]}: command not found\n".encode(), docker_api.STDERR)
+            return 127
+        return 0
+
+
+class FakeDockerServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, size: int, config_size: int, seed: int) -> None:
+        super().__init__(socket_path, FakeDockerHandler)
+        self.dump = SyntheticDump(size, seed)
+        self.config_size = config_size
+        self.seed = seed
+        self.execs = {}
+        # Set to lists to keep the SQL fed to mysql as (command, data) and the archives uploaded as
+        # (container, path, data), e.g. to check a restore
+        self.imports = None
+        self.uploads = None
+        # Change signals of the tables, as the server reports them to skip_unchanged
+        self.update_times = {}
+        self.checksums = {}
+        self.now = "2024-01-01 00:00:00"
+
+
+def _serve(socket_path: str, size: int, config_size: int, seed: int):
+    FakeDockerServer(socket_path, size, config_size, seed).serve_forever()
+
+
+# Current and peak memory of this process, from /proc on Linux
+def _rss() -> int:
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        return 0
+
+
+# Reset the peak RSS the kernel keeps for this process, so it can be read per phase. Returns False where that isn't
+# possible; then only the samples count.
+def _reset_peak_rss() -> bool:
+    try:
+        with open('/proc/self/clear_refs', 'w') as file:
+            file.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss() -> int:
+    try:
+        with open('/proc/self/status') as file:
+            for line in file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # ru_maxrss is in kilobytes on Linux and covers the whole life of the process
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _disk_usage(path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+# Samples the memory of this process and the size of the tmp folder while a phase runs and keeps the highest values
+class Sampler:
+
+    def __init__(self, tmp_dir: str, interval: float = SAMPLE_INTERVAL) -> None:
+        self.tmp_dir = tmp_dir
+        self.interval = interval
+        self.peak_rss = 0
+        self.tmp_peak = 0
+        self.__exact = False
+        self.__stop = threading.Event()
+        self.__thread = None
+
+    def __sample(self):
+        self.peak_rss = max(self.peak_rss, _rss())
+        self.tmp_peak = max(self.tmp_peak, _disk_usage(self.tmp_dir))
+
+    def __run(self):
+        while not self.__stop.wait(self.interval):
+            self.__sample()
+
+    def __enter__(self):
+        self.__exact = _reset_peak_rss()
+        self.__sample()
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.__stop.set()
+        self.__thread.join()
+        self.__sample()
+        if self.__exact:
+            self.peak_rss = max(self.peak_rss, _peak_rss())
+
+
+# Runs the scenarios against the fake Docker Engine and collects the figures of the backup and restore phases
+class Benchmark:
+
+    def __init__(self, size: int, config_size: int, work_dir: str, seed: int = 0) -> None:
+        self.size = size
+        self.config_size = config_size
+        self.work_dir = work_dir
+        self.seed = seed
+        self.__server = None
+
+    def __enter__(self):
+        os.makedirs(self.work_dir, exist_ok=True)
+        socket_path = os.path.join(self.work_dir, 'docker.sock')
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        # The fake daemon runs in its own process, so generating the dump doesn't count against the scripts
+        self.__server = multiprocessing.Process(target=_serve, args=(socket_path, self.size, self.config_size,
+                                                                     self.seed), daemon=True)
+        self.__server.start()
+        deadline = time.monotonic() + 10
+        while not os.path.exists(socket_path):
+            if time.monotonic() > deadline or not self.__server.is_alive():
+                raise Exception("The fake Docker Engine did not start")
+            time.sleep(0.05)
+        os.environ['DOCKER_HOST'] = F"unix://{socket_path}"
+        return self
+
+    def __exit__(self, *args):
+        self.__server.terminate()
+        self.__server.join()
+
+    # Back up the instance with the settings of a scenario and restore the backup. Every scenario runs in a fresh
+    # process, so memory held on to after earlier scenarios doesn't count against it.
+    def run(self, scenario: str, restore: bool = True) -> dict:
+        with multiprocessing.get_context('spawn').Pool(1) as pool:
+            return pool.apply(_run_scenario, (sys.argv, self.work_dir, scenario, restore))
+
+
+def _config(scenario: str, backup_dir: str) -> dict:
+    values = {
+        'mysql_root_password': 'benchmark',
+        'app_container': APP_CONTAINER,
+        'db_container': DB_CONTAINER,
+        'backup_dir': backup_dir,
+        'docker_compose_file_path': None,
+        'number_of_backups': 1,
+    }
+    values.update(SCENARIOS[scenario])
+    if 'encryption' in values:
+        # A throwaway key next to the backup dirs
+        key_file = os.path.join(os.path.dirname(backup_dir), 'benchmark.key')
+        if not os.path.isfile(key_file):
+            with open(key_file, 'wb') as file:
+                file.write(os.urandom(32))
+        values['encryption'] = dict(values['encryption'], key_file=key_file)
+    return {'nextcloud_containers': {INSTANCE: values}}
+
+
+def _phase(container: Container, sampler: Sampler) -> dict:
+    report = container.metrics.report()
+    # Throughput of the uncompressed data, i.e. of the dump read by a backup and imported by a restore
+    processed = report['bytes_read'] if report['operation'] == 'backup' else report['bytes_written']
+    return {
+        'success': report['success'],
+        'duration': report['duration'],
+        'throughput': round(processed / 1000000 / report['duration'], 2) if report['duration'] else 0.0,
+        'peak_rss': sampler.peak_rss,
+        'tmp_peak': sampler.tmp_peak,
+        # Bytes added to the backup dir
+        'archive_size': report['bytes_written'] if report['operation'] == 'backup' else None,
+        'steps': {step['step']: step['duration'] for step in report['steps']},
+    }
+
+
+def _run_scenario(flags: list, work_dir: str, scenario: str, restore: bool) -> dict:
+    utils.set_flags(flags)
+    backup_dir = os.path.join(work_dir, scenario)
+    tmp_dir = os.path.join(backup_dir, 'tmp')
+    shutil.rmtree(backup_dir, ignore_errors=True)
+    config = _config(scenario, backup_dir)
+    results = {}
+    try:
+        _print(F"{Fore.GREEN}{scenario}: backup{Style.RESET_ALL}")
+        container = Container.instantiate_container(config, INSTANCE)
+        with Sampler(tmp_dir) as sampler:
+            status = container.create_backup() is not False
+        results['backup'] = _phase(container, sampler)
+        _print_exceptions(container)
+        if restore and status:
+            _print(F"{Fore.GREEN}{scenario}: restore{Style.RESET_ALL}")
+            backup_file_path = container.archive_file_path
+            container = Container.instantiate_container(config, INSTANCE)
+            with Sampler(tmp_dir) as sampler:
+                container.restore_backup(backup_file_path)
+            results['restore'] = _phase(container, sampler)
+            _print_exceptions(container)
+    finally:
+        shutil.rmtree(backup_dir, ignore_errors=True)
+    return results
+
+
+def _print_exceptions(container: Container):
+    for name, exception in container.exceptions.items():
+        _print(F"{Fore.RED}{name}: {exception}{Style.RESET_ALL}")
+
+
+def _mb(value) -> str:
+    return F"{value / 1000000:.1f} MB" if value is not None else "-"
+
+
+def _format(figure: str, value) -> str:
+    if figure == 'duration':
+        return F"{value:.1f} s"
+    if figure == 'throughput':
+        return F"{value:.1f} MB/s"
+    return _mb(value)
+
+
+def print_results(results: dict):
+    _print()
+    _print(F"{'Scenario':<12}{'Phase':<9}{'Duration':>10}{'Throughput':>14}{'Peak RSS':>12}{'Tmp peak':>12}"
+           F"{'Archive':>12}")
+    for scenario, phases in results['scenarios'].items():
+        for phase, figures in phases.items():
+            color = Fore.RESET if figures['success'] else Fore.RED
+            _print(F"{color}{scenario:<12}{phase:<9}{figures['duration']:>8.1f} s{figures['throughput']:>9.1f} MB/s"
+                   F"{_mb(figures['peak_rss']):>12}{_mb(figures['tmp_peak']):>12}{_mb(figures['archive_size']):>12}"
+                   F"{Style.RESET_ALL}")
+            steps = ', '.join(F"{step} {duration:.1f} s" for step, duration in figures['steps'].items())
+            _print(F"{'':<21}{steps}")
+
+
+# Compare results with a baseline and print the differences. Returns False if a figure got worse by more than the
+# threshold in percent.
+def compare(results: dict, baseline: dict, threshold: float) -> bool:
+    for key in ('size', 'config_size', 'seed'):
+        if results.get(key) != baseline.get(key):
+            _print(F"{Fore.YELLOW}The baseline was measured with {key} {baseline.get(key)}, "
+                   F"not {results.get(key)}{Style.RESET_ALL}")
+    _print()
+    _print(F"{'Scenario':<12}{'Phase':<9}{'Figure':<12}{'Baseline':>14}{'Current':>14}{'Change':>10}")
+    status = True
+    for scenario, phases in results['scenarios'].items():
+        for phase, figures in phases.items():
+            previous = baseline.get('scenarios', {}).get(scenario, {}).get(phase)
+            if not previous or not previous['success'] or not figures['success']:
+                continue
+            for figure, higher_is_better in COMPARED:
+                old, new = previous[figure], figures[figure]
+                if not old:
+                    continue
+                change = (new - old) / old * 100
+                regression = (-change if higher_is_better else change) > threshold
+                improvement = (change if higher_is_better else -change) > threshold
+                color = Fore.RED if regression else Fore.GREEN if improvement else Fore.RESET
+                status = status and not regression
+                _print(F"{color}{scenario:<12}{phase:<9}{figure:<12}{_format(figure, old):>14}"
+                       F"{_format(figure, new):>14}{change:>+9.1f}%{Style.RESET_ALL}")
+    if not status:
+        _print(F"{Fore.RED}Slower or bigger than the baseline by more than {threshold}%{Style.RESET_ALL}")
+    return status
+
+
+def benchmark():
+
+    # Set flags
+    utils.set_flags(sys.argv)
+
+    size = parse_size(utils.get_option(sys.argv, "--size", "1 GB"))
+    config_size = parse_size(utils.get_option(sys.argv, "--config-size", "1 MB"))
+    seed = int(utils.get_option(sys.argv, "--seed", 0))
+    scenarios = utils.get_option(sys.argv, "--scenarios", ','.join(DEFAULT_SCENARIOS)).split(',')
+    unknown = [scenario for scenario in scenarios if scenario not in SCENARIOS]
+    if unknown:
+        _print(F"{Fore.RED}Unknown scenarios: {', '.join(unknown)}, choose from: {', '.join(SCENARIOS)}"
+               F"{Style.RESET_ALL}")
+        return False
+    work_dir = utils.get_option(sys.argv, "--dir") or tempfile.mkdtemp(prefix='nextcloud-benchmark-')
+
+    results = {
+        'started': datetime.datetime.now().isoformat(timespec='seconds'),
+        'host': platform.node(),
+        'cpus': os.cpu_count(),
+        'python': platform.python_version(),
+        'size': size,
+        'config_size': config_size,
+        'seed': seed,
+        'scenarios': {},
+    }
+    with Benchmark(size, config_size, work_dir, seed) as bench:
+        for scenario in scenarios:
+            try:
+                results['scenarios'][scenario] = bench.run(scenario, "--norestore" not in sys.argv)
+            except Exception as e:
+                # E.g. a compression format whose package isn't installed
+                _print(F"{Fore.YELLOW}Skip scenario {scenario}: {e}{Style.RESET_ALL}")
+    print_results(results)
+
+    status = all(figures['success'] for phases in results['scenarios'].values() for figures in phases.values())
+    output = utils.get_option(sys.argv, "--output")
+    if output:
+        with open(output, 'w') as file:
+            json.dump(results, file, indent=2)
+    baseline_path = utils.get_option(sys.argv, "--baseline")
+    if baseline_path:
+        with open(baseline_path) as file:
+            baseline = json.load(file)
+        status = compare(results, baseline, float(utils.get_option(sys.argv, "--threshold", 10))) and status
+    baseline_path = utils.get_option(sys.argv, "--save-baseline")
+    if baseline_path:
+        with open(baseline_path, 'w') as file:
+            json.dump(results, file, indent=2)
+        _print(F"Baseline saved to {baseline_path}")
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(0 if benchmark() else 1)
@@ -0,0 +1,118 @@
+import datetime
+import itertools
+import os
+import re
+
+# Incremental archives of the binary logs are kept in this subfolder of the backup dir, with a catalog of their own
+DIRECTORY = 'binlog'
+
+# Position of the binary log a dump starts at, written as a comment by mysqldump --master-data=2. MySQL 8.0.26 and
+# later use the REPLICATION SOURCE wording.
+POSITION = re.compile(rb"^-- CHANGE (?:MASTER|REPLICATION SOURCE) TO (?:MASTER|SOURCE)_LOG_FILE='([^']+)', "
+                      rb"(?:MASTER|SOURCE)_LOG_POS=([0-9]+)", re.MULTILINE)
+
+# The position is written ahead of the first database, only this much of a dump is searched for it
+HEAD_SIZE = 64 * 1024
+
+# Binary logs are named <basename>.<sequence number>
+LOG_NAME = re.compile(r'^(?P<basename>.+)\.(?P<number>[0-9]+)$')
+
+# Format of the target time of a point-in-time restore, as mysqlbinlog --stop-datetime expects it
+UNTIL_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+# Folder of the binlog archives of a backup dir
+def binlog_dir(backup_dir: str) -> str:
+    return os.path.join(backup_dir, DIRECTORY)
+
+
+# Parse the target time of a point-in-time restore like "2024-05-01 13:45" or "2024-05-01 13:45:30"
+def parse_until(value: str) -> datetime.datetime:
+    try:
+        return datetime.datetime.fromisoformat(value.strip())
+    except ValueError:
+        raise Exception(F"Invalid time '{value}', expected YYYY-MM-DD HH:MM[:SS]")
+
+
+def sequence(log_name: str) -> int:
+    match = LOG_NAME.match(log_name)
+    if not match:
+        raise Exception(F"Unexpected binary log name {log_name}")
+    return int(match.group('number'))
+
+
+# Name of the binary log the server opens after the given one
+def next_name(log_name: str) -> str:
+    match = LOG_NAME.match(log_name)
+    number = match.group('number')
+    return F"{match.group('basename')}.{int(number) + 1:0{len(number)}d}"
+
+
+# Binary logs to replay from the given one on, as (archive path, log name) in order, taken from the catalog entries of
+# the binlog archives. The chain ends at the first log that is missing; the names of later logs are returned as well,
+# they can't be replayed.
+def replay_chain(archives: list, start: str) -> tuple:
+    paths = {}
+    for backup in archives:
+        for name in backup['members']:
+            paths.setdefault(name, backup['path'])
+    chain = []
+    name = start
+    while name in paths:
+        chain.append((paths[name], name))
+        name = next_name(name)
+    if not chain:
+        raise Exception(F"Binary log {start} is not in the binlog backups, no binlog backup was made since the dump")
+    unreachable = sorted((name for name in paths if sequence(name) > sequence(chain[-1][1])), key=sequence)
+    return chain, unreachable
+
+
+# The chain grouped by archive, so each archive is read once
+def group_by_archive(chain: list):
+    for path, items in itertools.groupby(chain, key=lambda item: item[0]):
+        yield path, [name for _, name in items]
+
+
+# Finds the binary log position in the head of a dump that is passed through feed() piece by piece
+class PositionScanner:
+
+    def __init__(self) -> None:
+        self.file = None
+        self.position = None
+        self.__head = b''
+        self.__done = False
+
+    def feed(self, data: bytes):
+        if self.__done:
+            return
+        self.__head += data[:HEAD_SIZE - len(self.__head)]
+        match = POSITION.search(self.__head)
+        if match:
+            self.file, self.position = match.group(1).decode('utf-8'), int(match.group(2))
+        if match or len(self.__head) >= HEAD_SIZE:
+            self.__done = True
+            self.__head = b''
+
+    # Wrap a write function, so everything written is scanned on the way
+    def wrap(self, write):
+        def scanning_write(data):
+            self.feed(data)
+            write(data)
+        return scanning_write
+
+
+# Binlog mode: full dumps record the binary log position they start at, and in between backup.py --binlog copies the
+# binary logs closed since the last run into small incremental archives. A restore can then replay the logs on top of
+# a full backup up to any point in time covered by them.
+class Binlog:
+
+    def __init__(self, schedule: str = None) -> None:
+        self.schedule = schedule
+
+    @staticmethod
+    def from_config(values):
+        if not values:
+            return None
+        if values is True:
+            return Binlog()
+        return Binlog(values.get('schedule'))
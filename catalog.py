@@ -0,0 +1,161 @@
+import datetime
+import json
+import os
+import re
+import sqlite3
+from contextlib import closing
+
+import archive
+from repository import Repository
+
+CATALOG_FILE = 'catalog.sqlite'
+
+# Backup names are <instance>_<datetime>, the datetime is formatted like this
+DATETIME_FORMAT = "%Y-%m-%d_%H%M%S"
+BACKUP_NAME = re.compile(r'^(?P<instance>.+)_(?P<datetime>[0-9]{4}-[0-9]{2}-[0-9]{2}_[0-9]{6})$')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS backups (
+    path TEXT PRIMARY KEY,
+    file_name TEXT NOT NULL,
+    instance TEXT NOT NULL,
+    created TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    checksum TEXT,
+    format TEXT NOT NULL,
+    members TEXT NOT NULL,
+    tables TEXT
+);
+CREATE INDEX IF NOT EXISTS backups_instance_created ON backups (instance, created);
+"""
+
+COLUMNS = ('path', 'file_name', 'instance', 'created', 'size', 'checksum', 'format', 'members', 'tables')
+
+# Member of a parallel dump listing its tables, their checksums and the archive each of them was dumped into
+TABLES_SUFFIX = '.tables.json'
+
+
+# Split a backup name into instance name and creation time, None if it isn't a backup name
+def parse_name(backup_name: str):
+    match = BACKUP_NAME.match(backup_name)
+    if not match:
+        return None
+    try:
+        created = datetime.datetime.strptime(match.group('datetime'), DATETIME_FORMAT)
+    except ValueError:
+        return None
+    return match.group('instance'), created
+
+
+# Name of a backup, <instance>_<datetime>, from the path of its archive or snapshot manifest
+def backup_name(path: str) -> str:
+    if Repository.is_snapshot(path):
+        return os.path.splitext(os.path.basename(path))[0]
+    return archive.strip_extension(os.path.basename(path))
+
+
+# Names of the files in a backup, the parts of streamed files are listed once
+def member_names(names) -> list:
+    return list(dict.fromkeys(archive.strip_part(name.lstrip('/')) for name in names))
+
+
+# Index of all backups in a backup dir, kept in a SQLite database next to them. Listing and pruning backups are
+# lookups in the index instead of directory scans; reindex() rebuilds it from the files on disk.
+class Catalog:
+
+    def __init__(self, backup_dir: str) -> None:
+        self.backup_dir = backup_dir
+        self.path = os.path.join(backup_dir, CATALOG_FILE)
+        self.skipped = []
+
+    def exists(self) -> bool:
+        return os.path.isfile(self.path)
+
+    def __connect(self) -> sqlite3.Connection:
+        os.makedirs(self.backup_dir, exist_ok=True)
+        connection = sqlite3.connect(self.path, timeout=60)
+        connection.row_factory = sqlite3.Row
+        connection.executescript(SCHEMA)
+        # Catalogs written before unchanged tables were skipped have no tables column yet
+        if 'tables' not in [row['name'] for row in connection.execute("PRAGMA table_info(backups)")]:
+            connection.execute("ALTER TABLE backups ADD COLUMN tables TEXT")
+        return connection
+
+    # Record a backup that has just been written
+    def add(self, path: str, instance: str, created: datetime.datetime, compression_format: str, members: list,
+            checksum: str = None, tables: dict = None):
+        with closing(self.__connect()) as connection, connection:
+            self.__insert(connection, path, instance, created, compression_format, members, tables, checksum)
+
+    @staticmethod
+    def __insert(connection, path, instance, created, compression_format, members, tables, checksum):
+        entry = {
+            'path': os.path.abspath(path),
+            'file_name': os.path.basename(path),
+            'instance': instance,
+            'created': created.isoformat(timespec='seconds'),
+            'size': os.path.getsize(path),
+            'checksum': checksum,
+            'format': compression_format,
+            'members': json.dumps(member_names(members)),
+            'tables': json.dumps(tables) if tables is not None else None,
+        }
+        connection.execute(F"INSERT OR REPLACE INTO backups ({', '.join(COLUMNS)}) "
+                           F"VALUES ({', '.join('?' * len(COLUMNS))})", [entry[c] for c in COLUMNS])
+
+    def remove(self, paths: list):
+        with closing(self.__connect()) as connection, connection:
+            connection.executemany("DELETE FROM backups WHERE path = ?", [(os.path.abspath(p),) for p in paths])
+
+    # Backups of one instance or of all instances, oldest first
+    def backups(self, instance: str = None) -> list:
+        with closing(self.__connect()) as connection:
+            if instance is None:
+                rows = connection.execute("SELECT * FROM backups ORDER BY created, path").fetchall()
+            else:
+                rows = connection.execute("SELECT * FROM backups WHERE instance = ? ORDER BY created, path",
+                                          (instance,)).fetchall()
+        return [dict(row, members=json.loads(row['members']), tables=json.loads(row['tables'] or 'null'))
+                for row in rows]
+
+    # Rebuild the catalog from the backups on disk and return the number of backups found. Archives that can't be
+    # read are left out and listed in self.skipped. Encrypted archives are read with the encryption settings of their
+    # instance; without them only their name is recorded, so they still count for the retention.
+    def reindex(self, encryptions: dict = None) -> int:
+        entries = []
+        self.skipped = []
+        for entry in os.scandir(self.backup_dir):
+            if entry.is_file() and archive.is_backup(entry.name):
+                parsed = parse_name(archive.strip_extension(entry.name))
+                if parsed:
+                    encryption = (encryptions or {}).get(parsed[0])
+                    try:
+                        if encryption is None and archive.is_encrypted(entry.path):
+                            entries.append((entry.path, parsed[0], parsed[1], 'encrypted', [], None))
+                            continue
+                        members, tables = [], None
+                        with archive.open_tar(entry.path, encryption) as tarball:
+                            for member in tarball:
+                                members.append(member.name)
+                                if '/' not in member.name and member.name.endswith(TABLES_SUFFIX):
+                                    tables = json.load(tarball.extractfile(member))
+                        compression_format = archive.detect_format(entry.path, encryption)
+                    except Exception:
+                        self.skipped.append(entry.path)
+                        continue
+                    entries.append((entry.path, parsed[0], parsed[1], compression_format, members, tables))
+        repository = Repository(self.backup_dir)
+        for snapshot_path in repository.snapshots():
+            parsed = parse_name(os.path.splitext(os.path.basename(snapshot_path))[0])
+            if parsed:
+                manifest = Repository.read_snapshot(snapshot_path)
+                entries.append((snapshot_path, manifest['instance'], parsed[1], 'repository',
+                                [member['name'] for member in manifest['members']], None))
+        # Only checksums written together with a backup are trusted; hashing the file as it is now would vouch for
+        # whatever damage it has
+        checksums = [archive.read_checksum(entry[0]) for entry in entries]
+        with closing(self.__connect()) as connection, connection:
+            connection.execute("DELETE FROM backups")
+            for entry, checksum in zip(entries, checksums):
+                self.__insert(connection, *entry, checksum)
+        return len(entries)
@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+
+import sys
+from pathlib import Path
+import yaml
+import utils
+from utils import _print
+from models import Container
+from simple_term_menu import TerminalMenu
+
+
+def cleanup():
+
+    # Set flags
+    utils.set_flags(sys.argv)
+
+    # Load configuration
+    config = Path(__file__).parent / "config.yml"
+    with open(config) as file:
+        config_list = yaml.full_load(file)
+        containers = Container.instantiate_containers(config_list)
+
+    # If any container names were passed as parameters, do only clean up their backups
+    containers_wanted = {name: container for name, container in containers.items() if name in sys.argv}
+    if containers_wanted:
+        containers = containers_wanted
+
+    # If no container was chosen ask for it
+    elif not utils.all_containers:
+        containers_to_choose_from = [container.name for container in containers.values()]
+        terminal_menu = TerminalMenu(containers_to_choose_from, title="Which Nextcloud instance's backups do you want "
+                                                                      "to clean up?")
+        choice_index = terminal_menu.show()
+        containers = {containers_to_choose_from[choice_index]: containers.get(containers_to_choose_from[choice_index])}
+
+    container: Container
+    for container in containers.values():
+        _print("----------------------------------------------")
+        _print(F"Clean up backups of {container.name}")
+        container.cleanup()
+
+
+if __name__ == '__main__':
+    cleanup()
@@ -0,0 +1,111 @@
+import datetime
+import hashlib
+import re
+
+# Allowed values of the fields of a cron expression: minute, hour, day of month, month, day of week
+FIELDS = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
+
+NAMES = [
+    {},
+    {},
+    {},
+    {name: number for number, name in enumerate(
+        ['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec'], 1)},
+    {name: number for number, name in enumerate(['sun', 'mon', 'tue', 'wed', 'thu', 'fri', 'sat'])},
+]
+
+MACROS = {
+    '@yearly': '0 0 1 1 *',
+    '@annually': '0 0 1 1 *',
+    '@monthly': '0 0 1 * *',
+    '@weekly': '0 0 * * 0',
+    '@daily': '0 0 * * *',
+    '@midnight': '0 0 * * *',
+    '@hourly': '0 * * * *',
+}
+
+DURATION_UNITS = {'': 1, 's': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+# Parse a duration like 90, "90s", "15m" or "2h" into seconds
+def parse_duration(duration) -> int:
+    if duration is None or isinstance(duration, (int, float)):
+        return duration or 0
+    match = re.fullmatch(r'\s*([0-9.]+)\s*([smhd]?)\s*', str(duration).lower())
+    if not match:
+        raise Exception(F"Invalid duration: {duration}")
+    return int(float(match.group(1)) * DURATION_UNITS[match.group(2)])
+
+
+# Offset of up to spread seconds that is always the same for the same key, so the start times of instances with the
+# same schedule are spread over the window but don't move between restarts of the scheduler
+def spread_offset(key: str, spread: int) -> int:
+    if not spread:
+        return 0
+    return int(hashlib.sha256(key.encode('utf-8')).hexdigest(), 16) % int(spread)
+
+
+# A schedule in the crontab format "minute hour day-of-month month day-of-week". Fields accept *, numbers, names of
+# months and weekdays, ranges, lists and steps, e.g. "30 2 * * mon-fri" or "0 */6 * * *". The @daily style macros
+# work as well.
+class CronSchedule:
+
+    def __init__(self, expression: str) -> None:
+        self.expression = expression
+        fields = MACROS.get(expression.strip().lower(), expression).split()
+        if len(fields) != 5:
+            raise Exception(F"Invalid schedule '{expression}', expected 5 fields")
+        self.minutes, self.hours, self.days, self.months, self.weekdays = (
+            self.__parse_field(field, index) for index, field in enumerate(fields))
+        # Sunday is 0 and 7
+        if 7 in self.weekdays:
+            self.weekdays = self.weekdays - {7} | {0}
+        # Like cron, if both day fields are restricted a day matches if either of them does
+        self.__any_day = fields[2] == '*' or fields[4] == '*'
+
+    def __parse_field(self, field: str, index: int) -> set:
+        low, high = FIELDS[index]
+        values = set()
+        for part in field.lower().split(','):
+            match = re.fullmatch(r'(\*|[a-z0-9]+(?:-[a-z0-9]+)?)(?:/([0-9]+))?', part)
+            if not match:
+                raise Exception(F"Invalid schedule '{self.expression}': {part}")
+            if match.group(1) == '*':
+                start, end = low, high
+            else:
+                bounds = [self.__value(bound, index) for bound in match.group(1).split('-')]
+                start, end = bounds[0], bounds[-1] if len(bounds) > 1 or match.group(2) is None else high
+            step = int(match.group(2) or 1)
+            if not low <= start <= end <= high or step < 1:
+                raise Exception(F"Invalid schedule '{self.expression}': {part}")
+            values.update(range(start, end + 1, step))
+        return values
+
+    def __value(self, value: str, index: int) -> int:
+        if value in NAMES[index]:
+            return NAMES[index][value]
+        if not value.isdigit():
+            raise Exception(F"Invalid schedule '{self.expression}': {value}")
+        return int(value)
+
+    def __day_matches(self, moment: datetime.datetime) -> bool:
+        in_days = moment.day in self.days
+        in_weekdays = (moment.isoweekday() % 7) in self.weekdays
+        return in_days and in_weekdays if self.__any_day else in_days or in_weekdays
+
+    # First time after the given one the schedule fires at
+    def next_after(self, after: datetime.datetime) -> datetime.datetime:
+        moment = after.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        limit = moment + datetime.timedelta(days=366 * 5)
+        while moment < limit:
+            if moment.month not in self.months:
+                moment = (moment.replace(day=1, hour=0, minute=0) + datetime.timedelta(days=32)).replace(day=1)
+            elif not self.__day_matches(moment):
+                moment = moment.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+            elif moment.hour not in self.hours:
+                moment = moment.replace(minute=0) + datetime.timedelta(hours=1)
+            elif moment.minute not in self.minutes:
+                moment += datetime.timedelta(minutes=1)
+            else:
+                return moment
+        raise Exception(F"Schedule '{self.expression}' never fires")
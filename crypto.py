@@ -0,0 +1,241 @@
+import base64
+import binascii
+import hmac
+import io
+import os
+import struct
+from collections import OrderedDict
+
+try:
+    from cryptography.exceptions import InvalidTag
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+    from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+except ImportError:
+    AESGCM = ChaCha20Poly1305 = None
+
+from retention import parse_size
+
+# Encrypted backups start with these bytes
+MAGIC = b'NCBKENC1'
+
+# Added to the file extension of the compression format
+EXTENSION = '.enc'
+
+# Supported ciphers and their id in the header
+CIPHERS = {'aes-256-gcm': 1, 'chacha20-poly1305': 2}
+
+# Header of an encrypted file: magic, cipher id, chunk size, salt of the file key and id of the key
+HEADER = struct.Struct('>8sBI16s8s')
+
+# Default size of the plaintext chunks. Every chunk is followed by its authentication tag.
+CHUNK_SIZE = 1024 * 1024
+TAG_SIZE = 16
+
+# Decrypted chunks kept for random access
+CACHED_CHUNKS = 4
+
+
+# Read a 256 bit key from a file holding it raw, hex or base64 encoded
+def load_key(path: str) -> bytes:
+    with open(path, 'rb') as file:
+        data = file.read()
+    if len(data) == 32:
+        return data
+    text = data.strip()
+    for decode in (binascii.unhexlify, base64.b64decode):
+        try:
+            key = decode(text)
+        except (binascii.Error, ValueError):
+            continue
+        if len(key) == 32:
+            return key
+    raise Exception(F"{path} does not hold a 256 bit key, create one with: openssl rand -base64 32 > {path}")
+
+
+def is_encrypted(head: bytes) -> bool:
+    return head[:len(MAGIC)] == MAGIC
+
+
+# Nonce of a chunk: its index and whether it is the last one, so chunks can't be reordered, dropped or cut off
+def _nonce(index: int, last: bool) -> bytes:
+    return struct.pack('>Q3xB', index, int(last))
+
+
+# Authenticated encryption of backups. A file is split into chunks that are encrypted with AES-256-GCM or
+# ChaCha20-Poly1305 under a key derived for the file from the configured key and a random salt. Each chunk is
+# authenticated on its own, so a damaged or foreign chunk is noticed as soon as it is read and single chunks can be
+# decrypted for random access.
+class Encryption:
+
+    def __init__(self, key: bytes, cipher: str = 'aes-256-gcm', chunk_size=CHUNK_SIZE) -> None:
+        if AESGCM is None:
+            raise Exception("Encrypted backups require the cryptography package: pip3 install cryptography")
+        if cipher not in CIPHERS:
+            raise Exception(F"Unknown cipher '{cipher}', choose one of: {', '.join(CIPHERS.keys())}")
+        if len(key) != 32:
+            raise Exception("The encryption key must be 256 bits long")
+        self.cipher = cipher
+        self.chunk_size = parse_size(chunk_size)
+        self.__key = key
+        self.key_id = hmac.digest(key, b'key id', 'sha256')[:8]
+
+    @staticmethod
+    def from_config(values):
+        if not values:
+            return None
+        return Encryption(load_key(values['key_file']), values.get('cipher', 'aes-256-gcm'),
+                          values.get('chunk_size', CHUNK_SIZE))
+
+    # AEAD of a file, keyed for the salt in its header
+    def aead(self, header: bytes):
+        magic, cipher_id, chunk_size, salt, key_id = HEADER.unpack(header)
+        if magic != MAGIC:
+            raise Exception("Not an encrypted backup")
+        if key_id != self.key_id:
+            raise Exception("The backup was encrypted with a different key")
+        info = b'nextcloud backup' + bytes([cipher_id])
+        key = HKDF(algorithm=hashes.SHA256(), length=32, salt=salt, info=info).derive(self.__key)
+        if cipher_id == CIPHERS['aes-256-gcm']:
+            return AESGCM(key), chunk_size
+        elif cipher_id == CIPHERS['chacha20-poly1305']:
+            return ChaCha20Poly1305(key), chunk_size
+        raise Exception(F"Unknown cipher id {cipher_id}")
+
+    def header(self) -> bytes:
+        return HEADER.pack(MAGIC, CIPHERS[self.cipher], self.chunk_size, os.urandom(16), self.key_id)
+
+    def writer(self, fileobj) -> 'EncryptingWriter':
+        return EncryptingWriter(fileobj, self)
+
+    # Buffered reader of the plaintext of an encrypted file
+    def reader(self, fileobj) -> io.BufferedReader:
+        return io.BufferedReader(DecryptingReader(fileobj, self), CHUNK_SIZE)
+
+    # Random access to the plaintext of an encrypted file held in a buffer, e.g. a memory map
+    def view(self, buffer) -> 'DecryptedView':
+        return DecryptedView(buffer, self)
+
+
+# Encrypts everything written to it in chunks. A full chunk is only written once more data follows, so the last chunk
+# can be marked as such when the writer is closed.
+class EncryptingWriter:
+
+    def __init__(self, fileobj, encryption: Encryption) -> None:
+        self.fileobj = fileobj
+        self.__header = encryption.header()
+        self.__aead, self.__chunk_size = encryption.aead(self.__header)
+        self.__buffer = bytearray()
+        self.__index = 0
+        self.closed = False
+        self.fileobj.write(self.__header)
+
+    def __write_chunk(self, data, last: bool):
+        self.fileobj.write(self.__aead.encrypt(_nonce(self.__index, last), bytes(data), self.__header))
+        self.__index += 1
+
+    def write(self, data) -> int:
+        self.__buffer += data
+        while len(self.__buffer) > self.__chunk_size:
+            self.__write_chunk(memoryview(self.__buffer)[:self.__chunk_size], False)
+            del self.__buffer[:self.__chunk_size]
+        return len(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.__write_chunk(self.__buffer, True)
+            self.__buffer.clear()
+
+
+# Decrypts an encrypted file while it is read. Every chunk is authenticated before any of it is returned; a damaged,
+# reordered or missing chunk raises right away.
+class DecryptingReader(io.RawIOBase):
+
+    def __init__(self, fileobj, encryption: Encryption) -> None:
+        super().__init__()
+        self.__file = fileobj
+        self.__header = fileobj.read(HEADER.size)
+        if len(self.__header) < HEADER.size:
+            raise Exception("Encrypted backup is truncated")
+        self.__aead, chunk_size = encryption.aead(self.__header)
+        self.__chunk_size = chunk_size + TAG_SIZE
+        self.__next = fileobj.read(self.__chunk_size)
+        self.__plain = memoryview(b'')
+        self.__index = 0
+        self.__done = False
+
+    def readable(self) -> bool:
+        return True
+
+    def __read_chunk(self):
+        chunk, self.__next = self.__next, self.__file.read(self.__chunk_size)
+        last = len(self.__next) == 0
+        try:
+            self.__plain = memoryview(self.__aead.decrypt(_nonce(self.__index, last), chunk, self.__header))
+        except InvalidTag:
+            raise Exception(F"Chunk {self.__index} of the encrypted backup failed authentication, "
+                            F"the backup is damaged or truncated")
+        self.__index += 1
+        self.__done = last
+
+    def readinto(self, buffer) -> int:
+        while not self.__plain and not self.__done:
+            self.__read_chunk()
+        size = min(len(buffer), len(self.__plain))
+        buffer[:size] = self.__plain[:size]
+        self.__plain = self.__plain[size:]
+        return size
+
+    def close(self):
+        if not self.closed:
+            self.__file.close()
+        super().close()
+
+
+# Plaintext of an encrypted file held in a buffer, accessed by slices. Only the chunks a slice covers are decrypted.
+class DecryptedView:
+
+    def __init__(self, buffer, encryption: Encryption) -> None:
+        self.__buffer = buffer
+        self.__header = bytes(buffer[:HEADER.size])
+        self.__aead, self.__chunk_size = encryption.aead(self.__header)
+        body = len(buffer) - HEADER.size
+        self.__chunks = max(1, -(-body // (self.__chunk_size + TAG_SIZE)))
+        self.__size = body - self.__chunks * TAG_SIZE
+        self.__cache = OrderedDict()
+
+    def __len__(self) -> int:
+        return self.__size
+
+    def __chunk(self, index: int) -> bytes:
+        if index in self.__cache:
+            self.__cache.move_to_end(index)
+            return self.__cache[index]
+        start = HEADER.size + index * (self.__chunk_size + TAG_SIZE)
+        data = self.__buffer[start:start + self.__chunk_size + TAG_SIZE]
+        try:
+            plain = self.__aead.decrypt(_nonce(index, index == self.__chunks - 1), data, self.__header)
+        except InvalidTag:
+            raise Exception(F"Chunk {index} of the encrypted backup failed authentication, "
+                            F"the backup is damaged or truncated")
+        self.__cache[index] = plain
+        if len(self.__cache) > CACHED_CHUNKS:
+            self.__cache.popitem(last=False)
+        return plain
+
+    def __getitem__(self, item: slice) -> bytes:
+        start, stop, _ = item.indices(self.__size)
+        data = bytearray()
+        position = start
+        while position < stop:
+            index, offset = divmod(position, self.__chunk_size)
+            piece = self.__chunk(index)[offset:offset + stop - position]
+            if not piece:
+                break
+            data += piece
+            position += len(piece)
+        return bytes(data)
@@ -0,0 +1,248 @@
+import errno
+import fnmatch
+import os
+import shutil
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import closing
+
+# Snapshots of the data directory are kept in this subfolder of the backup dir
+DIRECTORY = 'data'
+
+# Directories copied at once
+DEFAULT_THREADS = 8
+
+# Rows written to the new index in one batch
+BATCH_SIZE = 10000
+
+# Ownership can only be kept when running as root
+PRESERVE_OWNER = hasattr(os, 'geteuid') and os.geteuid() == 0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    dir TEXT NOT NULL,
+    name TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    PRIMARY KEY (dir, name)
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+# Folder of the data snapshots of a backup dir
+def data_dir(backup_dir: str) -> str:
+    return os.path.join(backup_dir, DIRECTORY)
+
+
+# Snapshot of the data directory made together with the backup of the given name
+def snapshot_path(backup_dir: str, backup_name: str) -> str:
+    return os.path.join(data_dir(backup_dir), backup_name)
+
+
+# Host path of a path within a container, resolved through the mounts of the container. None if it isn't on a mount.
+def host_path(container_info: dict, path: str):
+    mounts = [mount for mount in container_info.get('Mounts') or []
+              if path == mount['Destination'] or path.startswith(mount['Destination'].rstrip('/') + '/')]
+    if not mounts:
+        return None
+    mount = max(mounts, key=lambda mount: len(mount['Destination']))
+    return os.path.join(mount['Source'], os.path.relpath(path, mount['Destination']))
+
+
+# Index of the files in the last snapshot of an instance: path, size, mtime and inode of each file as it was in the
+# data directory when it was copied. A file whose state is unchanged is hard-linked from the last snapshot instead of
+# being copied again. The index of a new snapshot is written next to the old one and replaces it once the snapshot is
+# complete.
+class FileIndex:
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    def exists(self) -> bool:
+        return os.path.isfile(self.path)
+
+    def __connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, timeout=60)
+        connection.executescript(SCHEMA)
+        return connection
+
+    # Snapshot the index describes, None without an index
+    def snapshot(self):
+        if not self.exists():
+            return None
+        with closing(self.__connect()) as connection:
+            row = connection.execute("SELECT value FROM meta WHERE key = 'snapshot'").fetchone()
+        return row[0] if row else None
+
+    # State of the files of a directory as name -> (size, mtime_ns, inode)
+    def files(self, directory: str) -> dict:
+        if not self.exists():
+            return {}
+        with closing(sqlite3.connect(self.path, timeout=60)) as connection:
+            rows = connection.execute("SELECT name, size, mtime_ns, inode FROM files WHERE dir = ?", (directory,))
+            return {name: (size, mtime_ns, inode) for name, size, mtime_ns, inode in rows}
+
+    # Start a new index for the given snapshot, it replaces this one on commit()
+    def create(self, snapshot: str) -> 'FileIndex':
+        new_index = FileIndex(self.path + '.tmp')
+        if os.path.isfile(new_index.path):
+            os.remove(new_index.path)
+        with closing(new_index.__connect()) as connection, connection:
+            connection.execute("INSERT INTO meta (key, value) VALUES ('snapshot', ?)", (snapshot,))
+        return new_index
+
+    def add(self, rows: list):
+        with closing(self.__connect()) as connection, connection:
+            connection.executemany("INSERT OR REPLACE INTO files (dir, name, size, mtime_ns, inode) "
+                                   "VALUES (?, ?, ?, ?, ?)", rows)
+
+    def commit(self):
+        os.replace(self.path, self.path[:-len('.tmp')])
+
+    def discard(self):
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+
+# Incremental backup of the Nextcloud data directory. Every backup gets a complete snapshot of the directory tree in
+# <backup_dir>/data/<backup name>/: files changed since the last snapshot are copied, all others are hard links to
+# the file in the last snapshot, so an unchanged file takes no space and no I/O. Whether a file changed is decided by
+# its size, mtime and inode in the file index, so unchanged files are never read. The directories are walked and
+# copied by a pool of threads.
+class DataBackup:
+
+    def __init__(self, path: str = None, threads: int = DEFAULT_THREADS, exclude: list = None) -> None:
+        self.path = path
+        self.threads = threads or DEFAULT_THREADS
+        self.exclude = exclude or []
+        self.copied_files = 0
+        self.copied_bytes = 0
+        self.linked_files = 0
+        self.__counter_lock = threading.Lock()
+
+    @staticmethod
+    def from_config(values):
+        if not values:
+            return None
+        if values is True:
+            return DataBackup()
+        return DataBackup(values.get('path'), values.get('threads', DEFAULT_THREADS), values.get('exclude'))
+
+    def __excluded(self, relative_path: str) -> bool:
+        return any(fnmatch.fnmatch(relative_path, pattern) for pattern in self.exclude)
+
+    # Snapshot the data directory at source into target, linking unchanged files from the snapshot the index of the
+    # instance describes. The snapshot is written as <target>.partial and renamed once it is complete.
+    def snapshot(self, source: str, target: str, index: FileIndex):
+        if not os.path.isdir(source):
+            raise Exception(F"Data directory {source} not found")
+        base_name = index.snapshot()
+        base = os.path.join(os.path.dirname(target), base_name) if base_name else None
+        # Without the last snapshot there is nothing to link to, everything is copied
+        if base is not None and not os.path.isdir(base):
+            base = None
+        self.copied_files = self.copied_bytes = self.linked_files = 0
+        partial = target + '.partial'
+        if os.path.isdir(partial):
+            shutil.rmtree(partial)
+        os.makedirs(partial)
+        self.__copy_owner(os.stat(source), partial)
+        new_index = index.create(os.path.basename(target))
+        try:
+            with ThreadPoolExecutor(max_workers=self.threads) as executor:
+                pending = {executor.submit(self.__copy_directory, source, partial, base, index, '')}
+                rows = []
+                try:
+                    while pending:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            directories, directory_rows = future.result()
+                            pending |= {executor.submit(self.__copy_directory, source, partial, base, index,
+                                                        directory) for directory in directories}
+                            rows += directory_rows
+                            if len(rows) >= BATCH_SIZE:
+                                new_index.add(rows)
+                                rows = []
+                except BaseException:
+                    for future in pending:
+                        future.cancel()
+                    raise
+                new_index.add(rows)
+            os.rename(partial, target)
+            new_index.commit()
+        except BaseException:
+            new_index.discard()
+            shutil.rmtree(partial, ignore_errors=True)
+            raise
+
+    # Copy or link the files of one directory and return its subdirectories and the index rows of its files. Files and
+    # directories removed from the data directory while it is copied are left out.
+    def __copy_directory(self, source: str, target: str, base, index: FileIndex, directory: str) -> tuple:
+        known = index.files(directory) if base else {}
+        directories, rows = [], []
+        try:
+            with os.scandir(os.path.join(source, directory)) as entries:
+                for entry in entries:
+                    relative_path = os.path.join(directory, entry.name)
+                    if self.__excluded(relative_path):
+                        continue
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            os.mkdir(os.path.join(target, relative_path))
+                            self.__copy_owner(entry.stat(follow_symlinks=False), os.path.join(target, relative_path))
+                            directories.append(relative_path)
+                        elif entry.is_symlink():
+                            os.symlink(os.readlink(entry.path), os.path.join(target, relative_path))
+                        elif entry.is_file(follow_symlinks=False):
+                            rows.append((directory, entry.name) + self.__copy_file(
+                                entry, os.path.join(target, relative_path), known.get(entry.name),
+                                os.path.join(base, relative_path) if base else None))
+                    except FileNotFoundError:
+                        continue
+            # Creating the entries changed the mtime of the directory
+            shutil.copystat(os.path.join(source, directory), os.path.join(target, directory), follow_symlinks=False)
+        except FileNotFoundError:
+            pass
+        return directories, rows
+
+    # Link a file from the last snapshot if its state is the one in the index, copy it otherwise. Returns the state
+    # the file had before it was copied, so a file changed while it is copied is copied again next time.
+    def __copy_file(self, entry: os.DirEntry, destination: str, known, base_path) -> tuple:
+        state = entry.stat(follow_symlinks=False)
+        current = (state.st_size, state.st_mtime_ns, state.st_ino)
+        if known == current and self.__link(base_path, destination):
+            self.__count(0, 0, 1)
+        else:
+            shutil.copy2(entry.path, destination, follow_symlinks=False)
+            self.__copy_owner(state, destination)
+            self.__count(1, state.st_size, 0)
+        return current
+
+    # Hard-link a file of the last snapshot into the new one. False if it has to be copied instead, e.g. because it
+    # is missing or has reached the link limit of the file system.
+    @staticmethod
+    def __link(base_path: str, destination: str) -> bool:
+        try:
+            os.link(base_path, destination)
+            return True
+        except OSError as e:
+            if e.errno in (errno.ENOENT, errno.EMLINK):
+                return False
+            raise
+
+    @staticmethod
+    def __copy_owner(state: os.stat_result, path: str):
+        if PRESERVE_OWNER:
+            os.chown(path, state.st_uid, state.st_gid, follow_symlinks=False)
+
+    def __count(self, copied_files: int, copied_bytes: int, linked_files: int):
+        with self.__counter_lock:
+            self.copied_files += copied_files
+            self.copied_bytes += copied_bytes
+            self.linked_files += linked_files
@@ -0,0 +1,381 @@
+import base64
+import http.client
+import io
+import json
+import os
+import queue
+import socket
+import struct
+import sys
+import threading
+import time
+from functools import partial
+from urllib.parse import quote, urlencode
+
+API_VERSION = 'v1.41'
+
+# Frame types of the multiplexed stream of an exec without TTY
+STDOUT = 1
+STDERR = 2
+
+# How much of the stderr output of an exec is kept for error messages
+STDERR_LIMIT = 64 * 1024
+
+
+class DockerError(Exception):
+
+    def __init__(self, status, message) -> None:
+        super().__init__(F"Docker Engine API error {status}: {message}")
+        self.status = status
+
+
+# HTTP connection to the Docker Engine over its unix socket
+class UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, socket_path, timeout=None) -> None:
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+# Response body that hands its connection back to the pool once it has been read completely
+class PooledResponse(io.RawIOBase):
+
+    def __init__(self, client, connection, response) -> None:
+        super().__init__()
+        self.__client = client
+        self.__connection = connection
+        self.__response = response
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        return self.__response.readinto(buffer)
+
+    def close(self):
+        if not self.closed:
+            if self.__response.isclosed():
+                self.__client.release(self.__connection)
+            else:
+                self.__connection.close()
+        super().close()
+
+
+# Demultiplexed stdout of an exec. stderr frames are kept (the last STDERR_LIMIT bytes) and echoed to our stderr.
+class ExecOutput(io.RawIOBase):
+
+    def __init__(self, reader, echo_stderr=True) -> None:
+        super().__init__()
+        self.__reader = reader
+        self.__remaining = 0
+        self.__echo_stderr = echo_stderr
+        self.stderr = bytearray()
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while self.__remaining == 0:
+            header = self.__reader.read(8)
+            if len(header) < 8:
+                return 0
+            stream_type, size = struct.unpack('>BxxxI', header)
+            if stream_type == STDERR:
+                data = self.__reader.read(size)
+                self.stderr += data
+                del self.stderr[:-STDERR_LIMIT]
+                if self.__echo_stderr:
+                    sys.stderr.buffer.write(data)
+                    sys.stderr.flush()
+            else:
+                self.__remaining = size
+        data = self.__reader.read(min(len(buffer), self.__remaining))
+        if not data:
+            return 0
+        self.__remaining -= len(data)
+        buffer[:len(data)] = data
+        return len(data)
+
+
+# Write end of an exec's stdin
+class ExecInput:
+
+    def __init__(self, sock) -> None:
+        self.__sock = sock
+        self.closed = False
+
+    def write(self, data) -> int:
+        self.__sock.sendall(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    # Signal EOF to the process while its output can still be read
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            try:
+                self.__sock.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
+
+
+# A running exec with streamed stdin/stdout. It behaves like a subprocess.Popen object.
+class ExecStream:
+
+    def __init__(self, client, exec_id, sock, reader, stdin=False, echo_stderr=True) -> None:
+        self.__client = client
+        self.exec_id = exec_id
+        self.__sock = sock
+        self.__output = ExecOutput(reader, echo_stderr)
+        self.stdout = io.BufferedReader(self.__output, 1024 * 1024)
+        self.stdin = ExecInput(sock) if stdin else None
+        self.returncode = None
+
+    # stderr output of the process so far
+    @property
+    def stderr_output(self) -> str:
+        return bytes(self.__output.stderr).decode("utf-8", "replace")
+
+    def poll(self):
+        if self.returncode is None:
+            result = self.__client.exec_inspect(self.exec_id)
+            if not result['Running'] and result['ExitCode'] is not None:
+                self.returncode = result['ExitCode']
+        return self.returncode
+
+    # Read the remaining output, close the connection and return the exit code
+    def wait(self) -> int:
+        if self.returncode is None:
+            try:
+                while self.stdout.read(1024 * 1024):
+                    pass
+            except OSError:
+                pass
+            self.__sock.close()
+            while self.poll() is None:
+                time.sleep(0.05)
+        return self.returncode
+
+    # The API can't signal an exec, so drop the connection. The process dies on its next write.
+    def kill(self):
+        try:
+            self.__sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.__sock.close()
+        if self.returncode is None:
+            self.returncode = -1
+
+
+# Thin client for the Docker Engine API. Requests share a small pool of keep-alive connections to the unix socket;
+# exec streams use their own hijacked connection.
+class DockerClient:
+
+    def __init__(self, socket_path=None, pool_size=8, timeout=None) -> None:
+        if socket_path is None:
+            docker_host = os.environ.get('DOCKER_HOST', 'unix:///var/run/docker.sock')
+            if not docker_host.startswith('unix://'):
+                raise Exception(F"Only unix sockets are supported as DOCKER_HOST: {docker_host}")
+            socket_path = docker_host[len('unix://'):]
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.__pool = queue.LifoQueue(maxsize=pool_size)
+
+    def __connection(self) -> UnixHTTPConnection:
+        try:
+            return self.__pool.get_nowait()
+        except queue.Empty:
+            return UnixHTTPConnection(self.socket_path, self.timeout)
+
+    # Put a connection back into the pool after its response has been read
+    def release(self, connection):
+        try:
+            self.__pool.put_nowait(connection)
+        except queue.Full:
+            connection.close()
+
+    @staticmethod
+    def __url(path, params=None) -> str:
+        return F"/{API_VERSION}{path}" + (F"?{urlencode(params)}" if params else "")
+
+    @staticmethod
+    def __raise_for_status(status, body: bytes):
+        if status >= 400:
+            try:
+                message = json.loads(body).get('message', body)
+            except ValueError:
+                message = body.decode("utf-8", "replace")
+            raise DockerError(status, message)
+
+    # Send a request and return the response. With stream=True the body is returned as a file object.
+    def request(self, method, path, params=None, body=None, headers=None, stream=False):
+        headers = dict(headers or {})
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode("utf-8")
+            headers['Content-Type'] = 'application/json'
+        for attempt in range(2):
+            connection = self.__connection()
+            try:
+                connection.request(method, self.__url(path, params), body=body, headers=headers)
+                response = connection.getresponse()
+                break
+            except (ConnectionError, http.client.RemoteDisconnected, http.client.CannotSendRequest):
+                # A pooled keep-alive connection may have been closed by the daemon in the meantime
+                connection.close()
+                if attempt or (body is not None and not isinstance(body, bytes)):
+                    raise
+        if response.status >= 400 or not stream:
+            data = response.read()
+            self.release(connection)
+            self.__raise_for_status(response.status, data)
+            return data
+        return PooledResponse(self, connection, response)
+
+    def request_json(self, method, path, params=None, body=None):
+        data = self.request(method, path, params, body)
+        return json.loads(data) if data else None
+
+    def exec_create(self, container, cmd, user=None, stdin=False, workdir=None) -> str:
+        body = {'AttachStdin': stdin, 'AttachStdout': True, 'AttachStderr': True, 'Tty': False, 'Cmd': list(cmd)}
+        if user:
+            body['User'] = user
+        if workdir:
+            body['WorkingDir'] = workdir
+        return self.request_json('POST', F"/containers/{quote(container)}/exec", body=body)['Id']
+
+    def exec_inspect(self, exec_id) -> dict:
+        return self.request_json('GET', F"/exec/{exec_id}/json")
+
+    # Start an exec on a hijacked connection and return the raw socket and a buffered reader on it
+    def __exec_start(self, exec_id):
+        body = json.dumps({'Detach': False, 'Tty': False}).encode("utf-8")
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        sock.sendall((F"POST {self.__url(F'/exec/{exec_id}/start')} HTTP/1.1\r\n"
+                      "Host: localhost\r\n"
+                      "Content-Type: application/json\r\n"
+                      "Connection: Upgrade\r\n"
+                      "Upgrade: tcp\r\n"
+                      F"Content-Length: {len(body)}\r\n\r\n").encode("ascii") + body)
+        reader = sock.makefile('rb')
+        status_line = reader.readline().decode("ascii", "replace")
+        try:
+            status = int(status_line.split()[1])
+        except (IndexError, ValueError):
+            sock.close()
+            raise DockerError(0, F"Invalid response to exec start: {status_line!r}")
+        content_length = 0
+        while True:
+            line = reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            if line.lower().startswith(b'content-length:'):
+                content_length = int(line.split(b':', 1)[1])
+        if status >= 400:
+            data = reader.read(content_length)
+            sock.close()
+            self.__raise_for_status(status, data)
+        return sock, reader
+
+    # Run a command in a container and stream its stdin/stdout
+    def exec_stream(self, container, cmd, user=None, stdin=False, echo_stderr=True) -> ExecStream:
+        exec_id = self.exec_create(container, cmd, user, stdin)
+        sock, reader = self.__exec_start(exec_id)
+        return ExecStream(self, exec_id, sock, reader, stdin, echo_stderr)
+
+    # Run a command in a container and return its exit code, stdout and stderr
+    def exec_run(self, container, cmd, user=None, stdin_data: bytes = None) -> tuple:
+        process = self.exec_stream(container, cmd, user, stdin=stdin_data is not None, echo_stderr=False)
+        if stdin_data is not None:
+            process.stdin.write(stdin_data)
+            process.stdin.close()
+        output = process.stdout.read()
+        exit_code = process.wait()
+        return exit_code, output.decode("utf-8", "replace"), process.stderr_output
+
+    # Stream a file or directory out of a container as an uncompressed tar archive
+    def get_archive(self, container, path):
+        return self.request('GET', F"/containers/{quote(container)}/archive", {'path': path}, stream=True)
+
+    # Extract a tar archive (bytes, file object or iterable of bytes) into a directory of a container
+    def put_archive(self, container, path, data):
+        # http.client sends file objects and iterables with chunked transfer encoding
+        if hasattr(data, 'read'):
+            data = iter(partial(data.read, 1024 * 1024), b'')
+        self.request('PUT', F"/containers/{quote(container)}/archive", {'path': path}, data,
+                     {'Content-Type': 'application/x-tar'})
+
+    def inspect_container(self, container) -> dict:
+        return self.request_json('GET', F"/containers/{quote(container)}/json")
+
+    def inspect_image(self, image) -> dict:
+        return self.request_json('GET', F"/images/{quote(image, safe='')}/json")
+
+    # Pull an image and return True if a newer image was downloaded
+    def pull(self, image) -> bool:
+        params = {'fromImage': image}
+        if '@' not in image:
+            repository, _, tag = image.rpartition(':')
+            if repository and '/' not in tag:
+                params = {'fromImage': repository, 'tag': tag}
+            else:
+                params = {'fromImage': image, 'tag': 'latest'}
+        headers = {}
+        auth = registry_auth(params['fromImage'])
+        if auth:
+            headers['X-Registry-Auth'] = auth
+        updated = False
+        with self.request('POST', '/images/create', params, b'', headers, stream=True) as response:
+            # The progress is a stream of JSON objects, one per line. Errors are reported in it as well.
+            for line in io.BufferedReader(response):
+                if not line.strip():
+                    continue
+                message = json.loads(line)
+                if 'error' in message:
+                    raise DockerError(500, message['error'])
+                if message.get('status', '').startswith('Status: Downloaded newer image'):
+                    updated = True
+        return updated
+
+
+# Registry credentials for an image from the docker CLI config, base64 encoded for the X-Registry-Auth header.
+# Credential helpers are not supported, only credentials stored by "docker login" in the config file.
+def registry_auth(image: str):
+    first = image.split('/', 1)[0]
+    registry = first if '/' in image and ('.' in first or ':' in first or first == 'localhost') else 'docker.io'
+    config_path = os.path.join(os.environ.get('DOCKER_CONFIG', os.path.expanduser('~/.docker')), 'config.json')
+    try:
+        with open(config_path) as config_file:
+            auths = json.load(config_file).get('auths', {})
+    except (OSError, ValueError):
+        return None
+    for key, value in auths.items():
+        host = key.split('://')[-1].split('/')[0]
+        if host == registry or (registry == 'docker.io' and host in ('index.docker.io', 'registry-1.docker.io')):
+            if not value.get('auth'):
+                return None
+            username, _, password = base64.b64decode(value['auth']).decode('utf-8').partition(':')
+            credentials = json.dumps({'username': username, 'password': password, 'serveraddress': key})
+            return base64.urlsafe_b64encode(credentials.encode('utf-8')).decode('ascii')
+    return None
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+# The client shared by all containers of this process
+def client() -> DockerClient:
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = DockerClient()
+        return _client
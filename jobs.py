@@ -0,0 +1,61 @@
+import threading
+
+
+# Runs jobs on a bounded number of worker threads. Every job claims a list of resources (e.g. its backup directory
+# and its database host) and is only started if none of them is used by more than the configured number of jobs.
+class JobRunner:
+
+    def __init__(self, jobs: int = 1, limits: dict = None) -> None:
+        self.jobs = max(1, jobs)
+        self.limits = limits or {}
+        self.__condition = threading.Condition()
+        self.__running = 0
+        self.__usage = {}
+
+    # Run fn(item) for all items and return a dict of item -> result. resources(item) returns a list of
+    # (resource type, resource name) tuples the job needs; a limit of 0 means unlimited.
+    def run(self, items, fn, resources=lambda item: []) -> dict:
+        pending = list(items)
+        results = {}
+        threads = []
+
+        def worker(item, claimed):
+            try:
+                results[item] = fn(item)
+            except Exception as e:
+                results[item] = e
+            finally:
+                with self.__condition:
+                    self.__running -= 1
+                    for resource in claimed:
+                        self.__usage[resource] -= 1
+                    self.__condition.notify_all()
+
+        with self.__condition:
+            while pending:
+                item = self.__next_runnable(pending, resources)
+                if item is None:
+                    self.__condition.wait()
+                    continue
+                pending.remove(item)
+                claimed = resources(item)
+                self.__running += 1
+                for resource in claimed:
+                    self.__usage[resource] = self.__usage.get(resource, 0) + 1
+                thread = threading.Thread(target=worker, args=(item, claimed), daemon=True)
+                threads.append(thread)
+                thread.start()
+
+        for thread in threads:
+            thread.join()
+        return results
+
+    # First pending item whose resources are all below their limit, if a worker is free
+    def __next_runnable(self, pending, resources):
+        if self.__running >= self.jobs:
+            return None
+        for item in pending:
+            if all(not self.limits.get(resource[0]) or self.__usage.get(resource, 0) < self.limits[resource[0]]
+                   for resource in resources(item)):
+                return item
+        return None
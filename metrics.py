@@ -0,0 +1,124 @@
+import datetime
+import json
+import os
+import time
+
+
+# Timing and volume figures of one backup, restore or upgrade run of an instance
+class RunMetrics:
+
+    def __init__(self, instance: str, operation: str) -> None:
+        self.instance = instance
+        self.operation = operation
+        self.started = datetime.datetime.now()
+        self.success = False
+        self.finished = False
+        self.steps = []
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.maintenance_duration = 0.0
+        self.throttled_duration = 0.0
+        self.__start = time.monotonic()
+        self.duration = 0.0
+
+    # Run a step function, record how long it took and return its result
+    def run_step(self, fn):
+        start = time.monotonic()
+        result = False
+        try:
+            result = fn()
+            return result
+        finally:
+            self.steps.append({
+                'step': step_name(fn),
+                'duration': round(time.monotonic() - start, 3),
+                'success': bool(result),
+            })
+
+    def finish(self, success: bool):
+        self.success = success
+        self.finished = True
+        self.duration = time.monotonic() - self.__start
+
+    # Uncompressed size divided by the compressed size. A backup reads uncompressed and writes compressed data,
+    # a restore the other way round.
+    def compression_ratio(self) -> float:
+        uncompressed, compressed = self.bytes_read, self.bytes_written
+        if self.operation == 'restore':
+            uncompressed, compressed = compressed, uncompressed
+        return round(uncompressed / compressed, 2) if compressed and uncompressed else 0.0
+
+    def report(self) -> dict:
+        return {
+            'instance': self.instance,
+            'operation': self.operation,
+            'started': self.started.isoformat(timespec='seconds'),
+            'success': self.success,
+            'duration': round(self.duration, 3),
+            'maintenance_duration': round(self.maintenance_duration, 3),
+            'throttled_duration': round(self.throttled_duration, 3),
+            'bytes_read': self.bytes_read,
+            'bytes_written': self.bytes_written,
+            'compression_ratio': self.compression_ratio(),
+            'steps': self.steps,
+        }
+
+    # Metrics in the Prometheus text exposition format
+    def prometheus(self) -> str:
+        labels = F'instance="{self.instance}",operation="{self.operation}"'
+        values = [
+            ('nextcloud_backup_last_run_timestamp_seconds', 'gauge', 'Start of the last run',
+             [(labels, self.started.timestamp())]),
+            ('nextcloud_backup_last_run_success', 'gauge', 'Whether the last run succeeded',
+             [(labels, int(self.success))]),
+            ('nextcloud_backup_duration_seconds', 'gauge', 'Duration of the last run',
+             [(labels, self.duration)]),
+            ('nextcloud_backup_maintenance_duration_seconds', 'gauge', 'Time maintenance mode was enabled',
+             [(labels, self.maintenance_duration)]),
+            ('nextcloud_backup_throttled_duration_seconds', 'gauge', 'Time reads and writes were held back by the '
+             'throttle', [(labels, self.throttled_duration)]),
+            ('nextcloud_backup_read_bytes', 'gauge', 'Uncompressed bytes processed by the last run',
+             [(labels, self.bytes_read)]),
+            ('nextcloud_backup_written_bytes', 'gauge', 'Bytes written by the last run',
+             [(labels, self.bytes_written)]),
+            ('nextcloud_backup_compression_ratio', 'gauge', 'Compression ratio of the last run',
+             [(labels, self.compression_ratio())]),
+            ('nextcloud_backup_step_duration_seconds', 'gauge', 'Duration of each step of the last run',
+             [(F'{labels},step="{step["step"]}"', step['duration']) for step in self.steps]),
+        ]
+        lines = []
+        for name, metric_type, description, samples in values:
+            lines.append(F"# HELP {name} {description}")
+            lines.append(F"# TYPE {name} {metric_type}")
+            lines.extend(F"{name}{{{sample_labels}}} {value}" for sample_labels, value in samples)
+        return "\n".join(lines) + "\n"
+
+
+# Name of a step function without the leading underscores of private methods
+def step_name(fn) -> str:
+    return getattr(fn, '__name__', str(fn)).lstrip('_')
+
+
+# Write a file atomically, so collectors never read a half written file
+def _write_atomic(path: str, content: str):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path + '.tmp', 'w') as file:
+        file.write(content)
+    os.replace(path + '.tmp', path)
+
+
+# Write the JSON report and the Prometheus textfile of a run to the directories set in the metrics config
+def write(run: RunMetrics, config: dict) -> list:
+    config = config or {}
+    written = []
+    if config.get('report_dir'):
+        path = os.path.join(config['report_dir'],
+                            F"{run.instance}_{run.started.strftime('%Y-%m-%d_%H%M%S')}_{run.operation}.json")
+        _write_atomic(path, json.dumps(run.report(), indent=2) + "\n")
+        written.append(path)
+    if config.get('textfile_dir'):
+        # One file per instance and operation, the node exporter textfile collector reads all *.prom files
+        path = os.path.join(config['textfile_dir'], F"nextcloud_{run.instance}_{run.operation}.prom")
+        _write_atomic(path, run.prometheus())
+        written.append(path)
+    return written
@@ -1,43 +1,158 @@
 import datetime
+import fcntl
+import hashlib
+import io
+import json
 import os
+import queue
 import stat
-import subprocess
 from subprocess import check_output
 import tarfile
+import tempfile
+import threading
+import time
 import traceback
 import shutil
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, closing
+import yaml
 from colorama import Fore, Style
 from pathlib import Path
 from utils import _print
 import utils
+import archive
+import docker_api
+import metrics
+from repository import Repository
+from catalog import Catalog, DATETIME_FORMAT, TABLES_SUFFIX, parse_name, backup_name
+import retention
+from throttle import Throttle
+import storage
+import crypto
+import binlog
+import pipeline
+import datadir
+import shadow
+
+# Nextcloud installation directory within the app container
+NEXTCLOUD_DIR = "/var/www/html"
+
+# Tables of a parallel dump are loaded with foreign key and unique checks disabled
+TABLE_IMPORT_PREFIX = b"SET FOREIGN_KEY_CHECKS=0;\nSET UNIQUE_CHECKS=0;\n"
+
+# Guards cleanups of backup directories shared by several concurrently running instances
+_backup_dir_locks = {}
+_backup_dir_locks_lock = threading.Lock()
+
+
+# Get the lock for a backup directory
+def backup_dir_lock(backup_dir: str) -> threading.Lock:
+    with _backup_dir_locks_lock:
+        return _backup_dir_locks.setdefault(os.path.realpath(backup_dir), threading.Lock())
 
 
 class Container:
 
     def __init__(self, name, password, app_container, db_container, backup_dir, docker_compose_file_path,
-                 number_of_backups) -> None:
-        self.__datetime = datetime.datetime.now().strftime("%Y-%m-%d_%H%M%S")
+                 number_of_backups, stream_dump=False, compression=None, online_snapshot=False, db_host=None,
+                 layout='archive', parallel_dump=0, retention_policy=None, size_budget=None,
+                 throttle=None, target=None, encryption=None, binlog_mode=None, data_backup=None,
+                 skip_unchanged=False) -> None:
+        self.__datetime = datetime.datetime.now().strftime(DATETIME_FORMAT)
         self.name = name
         self.__password = password
         self.app_container = app_container
         self.db_container = db_container
+        self.db_host = db_host or db_container
         self.backup_dir = backup_dir
-        self.tmp_dir = os.path.join(backup_dir, 'tmp')
+        self.tmp_dir = os.path.join(backup_dir, 'tmp', self.name)
         self.docker_compose_file_path = docker_compose_file_path
         self.number_of_backups = number_of_backups
+        self.retention_policy = retention_policy or retention.Policy(last=number_of_backups)
+        self.size_budget = retention.parse_size(size_budget)
+        self.stream_dump = stream_dump
+        self.compression = compression or archive.Compression()
+        self.throttle = throttle or Throttle()
+        if self.throttle.compression_threads:
+            self.compression.threads = min(self.compression.threads, self.throttle.compression_threads)
+        self.online_snapshot = online_snapshot
+        if layout not in ('archive', 'repository'):
+            raise Exception(F"Unknown backup_dir layout '{layout}' for {name}, choose 'archive' or 'repository'")
+        self.layout = layout
+        self.repository = Repository(backup_dir) if layout == 'repository' else None
+        self.catalog = Catalog(backup_dir)
+        # Dumps of separate connections don't share a snapshot, so a parallel dump needs the maintenance mode
+        if parallel_dump and (online_snapshot or self.repository):
+            raise Exception(F"parallel_dump can't be combined with online_snapshot or the repository layout for {name}")
+        self.parallel_dump = parallel_dump
+        # Only a parallel dump has a member per table that a later backup can refer to
+        if skip_unchanged and not parallel_dump:
+            raise Exception(F"skip_unchanged requires parallel_dump for {name}")
+        self.skip_unchanged = skip_unchanged
+        if target and self.repository:
+            raise Exception(F"A storage target can't be combined with the repository layout for {name}")
+        self.target = target
+        # Chunks of the repository are stored and deduplicated as they are
+        if encryption and self.repository:
+            raise Exception(F"Encryption can't be combined with the repository layout for {name}")
+        self.encryption = encryption
+        # Tables dumped by separate connections have no common binary log position to replay from
+        if binlog_mode and parallel_dump:
+            raise Exception(F"Binlog mode can't be combined with parallel_dump for {name}")
+        self.binlog = binlog_mode
+        self.binlog_catalog = Catalog(binlog.binlog_dir(backup_dir))
+        self.data = data_backup
+        self.data_index = datadir.FileIndex(os.path.join(datadir.data_dir(backup_dir), self.name + '.index.sqlite'))
+        self.data_snapshot_path = datadir.snapshot_path(backup_dir, self.name + '_' + self.__datetime)
         self.__dump_file = self.name + '_' + self.__datetime + '.sql'
         self.__dump_file_path = os.path.join(self.tmp_dir, self.__dump_file)
-        self.__tar_file = self.name + '_' + self.__datetime + '.tar'
-        self.__tar_file_path = os.path.join(self.tmp_dir, self.__tar_file)
-        self.tar_gz_file = self.__tar_file + '.gz'
-        self.tar_gz_file_path = os.path.join(self.backup_dir, self.tar_gz_file)
+        self.__tables_dir = self.name + '_' + self.__datetime + '.tables'
+        self.__tables_file = self.name + '_' + self.__datetime + TABLES_SUFFIX
+        self.__tables = None
+        if self.repository:
+            self.archive_file = self.name + '_' + self.__datetime + '.json'
+            self.archive_file_path = self.repository.snapshot_path(self.name + '_' + self.__datetime)
+        else:
+            self.archive_file = self.name + '_' + self.__datetime + self.compression.extension + \
+                (crypto.EXTENSION if encryption else '')
+            self.archive_file_path = os.path.join(self.backup_dir, self.archive_file)
+        # Incremental archive of a binlog backup
+        self.binlog_file_path = os.path.join(self.binlog_catalog.backup_dir, self.name + '_' + self.__datetime +
+                                             self.compression.extension + (crypto.EXTENSION if encryption else ''))
         self.exceptions = {}
+        self.__docker = docker_api.client()
+        self.maintenance_duration = 0.0
+        self.__maintenance_start = None
+        self.__dump_process = None
+        self.__dump_head = b''
+        self.__archive_stack = None
+        self.__tarball = None
+        self.__snapshot_members = []
+        self.__archive_members = []
+        self.__digest = None
+        self.checksum = None
+        self.__config_tar = None
+        self.__pipeline = None
+        self.__writer = None
+        self.__lock_file = None
+        self.__upload = None
+        self.__catalogued = False
+        self.__binlog_position = None
+        self.metrics = None
+        self.keep_maintenance_mode = False
+        self.maintenance_enabled = False
         self.SUCCESS = F"{Fore.GREEN}success{Style.RESET_ALL}"
         self.FAILED = F"{Fore.RED}failed{Style.RESET_ALL}"
         self.restore_dump_file = ""
-        self.restore_dump_file_path = ""
         self.restore_tar_file_path = ""
         self.restore_tar_file = ""
+        self.restore_tables_dir = ""
+        self.restore_database = None
+        self.restore_table_name = ""
+        self.restore_file_name = ""
+        self.restore_until = None
+        self.restore_shadow = False
+        self.__shadow_databases = []
 
     # Create backup dir if it does not yet exist
     def __create_backup_dir(self) -> bool:
@@ -53,11 +168,36 @@ class Container:
         else:
             return True
 
+    # Lock the instance against backups and restores running in other processes or threads, which would delete its
+    # tmp folder. The lock file stays next to the tmp folder.
+    def __lock_instance(self) -> bool:
+        try:
+            lock_dir = os.path.join(self.backup_dir, 'tmp')
+            os.makedirs(lock_dir, exist_ok=True)
+            self.__lock_file = open(os.path.join(lock_dir, self.name + '.lock'), 'a')
+            fcntl.flock(self.__lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            self.__lock_file.close()
+            self.__lock_file = None
+            _print(F"{Fore.RED}Another backup or restore of {self.name} is running{Style.RESET_ALL}")
+            self.exceptions.update({'lock_instance': F"{self.name} is locked by another backup or restore\n"})
+            return False
+        except:
+            _print(F"{Fore.RED}Could not lock {self.name}{Style.RESET_ALL}")
+            self.exceptions.update({'lock_instance': traceback.format_exc()})
+            return False
+
+    def __unlock_instance(self):
+        if self.__lock_file is not None:
+            self.__lock_file.close()
+            self.__lock_file = None
+
     # Create tmp dir
     def __create_tmp_dir(self) -> bool:
         if not os.path.isdir(self.tmp_dir):
             try:
-                os.mkdir(self.tmp_dir)
+                os.makedirs(self.tmp_dir)
                 return os.path.isdir(self.tmp_dir)
             except:
                 _print(F"{Fore.RED}Could not create tmp folder{Style.RESET_ALL}")
@@ -77,12 +217,51 @@ class Container:
             self.exceptions.update({'delete_tmp_dir': traceback.format_exc()})
             return False
 
+    # Build the mysqldump command. In online snapshot mode the dump is read from a consistent InnoDB snapshot, so the
+    # instance does not have to stay in maintenance mode while it runs.
+    def __dump_command(self) -> list:
+        command = ["mysqldump", "--default-character-set=utf8mb4", "--password=" + self.__password, "--all-databases"]
+        if self.online_snapshot:
+            command += ["--single-transaction", "--quick"]
+        # One row per line and no timestamp, so unchanged rows end up in the same chunks every time
+        if self.repository:
+            command += ["--skip-extended-insert", "--skip-dump-date"]
+        # Start a new binary log with the dump and note its position in the dump, point-in-time restores replay the
+        # logs from there
+        if self.binlog:
+            command += ["--master-data=2", "--flush-logs"]
+        return self.throttle.command(command)
+
+    # Start the database dump and wait until mysqldump has opened its snapshot, i.e. until it starts dumping the
+    # first database. Everything read so far is kept and written ahead of the rest of the dump.
+    def __start_dump(self) -> bool:
+        try:
+            self.__dump_process = self.__docker.exec_stream(self.db_container, self.__dump_command())
+            head = []
+            for line in iter(self.__dump_process.stdout.readline, b''):
+                head.append(line)
+                if line.startswith((b'-- Current Database:', b'CREATE DATABASE', b'USE ')):
+                    break
+            self.__dump_head = b''.join(head)
+            status = self.__dump_process.poll() in (None, 0)
+            _print(F"Open database snapshot: {self.SUCCESS if status else self.FAILED}")
+            return status
+        except:
+            _print(F"Open database snapshot: {self.FAILED}")
+            self.exceptions.update({'__start_dump': traceback.format_exc()})
+            return False
+
     # Dump database
     def __dump_db(self) -> bool:
         try:
-            os.system(
-                F"docker exec {self.db_container} mysqldump --default-character-set=utf8mb4 --password={self.__password} --all-databases > {self.__dump_file_path}")
-            status = os.path.isfile(self.__dump_file_path)
+            if self.__dump_process is None:
+                self.__dump_process = self.__docker.exec_stream(self.db_container, self.__dump_command())
+            # Spool the dump into the tmp folder
+            with open(self.__dump_file_path, 'wb') as dump_file:
+                dump_file.write(self.__dump_head)
+                shutil.copyfileobj(self.throttle.reader(self.__dump_process.stdout), dump_file, 1024 * 1024)
+            status = self.__dump_process.wait() == 0
+            status = status and os.path.isfile(self.__dump_file_path)
             _print(F"Dump Nextcloud database: {self.SUCCESS if status else self.FAILED}")
             return status
         except:
@@ -90,51 +269,890 @@ class Container:
             self.exceptions.update({'__dump_db': traceback.format_exc()})
             return False
 
-    # Import database
-    def __import_db(self) -> bool:
+    # Dump database and stream it straight into the backup archive without staging it in the tmp folder. The dump is
+    # read out of the container by a stage of its own, so reading, compressing and writing the archive overlap.
+    def __stream_backup(self) -> bool:
+        try:
+            if self.__dump_process is None:
+                self.__dump_process = self.__docker.exec_stream(self.db_container, self.__dump_command())
+            dump = self.__pipeline.channel()
+            reader = self.__pipeline.start(self.__read_dump, dump)
+            archive.add_stream(self.__archive(), self.__dump_file, io.BufferedReader(pipeline.ChannelReader(dump), pipeline.CHUNK_SIZE))
+            status = self.__pipeline.join(reader)
+            _print(F"Dump Nextcloud database into backup: {self.SUCCESS if status else self.FAILED}")
+            return status
+        except:
+            _print(F"Dump Nextcloud database into backup: {self.FAILED}")
+            self.exceptions.update({'__stream_backup': traceback.format_exc()})
+            return False
+
+    # Stage that reads the dump out of the database container into a channel
+    def __read_dump(self, channel: pipeline.Channel) -> bool:
+        with channel:
+            channel.put(self.__dump_head)
+            dump = self.throttle.reader(self.__dump_process.stdout)
+            for data in iter(lambda: dump.read(pipeline.CHUNK_SIZE), b''):
+                channel.put(data)
+        return self.__dump_process.wait() == 0
+
+    # Run a query in the database container and return the result rows as lists of columns
+    def __query(self, sql: str) -> list:
+        exit_code, output, errors = self.__docker.exec_run(
+            self.db_container, ["mysql", "--user=root", "--password=" + self.__password, "--batch",
+                                "--skip-column-names", "--execute", sql])
+        if exit_code != 0:
+            raise Exception(F"Query failed with exit code {exit_code}: {errors}")
+        return [line.split('\t') for line in output.splitlines() if line]
+
+    # Dump every table with its own mysqldump, up to parallel_dump at once, and stream them into the backup archive
+    # as separate members: <backup>.tables/<database>.sql creates the database, <backup>.tables/<database>/<table>.sql
+    # holds the table. <backup>.tables.json lists the tables with their change signal and the archive they were dumped
+    # into. With skip_unchanged, a table that is unchanged since the last backup isn't dumped again; the list refers to
+    # the archive it is in instead.
+    def __dump_tables(self) -> bool:
+        try:
+            system_schemas = "('mysql', 'information_schema', 'performance_schema', 'sys')"
+            databases = self.__query(
+                "SELECT schema_name, default_character_set_name, default_collation_name FROM information_schema.schemata "
+                F"WHERE schema_name NOT IN {system_schemas}")
+            # Start with the largest tables so they don't end up running alone at the end
+            # The time the tables are looked at, the update times are compared with it by the next backup
+            checked = self.__query("SELECT NOW()")[0][0] if self.skip_unchanged else None
+            tables = self.__query(
+                "SELECT table_schema, table_name, update_time FROM information_schema.tables "
+                F"WHERE table_type = 'BASE TABLE' AND table_schema NOT IN {system_schemas} ORDER BY data_length DESC")
+            lock = threading.Lock()
+            previous = self.__previous_tables() if self.skip_unchanged else {}
+            self.__tables = {}
+
+            def dump_table(database, table, update_time):
+                key = F"{database}/{table}"
+                entry = {'update_time': None if update_time == 'NULL' else update_time, 'checksum': None,
+                         'checked': checked, 'archive': self.archive_file}
+                if self.skip_unchanged and self.__unchanged(database, table, entry, previous.get(key)):
+                    with lock:
+                        self.__tables[key] = dict(entry, archive=previous[key]['archive'],
+                                                  checksum=entry['checksum'] or previous[key].get('checksum'))
+                    return True
+                with lock:
+                    self.__tables[key] = entry
+                dump = self.__docker.exec_stream(
+                    self.db_container, self.throttle.command(["mysqldump", "--default-character-set=utf8mb4",
+                                                              "--password=" + self.__password, database, table]))
+                try:
+                    archive.add_stream(tarball, F"{self.__tables_dir}/{database}/{table}.sql",
+                                       self.throttle.reader(dump.stdout), archive.CHUNK_SIZE // 4, lock)
+                finally:
+                    returncode = dump.wait()
+                return returncode == 0
+
+            tarball = self.__archive()
+            for database, charset, collation in databases:
+                archive.add_bytes(tarball, F"{self.__tables_dir}/{database}.sql",
+                                  F"CREATE DATABASE IF NOT EXISTS `{database}` "
+                                  F"DEFAULT CHARACTER SET {charset} COLLATE {collation};\n".encode("utf-8"))
+            with ThreadPoolExecutor(max_workers=self.parallel_dump) as executor:
+                results = list(executor.map(lambda row: dump_table(*row), tables))
+            archive.add_bytes(tarball, self.__tables_file, json.dumps(self.__tables, sort_keys=True).encode('utf-8'))
+            status = all(results)
+            dumped = len([entry for entry in self.__tables.values() if entry['archive'] == self.archive_file])
+            _print(F"Dump {dumped} tables in parallel into backup: {self.SUCCESS if status else self.FAILED}")
+            if dumped < len(tables):
+                _print(F"{len(tables) - dumped} unchanged tables refer to earlier backups")
+            return status
+        except:
+            _print(F"Dump tables in parallel into backup: {self.FAILED}")
+            self.exceptions.update({'__dump_tables': traceback.format_exc()})
+            return False
+
+    # Tables of the last backup of this instance whose archives are still there and are kept by the retention policy
+    # once this backup is made. Tables of backups made without a list of their tables, and tables whose archive was
+    # deleted or falls out of the retention window, are dumped again.
+    def __previous_tables(self) -> dict:
+        backups = self.__catalog_backups()
+        if not backups or not backups[-1]['tables']:
+            return {}
+        created = datetime.datetime.strptime(self.__datetime, DATETIME_FORMAT)
+        keep, _ = self.retention_policy.apply(backups + [{'path': self.archive_file_path, 'created': created}])
+        kept = {os.path.basename(backup['path']) for backup in keep if os.path.isfile(backup['path'])}
+        return {key: entry for key, entry in backups[-1]['tables'].items() if entry['archive'] in kept}
+
+    # Whether a table is unchanged since the last backup, which listed it with the given entry. The update time the
+    # server keeps is compared first, it costs nothing; it is only trusted if it is older than the time the last
+    # backup looked at the table, so a change in the same second isn't missed. Without update times, e.g. after the
+    # server restarted, the CHECKSUM TABLE of the content is compared, which reads the whole table. The checksum is
+    # added to the entry, so the next backup can compare it as well.
+    def __unchanged(self, database: str, table: str, entry: dict, last) -> bool:
+        if entry['update_time'] and last and last.get('update_time') and last.get('checked'):
+            return entry['update_time'] == last['update_time'] and last['update_time'] < last['checked']
+        if not entry['update_time']:
+            entry['checksum'] = self.__table_checksum(database, table)
+        return bool(last) and entry['checksum'] is not None and entry['checksum'] == last.get('checksum')
+
+    # Checksum of the content of a table, None if the server can't compute one
+    def __table_checksum(self, database: str, table: str):
+        rows = self.__query(F"CHECKSUM TABLE `{database}`.`{table}`")
+        return rows[0][1] if rows and len(rows[0]) > 1 and rows[0][1] != 'NULL' else None
+
+    # Dump database and store it together with the config as a new snapshot in the backup repository. Only chunks not
+    # yet in the repository are written. The chunks are written under the lock of the backup dir, so the garbage
+    # collection of a concurrent cleanup can't delete them before the snapshot refers to them.
+    def __store_snapshot(self) -> bool:
+        try:
+            if self.__dump_process is None:
+                self.__dump_process = self.__docker.exec_stream(self.db_container, self.__dump_command())
+            with backup_dir_lock(self.backup_dir):
+                self.__config_tar.seek(0)
+                with tarfile.open(fileobj=self.__config_tar, mode='r|') as config:
+                    members = self.__snapshot_members = self.repository.put_tar(config, "config")
+                dump = self.throttle.reader(self.__dump_process.stdout)
+                members.append(self.repository.put_stream(self.__dump_file,
+                                                          archive.PrefixedStream(self.__dump_head, dump)))
+                status = self.__dump_process.wait() == 0
+                if status:
+                    self.repository.write_snapshot(self.name + '_' + self.__datetime, self.name, members)
+                    self.checksum = archive.file_checksum(self.archive_file_path)
+                    archive.write_checksum(self.archive_file_path, self.checksum)
+                    self.metrics.bytes_read = sum(member.get('size', 0) for member in members)
+            _print(F"Store snapshot in backup repository: {self.SUCCESS if status else self.FAILED}")
+            if status:
+                _print(F"{self.repository.new_chunks} new chunks, "
+                       F"{round(self.repository.new_bytes / 1000000, 2)} MB added to the repository")
+            return status
+        except:
+            _print(F"Store snapshot in backup repository: {self.FAILED}")
+            self.exceptions.update({'__store_snapshot': traceback.format_exc()})
+            return False
+
+    # Host path of the data directory: the datadirectory of the Nextcloud config, resolved through the mounts of the
+    # app container, unless a path is configured
+    def __data_location(self) -> str:
+        if self.data.path:
+            return self.data.path
+        exit_code, output, errors = self.__docker.exec_run(
+            self.app_container, ["php", "occ", "config:system:get", "datadirectory"], user="www-data")
+        directory = output.strip() if exit_code == 0 and output.strip() else NEXTCLOUD_DIR + "/data"
+        path = datadir.host_path(self.__docker.inspect_container(self.app_container), directory)
+        if path is None or not os.path.isdir(path):
+            raise Exception(F"The data directory {directory} of {self.app_container} is not on a volume readable "
+                            F"from the host, set its path in the data config")
+        return path
+
+    # Snapshot the data directory next to the backup. Only files changed since the last snapshot are copied, the
+    # others are hard-linked from it.
+    def __backup_data(self) -> bool:
+        try:
+            self.data.snapshot(self.__data_location(), self.data_snapshot_path, self.data_index)
+            _print(F"Back up data directory: {self.SUCCESS}")
+            _print(F"{self.data.copied_files} files copied ({round(self.data.copied_bytes / 1000000, 2)} MB), "
+                   F"{self.data.linked_files} unchanged files linked")
+            return True
+        except:
+            _print(F"Back up data directory: {self.FAILED}")
+            self.exceptions.update({'__backup_data': traceback.format_exc()})
+            return False
+
+    # Folder of the binary logs within the database container
+    def __binlog_location(self) -> str:
+        enabled = self.__query("SHOW VARIABLES LIKE 'log_bin'")
+        if not enabled or enabled[0][1] != 'ON':
+            raise Exception(F"Binary logging is disabled in {self.db_container}, start the database with --log-bin")
+        basename = self.__query("SHOW VARIABLES LIKE 'log_bin_basename'")
+        if basename and len(basename[0]) > 1 and basename[0][1]:
+            return basename[0][1].rpartition('/')[0]
+        return self.__query("SELECT @@datadir")[0][0].rstrip('/')
+
+    # Copy the binary logs closed since the last binlog backup into a new incremental archive. The current log is
+    # closed first, so the archive covers everything up to now. Without earlier binlog backups, all logs the server
+    # still has are copied.
+    def __copy_binlogs(self) -> bool:
+        try:
+            directory = self.__binlog_location()
+            self.__query("FLUSH BINARY LOGS")
+            # The last log is the one the server writes to now
+            logs = [row[0] for row in self.__query("SHOW BINARY LOGS")][:-1]
+            archived = [name for backup in self.__binlog_backups() for name in backup['members']]
+            if archived:
+                last = max(archived, key=binlog.sequence)
+                logs = [name for name in logs if binlog.sequence(name) > binlog.sequence(last)]
+                if logs and logs[0] != binlog.next_name(last):
+                    _print(F"{Fore.YELLOW}The binary logs between {last} and {logs[0]} were purged before they were "
+                           F"backed up, point-in-time restores need a full backup made after them{Style.RESET_ALL}")
+            os.makedirs(self.binlog_catalog.backup_dir, exist_ok=True)
+            digest = hashlib.sha256()
+            with archive.open_backup(self.binlog_file_path, self.compression, digest, self.throttle.writer,
+                                     self.encryption) as tarball:
+                for name in logs:
+                    with self.__docker.get_archive(self.db_container, F"{directory}/{name}") as stream, \
+                            tarfile.open(fileobj=self.throttle.reader(stream), mode='r|') as source:
+                        for member in source:
+                            member.name = name
+                            tarball.addfile(member, source.extractfile(member))
+                self.metrics.bytes_read = tarball.offset
+            self.__archive_members = logs
+            self.checksum = digest.hexdigest()
+            archive.write_checksum(self.binlog_file_path, self.checksum)
+            os.chmod(self.binlog_file_path, stat.S_IREAD)
+            os.chmod(archive.checksum_path(self.binlog_file_path), stat.S_IREAD)
+            _print(F"Copy {len(logs)} binary logs into backup: {self.SUCCESS}")
+            return True
+        except:
+            _print(F"Copy binary logs into backup: {self.FAILED}")
+            self.exceptions.update({'__copy_binlogs': traceback.format_exc()})
+            for path in (self.binlog_file_path, archive.checksum_path(self.binlog_file_path)):
+                if os.path.isfile(path):
+                    os.remove(path)
+            return False
+
+    # Record the new binlog archive in the catalog of the binlog folder
+    def __add_binlogs_to_catalog(self) -> bool:
+        try:
+            created = datetime.datetime.strptime(self.__datetime, DATETIME_FORMAT)
+            self.binlog_catalog.add(self.binlog_file_path, self.name, created, self.compression.format,
+                                    self.__archive_members, self.checksum)
+            _print(F"Add binlog backup to catalog: {self.SUCCESS}")
+            return True
+        except:
+            _print(F"Add binlog backup to catalog: {self.FAILED}")
+            self.exceptions.update({'__add_binlogs_to_catalog': traceback.format_exc()})
+            return False
+
+    # Collect the config of a snapshot for the upload into the container
+    def __restore_snapshot_config(self) -> bool:
         try:
-            import_db = subprocess.Popen(['cat', self.restore_dump_file_path], stdout=subprocess.PIPE)
-            result = check_output(
-                ["docker", "exec", self.db_container, "mysql", "--user=root", "--password=" + self.__password, ],
-                stdin=import_db.stdout)
-            status = 'ERROR' not in result.decode("utf-8")
-            _print(F"Import Nextcloud database: {self.SUCCESS if status else self.FAILED}")
+            manifest = Repository.read_snapshot(self.backup_file_path)
+            with tarfile.open(fileobj=self.__config_tar, mode='w') as config:
+                status = self.repository.write_tar(manifest, config, "config") > 0
+            _print(F"Restore configuration from snapshot: {self.SUCCESS if status else self.FAILED}")
             return status
-        except subprocess.CalledProcessError as e:
+        except:
+            _print(F"Restore configuration from snapshot: {self.FAILED}")
+            self.exceptions.update({'__restore_snapshot_config': traceback.format_exc()})
+            return False
+
+    # Stop a running dump without waiting for it, when another stage of the pipeline failed
+    def __stop_dump(self):
+        if self.__dump_process is not None:
+            self.__dump_process.kill()
+
+    # Make sure no dump process outlives an aborted backup
+    def __kill_dump(self):
+        if self.__dump_process is not None:
+            if self.__dump_process.poll() is None:
+                self.__dump_process.kill()
+            self.__dump_process.wait()
+            self.__dump_process = None
+
+    # Import database straight from the backup. The dump is read from the compressed archive or the repository and fed
+    # to mysql in bounded chunks, so it is never written to disk and memory usage does not depend on its size. Config
+    # members of an archive are extracted into the tmp folder on the way.
+    def __import_db(self) -> bool:
+        progress = utils.Throughput("Import Nextcloud database")
+        self.__binlog_position = binlog.PositionScanner()
+        try:
+            if Repository.is_snapshot(self.backup_file_path):
+                self.__import_snapshot_db(progress)
+            else:
+                self.__import_archive_db(progress)
+            progress.finish()
+            self.metrics.bytes_written = progress.bytes
+            _print(F"Import Nextcloud database: {self.SUCCESS}")
+            return True
+        except:
             _print(F"Import Nextcloud database: {self.FAILED}")
             self.exceptions.update({'__import_db': traceback.format_exc()})
             return False
 
-    # Tar config folder within container and copy it into backup folder
-    def __export_config(self) -> bool:
+    def __import_snapshot_db(self, progress):
+        manifest = Repository.read_snapshot(self.backup_file_path)
+        dump = [member for member in manifest['members'] if member['name'] == self.restore_dump_file]
+        if not dump:
+            raise Exception(F"No database dump found in {self.backup_file_path}")
+        with DatabaseImport(self.db_container, self.__password, progress=progress) as import_db:
+            dump_filter = self.__shadow_filter(import_db.write)
+            write = dump_filter.feed if dump_filter else import_db.write
+            for data in self.repository.read_member(dump[0]):
+                self.__binlog_position.feed(data)
+                write(data)
+            if dump_filter:
+                dump_filter.close()
+
+    # Read the archive once from start to end. The members of a parallel dump are dispatched to one mysql client per
+    # table, so tables are loaded in parallel with foreign key and unique checks disabled: the reader moves on to the
+    # next member while mysql still loads the tables already read. Unchanged tables that were not dumped again are
+    # loaded from the earlier archives afterwards.
+    def __import_archive_db(self, progress):
+        imports = {}
+        finishing = FinishingImports(self.parallel_dump or os.cpu_count() or 1)
+        found_dump = False
+        tables = {}
+        filters = {}
+        try:
+            with archive.open_tar(self.backup_file_path, self.encryption) as tarball, \
+                    tarfile.open(fileobj=self.__config_tar, mode='w') as config:
+                for member in tarball:
+                    name = member.name.lstrip('/')
+                    if name == "config" or name.startswith("config/"):
+                        member.name = name
+                        config.addfile(member, tarball.extractfile(member) if member.isfile() else None)
+                        continue
+                    if archive.strip_part(name) == self.restore_dump_file:
+                        key = None
+                    elif name == self.restore_tables_dir + '.json':
+                        tables = json.load(tarball.extractfile(member))
+                        continue
+                    elif name.startswith(self.restore_tables_dir + '/') and name.count('/') == 1:
+                        # Create a database before its tables are loaded
+                        with DatabaseImport(self.db_container, self.__password) as import_db:
+                            database_filter = self.__shadow_filter(import_db.write)
+                            archive.copy_member(tarball, member,
+                                                database_filter.feed if database_filter else import_db.write)
+                            if database_filter:
+                                database_filter.close()
+                        continue
+                    elif name.startswith(self.restore_tables_dir + '/'):
+                        database, table = name[len(self.restore_tables_dir) + 1:].split('/', 1)
+                        key = (database, archive.strip_part(table))
+                    else:
+                        continue
+                    found_dump = True
+                    if key not in imports:
+                        imports[key] = DatabaseImport(
+                            self.db_container, self.__password, self.__restore_database(key[0]) if key else None,
+                            progress, TABLE_IMPORT_PREFIX if key else b"")
+                        filters[key] = self.__shadow_filter(imports[key].write)
+                    write = filters[key].feed if filters[key] else imports[key].write
+                    if not key:
+                        write = self.__binlog_position.wrap(write)
+                    archive.copy_member(tarball, member, write)
+                    if key and archive.is_last_part(member):
+                        if filters[key]:
+                            filters[key].close()
+                        finishing.add(imports.pop(key))
+            if not found_dump and not tables:
+                raise Exception(F"No database dump found in {self.backup_file_path}")
+            for key in imports:
+                if filters[key]:
+                    filters[key].close()
+            while imports:
+                finishing.add(imports.popitem()[1])
+            finishing.close()
+        finally:
+            for import_db in imports.values():
+                import_db.abort()
+            finishing.abort()
+        self.__import_referenced_tables(tables, progress)
+
+    # Filter that renames the databases in the SQL passed to write() to their shadows and refuses statements that name
+    # them explicitly, None unless this is a shadow restore
+    def __shadow_filter(self, write):
+        return shadow.ShadowFilter(write, self.__shadow_databases) if self.restore_shadow else None
+
+    # Database a table of a parallel dump is loaded into: its shadow in a shadow restore
+    def __restore_database(self, database: str) -> str:
+        if not self.restore_shadow:
+            return database
+        if database not in self.__shadow_databases:
+            self.__shadow_databases.append(database)
+        return shadow.shadow_name(database)
+
+    # Load the tables a backup refers to from the earlier archives they were dumped into, reading each archive once
+    def __import_referenced_tables(self, tables: dict, progress):
+        references = {}
+        for key, entry in tables.items():
+            if entry['archive'] != self.restore_tar_file:
+                references.setdefault(entry['archive'], set()).add(key)
+        for file_name, keys in references.items():
+            path = os.path.join(os.path.dirname(self.backup_file_path), file_name)
+            if not os.path.isfile(path):
+                raise Exception(F"{file_name} holds unchanged tables of {self.restore_tar_file}, but it is missing")
+            tables_dir = backup_name(path) + '.tables'
+            imports = {}
+            filters = {}
+            finishing = FinishingImports(self.parallel_dump or os.cpu_count() or 1)
+            try:
+                with archive.open_tar(path, self.encryption) as tarball:
+                    for member in tarball:
+                        name = archive.strip_part(member.name.lstrip('/'))
+                        key = name[len(tables_dir) + 1:-len('.sql')]
+                        if not name.startswith(tables_dir + '/') or key not in keys:
+                            continue
+                        if key not in imports:
+                            imports[key] = DatabaseImport(self.db_container, self.__password,
+                                                          self.__restore_database(key.split('/')[0]), progress,
+                                                          TABLE_IMPORT_PREFIX)
+                            filters[key] = self.__shadow_filter(imports[key].write)
+                        archive.copy_member(tarball, member, filters[key].feed if filters[key] else imports[key].write)
+                        if archive.is_last_part(member):
+                            if filters[key]:
+                                filters[key].close()
+                            finishing.add(imports.pop(key))
+                            keys.discard(key)
+                if keys:
+                    raise Exception(F"Tables {', '.join(sorted(keys))} not found in {file_name}")
+                finishing.close()
+            finally:
+                for import_db in imports.values():
+                    import_db.abort()
+                finishing.abort()
+
+    # Base tables of a database, views and the like are not swapped
+    def __base_tables(self, database: str) -> list:
+        return [row[0] for row in self.__query(
+            F"SELECT table_name FROM information_schema.tables WHERE table_schema = {shadow.literal(database)} "
+            "AND table_type = 'BASE TABLE'")]
+
+    # Swap the restored databases in. A single RENAME TABLE statement moves the tables of each live database to
+    # <database>__previous and the restored tables from its shadow into it, so the instance never sees a partly
+    # restored database. The tables kept by the shadow restore before are dropped.
+    def __swap_databases(self) -> bool:
+        try:
+            moves = []
+            for database in self.__shadow_databases:
+                previous = shadow.quote(shadow.previous_name(database))
+                self.__query(F"DROP DATABASE IF EXISTS {previous}; CREATE DATABASE {previous}; "
+                             F"CREATE DATABASE IF NOT EXISTS {shadow.quote(database)}")
+                moves += shadow.swap_moves(database, self.__base_tables(database),
+                                           self.__base_tables(shadow.shadow_name(database)))
+            if moves:
+                self.__query(shadow.rename_statement(moves))
+            _print(F"Swap in {len(self.__shadow_databases)} restored databases: {self.SUCCESS}")
+            return True
+        except:
+            _print(F"Swap in restored databases: {self.FAILED}")
+            self.exceptions.update({'__swap_databases': traceback.format_exc()})
+            return False
+
+    # Drop the shadow databases once a shadow restore is done. They are empty after the swap; if the restore failed
+    # before, they hold what was imported and the live databases are untouched.
+    def __drop_shadow_databases(self):
+        try:
+            for database in self.__shadow_databases:
+                self.__query(F"DROP DATABASE IF EXISTS {shadow.quote(shadow.shadow_name(database))}")
+        except:
+            _print(F"Drop shadow databases: {self.FAILED}")
+            self.exceptions.update({'__drop_shadow_databases': traceback.format_exc()})
+
+    # Swap each live database with the <database>__previous one of the last shadow restore. The shadow name is used
+    # to park the live tables, so all tables change places in one RENAME TABLE statement.
+    def __swap_previous_databases(self) -> bool:
+        try:
+            databases = [row[0][:-len(shadow.PREVIOUS_SUFFIX)]
+                         for row in self.__query("SELECT schema_name FROM information_schema.schemata")
+                         if row[0].endswith(shadow.PREVIOUS_SUFFIX)]
+            if not databases:
+                raise Exception(F"No databases of an earlier shadow restore found in {self.db_container}")
+            moves = []
+            for database in databases:
+                parked = shadow.shadow_name(database)
+                self.__query(F"DROP DATABASE IF EXISTS {shadow.quote(parked)}; CREATE DATABASE {shadow.quote(parked)}; "
+                             F"CREATE DATABASE IF NOT EXISTS {shadow.quote(database)}")
+                moves += shadow.rollback_moves(database, self.__base_tables(database),
+                                               self.__base_tables(shadow.previous_name(database)))
+            if moves:
+                self.__query(shadow.rename_statement(moves))
+            for database in databases:
+                self.__query(F"DROP DATABASE {shadow.quote(shadow.shadow_name(database))}")
+            _print(F"Swap back {len(databases)} databases replaced by the last restore: {self.SUCCESS}")
+            return True
+        except:
+            _print(F"Swap back databases replaced by the last restore: {self.FAILED}")
+            self.exceptions.update({'__swap_previous_databases': traceback.format_exc()})
+            return False
+
+    # Replay the binary logs on top of the imported dump, from the position the dump was taken at up to the target time
+    # of the restore. Each log is streamed out of its archive through mysqlbinlog in the database container, and the
+    # events of all logs go into one mysql session.
+    def __replay_binlogs(self) -> bool:
+        progress = utils.Throughput("Replay binary logs")
         try:
-            os.system(F"docker exec {self.app_container} tar -cf config.tar config/")
-            os.system(F"docker cp {self.app_container}:/var/www/html/config.tar {self.__tar_file_path}")
-            os.system(F"docker exec {self.app_container} rm config.tar")
-            if os.path.isfile(self.__tar_file_path):
-                with tarfile.open(self.__tar_file_path, 'r') as tarball:
-                    tarball.extractall(self.tmp_dir)
-                status = os.path.isdir(os.path.join(self.tmp_dir, "config"))
-                _print(F"Export Nextcloud configuration: {self.SUCCESS if status else self.FAILED}")
-                return status
+            position = self.__binlog_position
+            if position is None or position.file is None:
+                raise Exception(F"{self.restore_tar_file} holds no binary log position, it wasn't made in binlog mode")
+            chain, unreachable = binlog.replay_chain(self.__binlog_backups(), position.file)
+            if unreachable:
+                _print(F"{Fore.YELLOW}Binary log {binlog.next_name(chain[-1][1])} is missing, the {len(unreachable)} "
+                       F"logs after it can't be replayed{Style.RESET_ALL}")
+            stop = "--stop-datetime=" + self.restore_until.strftime(binlog.UNTIL_FORMAT)
+            replayed = 0
+            with DatabaseImport(self.db_container, self.__password, progress=progress) as import_db:
+                for path, names in binlog.group_by_archive(chain):
+                    with archive.open_tar(path, self.encryption) as tarball:
+                        for member in tarball:
+                            if member.name not in names:
+                                continue
+                            command = ["mysqlbinlog", stop]
+                            # In a shadow restore the events go to the shadow databases
+                            if self.restore_shadow:
+                                command += [F"--rewrite-db={database}->{shadow.shadow_name(database)}"
+                                            for database in self.__shadow_databases]
+                            if member.name == position.file:
+                                command.append(F"--start-position={position.position}")
+                            self.__replay_binlog(tarball, member, command + ["-"], import_db.write)
+                            replayed += 1
+            if replayed != len(chain):
+                raise Exception(F"Only {replayed} of {len(chain)} binary logs were found in the binlog backups")
+            progress.finish()
+            _print(F"Replay {replayed} binary logs up to {self.restore_until.strftime(binlog.UNTIL_FORMAT)}: "
+                   F"{self.SUCCESS}")
+            return True
+        except:
+            _print(F"Replay binary logs: {self.FAILED}")
+            self.exceptions.update({'__replay_binlogs': traceback.format_exc()})
+            return False
+
+    # Pipe one binary log of an archive through mysqlbinlog and pass the SQL it prints on
+    def __replay_binlog(self, tarball: tarfile.TarFile, member: tarfile.TarInfo, command: list, write):
+        process = self.__docker.exec_stream(self.db_container, command, stdin=True, echo_stderr=False)
+        errors = []
+
+        def feed():
+            try:
+                archive.copy_member(tarball, member, process.stdin.write)
+            except OSError:
+                # mysqlbinlog gave up, its exit code tells why
+                pass
+            except Exception as e:
+                errors.append(e)
+            finally:
+                process.stdin.close()
+
+        feeder = threading.Thread(target=feed, daemon=True)
+        feeder.start()
+        try:
+            for data in iter(lambda: process.stdout.read(1024 * 1024), b''):
+                write(data)
+        except:
+            process.kill()
+            raise
+        finally:
+            feeder.join()
+        if errors:
+            raise errors[0]
+        returncode = process.wait()
+        if returncode != 0:
+            raise Exception(F"mysqlbinlog failed on {member.name} with exit code {returncode}: "
+                            F"{process.stderr_output}")
+
+    # Import one table. Archives with an index are read only where the table is; other backups are read until the
+    # table has been found.
+    def __import_table(self) -> bool:
+        progress = utils.Throughput(F"Import table {self.restore_table_name}")
+        try:
+            self.__follow_table_reference()
+            indexed = None if Repository.is_snapshot(self.backup_file_path) else \
+                archive.IndexedArchive.open(self.backup_file_path, self.encryption)
+            if indexed:
+                with indexed:
+                    found = self.__import_indexed_table(indexed, progress)
             else:
-                _print(F"Export Nextcloud configuration: {self.FAILED}")
+                found = self.__import_streamed_table(progress)
+            if not found:
+                raise Exception(F"Table {self.restore_table_name} not found in {self.backup_file_path}")
+            progress.finish()
+            self.metrics.bytes_written = progress.bytes
+            _print(F"Import table {self.restore_table_name}: {self.SUCCESS}")
+            return True
+        except:
+            _print(F"Import table {self.restore_table_name}: {self.FAILED}")
+            self.exceptions.update({'__import_table': traceback.format_exc()})
+            return False
+
+    # A table that was unchanged when the backup was made is read from the earlier archive it was dumped into
+    def __follow_table_reference(self):
+        for key, entry in sorted(self.__backup_tables(self.backup_file_path).items()):
+            database, table = key.split('/', 1)
+            if table == self.restore_table_name and self.restore_database in (None, database):
+                if entry['archive'] != self.restore_tar_file:
+                    self.__prepare_restore(os.path.join(os.path.dirname(self.backup_file_path), entry['archive']))
+                return
+
+    def __import_indexed_table(self, indexed: archive.IndexedArchive, progress) -> bool:
+        # A parallel dump has a file per table
+        for name in indexed.names():
+            if name.startswith(self.restore_tables_dir + '/') and name.count('/') == 2:
+                database, table = name[len(self.restore_tables_dir) + 1:-len('.sql')].split('/')
+                if table == self.restore_table_name and self.restore_database in (None, database):
+                    with DatabaseImport(self.db_container, self.__password, database, progress) as import_db:
+                        for data in indexed.iter_file(name):
+                            import_db.write(data)
+                    return True
+        found = indexed.table_ranges(self.restore_dump_file, self.restore_database, self.restore_table_name)
+        if not found:
+            return False
+        database, ranges = found
+        with DatabaseImport(self.db_container, self.__password, database, progress) as import_db:
+            for data in indexed.iter_file(self.restore_dump_file, ranges):
+                import_db.write(data)
+        return True
+
+    def __import_streamed_table(self, progress) -> bool:
+        imports = []
+        head = []
+
+        # The head of the dump is kept until the table is found, then the import into its database starts
+        def write(data):
+            if not table_filter.found:
+                head.append(data)
+                return
+            if not imports:
+                imports.append(DatabaseImport(self.db_container, self.__password, table_filter.database, progress))
+                for buffered in head:
+                    imports[0].write(buffered)
+            imports[0].write(data)
+
+        table_filter = archive.TableFilter(self.restore_database, self.restore_table_name, write)
+        try:
+            if Repository.is_snapshot(self.backup_file_path):
+                manifest = Repository.read_snapshot(self.backup_file_path)
+                for member in manifest['members']:
+                    if member['name'] == self.restore_dump_file:
+                        for data in self.repository.read_member(member):
+                            table_filter.feed(data)
+            else:
+                with archive.open_tar(self.backup_file_path, self.encryption) as tarball:
+                    for member in tarball:
+                        name = member.name.lstrip('/')
+                        if archive.strip_part(name) == self.restore_dump_file:
+                            archive.copy_member(tarball, member, table_filter.feed)
+                        elif name.startswith(self.restore_tables_dir + '/') and name.count('/') == 2:
+                            database, table = archive.strip_part(name)[len(self.restore_tables_dir) + 1:-4].split('/')
+                            if table == self.restore_table_name and self.restore_database in (None, database):
+                                table_filter.found, table_filter.database = True, database
+                                archive.copy_member(tarball, member, write)
+            table_filter.close()
+            while imports:
+                imports.pop().close()
+            return table_filter.found
+        finally:
+            for import_db in imports:
+                import_db.abort()
+
+    # Upload one file of the backup into the app container
+    def __import_file(self) -> bool:
+        try:
+            info, data = self.__read_backup_file(self.restore_file_name)
+            if info is None:
+                raise Exception(F"{self.restore_file_name} not found in {self.backup_file_path}")
+            upload = tempfile.SpooledTemporaryFile(max_size=16 * 1024 * 1024)
+            with upload, tarfile.open(fileobj=upload, mode='w') as tarball:
+                tarball.addfile(info, io.BytesIO(data))
+                tarball.close()
+                upload.seek(0)
+                self.__docker.put_archive(self.app_container, NEXTCLOUD_DIR, upload)
+            _print(F"Restore {self.restore_file_name}: {self.SUCCESS}")
+            return True
+        except:
+            _print(F"Restore {self.restore_file_name}: {self.FAILED}")
+            self.exceptions.update({'__import_file': traceback.format_exc()})
+            return False
+
+    # TarInfo and content of a file in the backup, (None, None) if it isn't there
+    def __read_backup_file(self, name: str):
+        if Repository.is_snapshot(self.backup_file_path):
+            for member in Repository.read_snapshot(self.backup_file_path)['members']:
+                if member['name'] == name and member['type'] == 'file':
+                    info = tarfile.TarInfo(name)
+                    info.mode, info.size, info.mtime = member['mode'], member['size'], int(time.time())
+                    return info, b''.join(self.repository.read_member(member))
+            return None, None
+        indexed = archive.IndexedArchive.open(self.backup_file_path, self.encryption)
+        if indexed:
+            with indexed:
+                entry = indexed.members.get(name)
+                if entry is None or entry[6]:
+                    return None, None
+                info = tarfile.TarInfo(name)
+                info.size, info.mode, info.uid, info.gid = entry[2:6]
+                info.mtime = int(time.time())
+                return info, indexed.read_file(name)
+        with archive.open_tar(self.backup_file_path, self.encryption) as tarball:
+            for member in tarball:
+                if member.name.lstrip('/') == name and member.isfile():
+                    member.name = name
+                    return member, tarball.extractfile(member).read()
+        return None, None
+
+    # Stream the config folder out of the container into the repository, or into a spooled tar that is added to the
+    # backup archive once the dump is in. That way the export doesn't have to wait for the archive and runs while the
+    # database is dumped.
+    def __export_config(self) -> bool:
+        try:
+            with self.__docker.get_archive(self.app_container, NEXTCLOUD_DIR + "/config") as stream, \
+                    tarfile.open(fileobj=stream, mode='r|') as config, \
+                    tarfile.open(fileobj=self.__config_tar, mode='w') as spool:
+                status = archive.copy_members(config, spool, "config") > 0
+            _print(F"Export Nextcloud configuration: {self.SUCCESS if status else self.FAILED}")
+            return status
         except:
             _print(F"Export Nextcloud configuration: {self.FAILED}")
             self.exceptions.update({'__export_config': traceback.format_exc()})
             return False
 
-    # Tar config folder within container and copy it into backup folder
+    # The backup archive, opened on first use. It is compressed into a channel, and a stage of its own hashes it and
+    # writes it to the disk, so compressing and writing overlap.
+    def __archive(self) -> tarfile.TarFile:
+        if self.__tarball is None:
+            self.__archive_stack = ExitStack()
+            self.__digest = hashlib.sha256()
+            # The archive is uploaded to the storage target while it is written
+            if self.target:
+                self.__upload = self.target.upload(self.archive_file_path, self.archive_file)
+            channel = self.__pipeline.channel()
+            self.__writer = self.__pipeline.start(self.__write_archive, channel)
+            writer = self.__archive_stack.enter_context(closing(pipeline.ChannelWriter(channel)))
+            self.__tarball = self.__archive_stack.enter_context(
+                archive.backup_writer(writer, self.compression, self.encryption))
+        return self.__tarball
+
+    # Stage that hashes the compressed archive and writes it to the backup dir, and to the storage target
+    def __write_archive(self, channel: pipeline.Channel) -> bool:
+        with open(self.archive_file_path, 'wb') as file:
+            target = self.throttle.writer(file)
+            if self.__upload is not None:
+                target = storage.Tee(target, self.__upload)
+            target = archive.HashingWriter(target, self.__digest)
+            for data in channel:
+                target.write(data)
+        return True
+
+    # Finish the backup archive and wait until it is written
+    def __close_archive(self):
+        stack, tarball, self.__archive_stack, self.__tarball = self.__archive_stack, self.__tarball, None, None
+        writer, self.__writer = self.__writer, None
+        try:
+            stack.close()
+        finally:
+            written = self.__pipeline.join(writer)
+        if not written:
+            raise Exception(F"Could not write {self.archive_file_path}")
+        self.metrics.bytes_read = tarball.offset
+        self.__archive_members = [member.name for member in tarball.members]
+        self.checksum = self.__digest.hexdigest()
+        archive.write_checksum(self.archive_file_path, self.checksum)
+
+    # Add the exported config to the backup archive
+    def __add_config(self):
+        self.__config_tar.seek(0)
+        with tarfile.open(fileobj=self.__config_tar, mode='r|') as config:
+            archive.copy_members(config, self.__archive(), "config")
+
+    # Add the config to the backup archive and finish it
+    def __finish_archive(self) -> bool:
+        try:
+            self.__add_config()
+            self.__close_archive()
+            status = self.checksum is not None
+            _print(F"Finish backup archive: {self.SUCCESS if status else self.FAILED}")
+            return status
+        except:
+            _print(F"Finish backup archive: {self.FAILED}")
+            self.exceptions.update({'__finish_archive': traceback.format_exc()})
+            return False
+
+    # Remove the archive of an aborted backup, whether it is still being written or a later step failed. Once the
+    # backup is in the catalog it is kept, a failed upload is resumed by the next backup.
+    def __discard_archive(self):
+        if self.__catalogued:
+            return
+        if self.__tarball is not None:
+            try:
+                self.__close_archive()
+            except:
+                pass
+        for path in (self.archive_file_path, archive.checksum_path(self.archive_file_path)):
+            if os.path.isfile(path):
+                os.remove(path)
+        if self.__upload is not None:
+            self.__upload.cancel()
+            self.__upload = None
+
+    # Finish the upload of the backup to the storage target. If the upload that ran while the archive was written
+    # failed, it is resumed from the archive. Interrupted uploads of earlier backups are finished as well.
+    def __upload_backup(self) -> bool:
+        try:
+            upload, self.__upload = self.__upload, None
+            uploaded = upload is not None and upload.close()
+            # Other instances may share the backup dir, e.g. cloud and cloud_2, so the instance is parsed from the name
+            pending = [file_name[:-len('.upload')] for file_name in sorted(os.listdir(self.backup_dir))
+                       if file_name.endswith('.upload')
+                       and (parse_name(archive.strip_extension(file_name[:-len('.upload')])) or [None])[0] == self.name]
+            paths = [self.archive_file_path] + [os.path.join(self.backup_dir, file_name) for file_name in pending]
+            status = True
+            for path in dict.fromkeys(paths):
+                if not os.path.isfile(path):
+                    storage.remove_state(path)
+                    continue
+                try:
+                    if not (uploaded and path == self.archive_file_path):
+                        storage.retry(lambda: self.target.resume(path, os.path.basename(path)))
+                    if os.path.isfile(archive.checksum_path(path)):
+                        self.target.put_file(archive.checksum_path(path), os.path.basename(archive.checksum_path(path)))
+                except:
+                    self.exceptions.update({'__upload_backup': traceback.format_exc()})
+                    status = False
+            _print(F"Upload backup to {self.target.url}: {self.SUCCESS if status else self.FAILED}")
+            return status
+        except:
+            _print(F"Upload backup to {self.target.url}: {self.FAILED}")
+            self.exceptions.update({'__upload_backup': traceback.format_exc()})
+            return False
+
+    # Check the backup against the checksum recorded when it was written. Backups without a checksum are restored
+    # with a warning. For snapshots, all chunks they refer to must be in the repository, for parallel dumps all
+    # archives holding unchanged tables they refer to must be there and intact.
+    def __verify_backup(self) -> bool:
+        try:
+            if Repository.is_snapshot(self.backup_file_path):
+                missing = self.repository.check(Repository.read_snapshot(self.backup_file_path))
+                status = not missing
+                if missing:
+                    _print(F"{Fore.RED}{len(missing)} chunks of the snapshot are missing{Style.RESET_ALL}")
+            else:
+                paths = [self.backup_file_path] + self.__referenced_archives(self.backup_file_path)
+                status = all([self.__verify_archive(path) for path in paths])
+            _print(F"Verify backup: {self.SUCCESS if status else self.FAILED}")
+            return status
+        except:
+            _print(F"Verify backup: {self.FAILED}")
+            self.exceptions.update({'__verify_backup': traceback.format_exc()})
+            return False
+
+    def __verify_archive(self, path: str) -> bool:
+        if not os.path.isfile(path):
+            _print(F"{Fore.RED}{os.path.basename(path)} is missing{Style.RESET_ALL}")
+            return False
+        expected = archive.read_checksum(path) or next(
+            (backup['checksum'] for backup in self.catalog.backups(self.name)
+             if backup['path'] == os.path.abspath(path)), None)
+        if expected is None:
+            _print(F"{Fore.YELLOW}No checksum recorded for {os.path.basename(path)}, "
+                   F"it can't be verified{Style.RESET_ALL}")
+            return True
+        return archive.file_checksum(path) == expected
+
+    # Tables a parallel dump lists in the catalog, with their checksum and the archive they were dumped into
+    def __backup_tables(self, path: str) -> dict:
+        return next((backup['tables'] for backup in self.catalog.backups(self.name)
+                     if backup['path'] == os.path.abspath(path)), None) or {}
+
+    # Earlier archives holding unchanged tables of a backup
+    def __referenced_archives(self, path: str) -> list:
+        file_names = {entry['archive'] for entry in self.__backup_tables(path).values()} - {os.path.basename(path)}
+        return [os.path.join(os.path.dirname(path), file_name) for file_name in sorted(file_names)]
+
+    # Replace the config folder within the container with the config collected from the backup
     def __import_config(self) -> bool:
         try:
-            if os.path.isdir(os.path.join(self.tmp_dir, "config")):
-                with tarfile.open(self.restore_tar_file_path, 'w') as tarball:
-                    tarball.add(os.path.join(self.tmp_dir, "config"), arcname="/config")
-            os.system(F"docker cp {self.restore_tar_file_path} {self.app_container}:/var/www/html/config.tar")
-            os.system(F"docker exec {self.app_container} rm -r config")
-            os.system(F"docker exec {self.app_container} tar -xf config.tar")
-            os.system(F"docker exec {self.app_container} rm config.tar")
-            status = True  # TODO: implement a test if export into docker container was successful
+            exit_code, output, errors = self.__docker.exec_run(
+                self.app_container, ["rm", "-r", NEXTCLOUD_DIR + "/config"])
+            if exit_code != 0:
+                raise Exception(F"Could not remove old config folder: {errors}")
+            self.__config_tar.seek(0)
+            self.__docker.put_archive(self.app_container, NEXTCLOUD_DIR, self.__config_tar)
+            exit_code, output, errors = self.__docker.exec_run(
+                self.app_container, ["test", "-f", NEXTCLOUD_DIR + "/config/config.php"])
+            status = exit_code == 0
             _print(F"Import Nextcloud configuration: {self.SUCCESS if status else self.FAILED}")
             return status
         except:
@@ -145,10 +1163,10 @@ class Container:
     # Tar database with config and settings
     def __tar_backup(self) -> bool:
         try:
-            with tarfile.open(self.tar_gz_file_path, 'w:gz') as tarball:
-                tarball.add(self.__dump_file_path, arcname=self.__dump_file)
-                tarball.add(os.path.join(self.tmp_dir, "config"), arcname="/config")
-            status = True  # TODO: Implement a test to confirm that files where added to tar file
+            self.__archive().add(self.__dump_file_path, arcname=self.__dump_file)
+            self.__add_config()
+            self.__close_archive()
+            status = self.__dump_file in self.__archive_members and self.checksum is not None
             _print(F"Zip backup: {self.SUCCESS if status else self.FAILED}")
             return status
         except:
@@ -156,25 +1174,13 @@ class Container:
             self.exceptions.update({'__tar_backup': traceback.format_exc()})
             return False
 
-    # Untar backup
-    def __untar_backup(self) -> bool:
-        try:
-            with tarfile.open(self.backup_file_path, 'r:gz') as tarball:
-                tarball.extractall(self.tmp_dir)
-            status = os.path.isdir(os.path.join(self.tmp_dir, "config"))
-            _print(F"Unzip backup: {self.SUCCESS if status else self.FAILED}")
-            return status
-        except:
-            _print(F"Unzip backup: {self.FAILED}")
-            self.exceptions.update({'__untar_backup': traceback.format_exc()})
-            return False
-
     # Set secure file permissions
     def __set_file_permissions(self) -> bool:
         try:
-            os.chmod(self.tar_gz_file_path, stat.S_IREAD)
-            status = oct(os.stat(self.tar_gz_file_path).st_mode)[-3:] == '400'
-            _print(F"Set secure file permissions: {self.SUCCESS if True else self.FAILED}")
+            os.chmod(self.archive_file_path, stat.S_IREAD)
+            os.chmod(archive.checksum_path(self.archive_file_path), stat.S_IREAD)
+            status = oct(os.stat(self.archive_file_path).st_mode)[-3:] == '400'
+            _print(F"Set secure file permissions: {self.SUCCESS if status else self.FAILED}")
             return status
         except:
             _print(F"Set secure file permissions: {self.FAILED}")
@@ -184,13 +1190,17 @@ class Container:
     # Enable Nextcloud maintenance mode
     def __enable_maintenance_mode(self) -> bool:
         try:
-            enable_maintenance_mode = check_output(
-                ["docker", "exec", "--user", "www-data", self.app_container, "php", "occ", "maintenance:mode", "--on"])
-            chunks = enable_maintenance_mode.decode("utf-8").split('\n')
+            exit_code, enable_maintenance_mode, errors = self.__docker.exec_run(
+                self.app_container, ["php", "occ", "maintenance:mode", "--on"], user="www-data")
+            chunks = enable_maintenance_mode.split('\n')
             if 'Maintenance mode enabled' in chunks:
                 _print(F"Enable Nextcloud maintenance mode: {self.SUCCESS}")
+                self.__maintenance_start = self.__maintenance_start or time.monotonic()
+                self.maintenance_enabled = True
                 return True
             elif 'Maintenance mode already enabled' in chunks:
+                self.__maintenance_start = self.__maintenance_start or time.monotonic()
+                self.maintenance_enabled = True
                 return True
             else:
                 _print(F"Enable Nextcloud maintenance mode: {self.FAILED}")
@@ -202,13 +1212,15 @@ class Container:
 
     # Disable Nextcloud maintenance mode
     def __disable_maintenance_mode(self) -> bool:
-        if not utils.keep_maintenance_mode:
+        if not self.keep_maintenance_mode:
             try:
-                disable_maintenance_mode = check_output(
-                    ["docker", "exec", "--user", "www-data", self.app_container, "php", "occ", "maintenance:mode", "--off"])
-                chunks = disable_maintenance_mode.decode("utf-8").split('\n')
+                exit_code, disable_maintenance_mode, errors = self.__docker.exec_run(
+                    self.app_container, ["php", "occ", "maintenance:mode", "--off"], user="www-data")
+                chunks = disable_maintenance_mode.split('\n')
                 if 'Maintenance mode disabled' in chunks:
                     _print(F"Disable Nextcloud maintenance mode: {self.SUCCESS}")
+                    self.__stop_maintenance_clock()
+                    self.maintenance_enabled = False
                     return True
                 else:
                     _print(F"Disable Nextcloud maintenance mode: {self.FAILED}")
@@ -220,43 +1232,47 @@ class Container:
         else:
             return True
 
-    # Pull new docker images
-    def __pull_images(self):
-        update_required = False
+    # Add the time since maintenance mode was enabled to the maintenance duration of this run
+    def __stop_maintenance_clock(self):
+        if self.__maintenance_start is not None:
+            self.maintenance_duration += time.monotonic() - self.__maintenance_start
+            self.__maintenance_start = None
+
+    # Directory of the docker-compose project of this instance
+    def compose_directory(self) -> str:
+        if os.path.isfile(self.docker_compose_file_path):
+            return str(Path(self.docker_compose_file_path).parent)
+        elif os.path.isdir(self.docker_compose_file_path):
+            return self.docker_compose_file_path
+        else:
+            raise Exception("Docker Compose path invalid")
+
+    # Images used by the services of the docker-compose project, with variables resolved by docker-compose
+    def compose_images(self) -> list:
+        config = yaml.safe_load(check_output(["docker-compose", "config"], cwd=self.compose_directory()))
+        return sorted({service['image'] for service in (config.get('services') or {}).values() if 'image' in service})
+
+    # Check whether a container of the docker-compose project runs an older image than the one its tag points to now.
+    # The images have been pulled before. Returns None if the check failed.
+    def __check_for_updates(self):
         try:
-            if os.path.isfile(self.docker_compose_file_path):
-                path = Path(self.docker_compose_file_path)
-                directory = path.parent
-            elif os.path.isdir(self.docker_compose_file_path):
-                directory = self.docker_compose_file_path
-            else:
-                raise Exception("Docker Compose path invalid")
-            os.chdir(directory)
-            result = check_output(["docker-compose", "pull"])
-            result = result.decode("utf-8").split("\n")
-            for line in result:
-                if line.startswith("Status:"):
-                    _print(line)
-                    if 'Image is up to date' not in line:
-                        update_required = True
+            container_ids = check_output(["docker-compose", "ps", "-q"], cwd=self.compose_directory())
+            update_required = False
+            for container_id in container_ids.decode("utf-8").split():
+                container = self.__docker.inspect_container(container_id)
+                if container['Image'] != self.__docker.inspect_image(container['Config']['Image'])['Id']:
+                    _print(F"Newer image available: {container['Config']['Image']}")
+                    update_required = True
             return update_required
         except:
-            self.exceptions.update({'__pull_images': traceback.format_exc()})
-            _print(F"Pull new docker images: {self.FAILED}")
-            return False
+            self.exceptions.update({'__check_for_updates': traceback.format_exc()})
+            _print(F"Check for new docker images: {self.FAILED}")
+            return None
 
     # Restart docker containers
     def __restart_containers(self):
         try:
-            if os.path.isfile(self.docker_compose_file_path):
-                path = Path(self.docker_compose_file_path)
-                directory = path.parent
-            elif os.path.isdir(self.docker_compose_file_path):
-                directory = self.docker_compose_file_path
-            else:
-                raise Exception("Docker Compose path invalid")
-            os.chdir(directory)
-            result = check_output(["docker-compose", "up", "-d"])
+            check_output(["docker-compose", "up", "-d"], cwd=self.compose_directory())
             _print(F"Restart docker containers: {self.SUCCESS}")
             return True  # TODO: Implement test
         except:
@@ -264,62 +1280,277 @@ class Container:
             _print(F"Restart docker containers: {self.FAILED}")
             return False
 
-    # Create backup and return file size in MB or False if it failed
+    # URL the adaptive throttle probes the response time of the instance with: the status page of the app container
+    # on its first network, unless a probe_url is configured
+    def __probe_url(self):
+        if not self.throttle.adaptive or self.throttle.probe_url:
+            return None
+        try:
+            networks = self.__docker.inspect_container(self.app_container)['NetworkSettings']['Networks']
+            address = next(network['IPAddress'] for network in networks.values() if network.get('IPAddress'))
+            return F"http://{address}/status.php"
+        except:
+            _print(F"{Fore.YELLOW}Could not find the address of {self.app_container}, set throttle.adaptive.probe_url "
+                   F"to enable the adaptive throttle{Style.RESET_ALL}")
+            self.exceptions.update({'__probe_url': traceback.format_exc()})
+            return None
+
+    # Create backup and return file size in MB or False if it failed. Steps given as a tuple run at the same time as
+    # stages of a pipeline: the config is exported while the database is dumped, and the archive is compressed, hashed
+    # and written while the dump is read.
     def create_backup(self):
 
         backup_functions = [
             self.__enable_maintenance_mode,
-            self.__dump_db,
-            self.__export_config,
+            (self.__dump_db, self.__export_config),
             self.__disable_maintenance_mode,
             self.__tar_backup,
             self.__set_file_permissions,
             self.__delete_tmp_dir
         ]
 
-        if self.__create_backup_dir() and self.__create_tmp_dir():
+        # In streaming mode the dump is compressed while it is read, so maintenance mode lasts until the archive is written
+        if self.stream_dump:
+            backup_functions = [
+                self.__enable_maintenance_mode,
+                (self.__export_config, self.__stream_backup),
+                self.__finish_archive,
+                self.__disable_maintenance_mode,
+                self.__set_file_permissions,
+                self.__delete_tmp_dir
+            ]
+
+        # In online snapshot mode maintenance mode only lasts until mysqldump has opened its snapshot. The config is
+        # exported from the running instance and the dump is finished afterwards.
+        if self.online_snapshot and self.stream_dump:
+            backup_functions = [
+                self.__enable_maintenance_mode,
+                self.__start_dump,
+                self.__disable_maintenance_mode,
+                (self.__export_config, self.__stream_backup),
+                self.__finish_archive,
+                self.__set_file_permissions,
+                self.__delete_tmp_dir
+            ]
+        elif self.parallel_dump:
+            backup_functions = [
+                self.__enable_maintenance_mode,
+                (self.__export_config, self.__dump_tables),
+                self.__finish_archive,
+                self.__disable_maintenance_mode,
+                self.__set_file_permissions,
+                self.__delete_tmp_dir
+            ]
+        elif self.online_snapshot and self.repository:
+            backup_functions = [
+                self.__enable_maintenance_mode,
+                self.__start_dump,
+                self.__disable_maintenance_mode,
+                self.__export_config,
+                self.__store_snapshot,
+                self.__set_file_permissions,
+                self.__delete_tmp_dir
+            ]
+        elif self.repository:
+            backup_functions = [
+                self.__enable_maintenance_mode,
+                self.__export_config,
+                self.__store_snapshot,
+                self.__disable_maintenance_mode,
+                self.__set_file_permissions,
+                self.__delete_tmp_dir
+            ]
+        elif self.online_snapshot:
+            backup_functions = [
+                self.__enable_maintenance_mode,
+                self.__start_dump,
+                self.__disable_maintenance_mode,
+                (self.__export_config, self.__dump_db),
+                self.__tar_backup,
+                self.__set_file_permissions,
+                self.__delete_tmp_dir
+            ]
+
+        # The data directory is copied once the instance is back online
+        if self.data:
+            backup_functions.insert(-1, self.__backup_data)
+        backup_functions.insert(-1, self.__add_to_catalog)
+        # A failed upload leaves the backup in the backup dir and in the catalog, the next backup resumes it
+        if self.target:
+            backup_functions.insert(-1, self.__upload_backup)
+
+        self.__start_run('backup')
+        if self.__create_backup_dir() and self.__lock_instance() and self.__create_tmp_dir():
+            self.__pipeline = pipeline.Pipeline(self.exceptions)
+            self.__pipeline.on_abort(self.__stop_dump)
+            self.__config_tar = tempfile.SpooledTemporaryFile(max_size=16 * 1024 * 1024, dir=self.tmp_dir)
             try:
-                for fn in backup_functions:
-                    if not fn():
-                        _print(F"{Fore.RED}Backup aborted.{Style.RESET_ALL}")
-                        return False
-                return round(Path(self.tar_gz_file_path).stat().st_size / 1000000, 2)
+                with self.throttle.active(self.__probe_url()):
+                    for fn in backup_functions:
+                        if not self.__run_steps(fn):
+                            _print(F"{Fore.RED}Backup aborted.{Style.RESET_ALL}")
+                            return False
+                if self.throttle.back_offs:
+                    _print(F"Backup slowed down {self.throttle.back_offs} times because the response time of "
+                           F"{self.name} went above {self.throttle.max_latency} seconds")
+                if self.repository:
+                    self.metrics.bytes_written = self.repository.new_bytes
+                else:
+                    self.metrics.bytes_written = Path(self.archive_file_path).stat().st_size
+                self.__finish_run(True)
+                return round(self.metrics.bytes_written / 1000000, 2)
             except:
                 self.exceptions.update({'backup': traceback.format_exc()})
                 return False
+            finally:
+                self.__pipeline.shutdown()
+                self.__kill_dump()
+                self.__discard_archive()
+                self.__config_tar.close()
+                self.__finish_run(False)
+                self.__unlock_instance()
         else:
             _print(F"{Fore.RED}Could not create temporary folder or backup folder. Backup aborted.{Style.RESET_ALL}")
+            self.__unlock_instance()
+            self.__finish_run(False)
             return False
 
-    def restore_backup(self, backup_file_path) -> bool:
+    # Run a step, or the steps of a tuple at the same time as stages of the pipeline. A failed step aborts the
+    # pipeline, so no stage keeps waiting for it.
+    def __run_steps(self, steps) -> bool:
+        if isinstance(steps, tuple):
+            return self.__pipeline.run([(fn.__name__, self.metrics.run_step, (fn,)) for fn in steps])
+        status = self.metrics.run_step(steps)
+        if not status:
+            self.__pipeline.abort()
+        return status
 
-        self.backup_file_path = backup_file_path
-        self.restore_dump_file = os.path.basename(backup_file_path[:-6] + "sql")
-        self.restore_dump_file_path = os.path.join(self.tmp_dir, self.restore_dump_file)
-        self.restore_tar_file = os.path.basename(backup_file_path[:-3])
-        self.restore_tar_file_path = os.path.join(self.tmp_dir, self.restore_tar_file)
+    # Back up the binary logs closed since the last binlog backup into an incremental archive and return its size in MB,
+    # or False if it failed. The instance stays online.
+    def backup_binlogs(self):
+        self.__start_run('binlog')
+        if not self.__lock_instance():
+            self.__finish_run(False)
+            return False
+        try:
+            for fn in [self.__copy_binlogs, self.__add_binlogs_to_catalog]:
+                if not self.metrics.run_step(fn):
+                    _print(F"{Fore.RED}Binlog backup aborted.{Style.RESET_ALL}")
+                    return False
+            self.metrics.bytes_written = Path(self.binlog_file_path).stat().st_size
+            self.__finish_run(True)
+            return round(self.metrics.bytes_written / 1000000, 2)
+        except:
+            self.exceptions.update({'backup_binlogs': traceback.format_exc()})
+            return False
+        finally:
+            self.__finish_run(False)
+            self.__unlock_instance()
 
+    # Restore a backup. If a target time is given, the binary logs backed up since the backup are replayed on top of it
+    # up to that time. A shadow restore loads the backup into shadow databases while the instance keeps running and
+    # only enables maintenance mode to swap them in and import the config.
+    def restore_backup(self, backup_file_path, until: datetime.datetime = None, shadow_restore=False) -> bool:
+        self.__prepare_restore(backup_file_path)
+        self.restore_until = until
+        self.restore_shadow = shadow_restore
+        # The config is collected while the backup is read and uploaded into the container in one piece
+        self.__config_tar = tempfile.SpooledTemporaryFile(max_size=16 * 1024 * 1024)
+
+        # The backup is verified before the instance is taken offline
         restore_functions = [
-            self.__untar_backup,
+            self.__verify_backup,
             self.__enable_maintenance_mode,
             self.__import_db,
             self.__import_config,
-            self.__disable_maintenance_mode,
-            self.__delete_tmp_dir
+            self.__disable_maintenance_mode
         ]
+        if Repository.is_snapshot(backup_file_path):
+            restore_functions.insert(1, self.__restore_snapshot_config)
+        if until:
+            restore_functions.insert(restore_functions.index(self.__import_db) + 1, self.__replay_binlogs)
+        if shadow_restore:
+            restore_functions.remove(self.__enable_maintenance_mode)
+            restore_functions.insert(restore_functions.index(self.__import_config), self.__enable_maintenance_mode)
+            restore_functions.insert(restore_functions.index(self.__import_config), self.__swap_databases)
 
-        if self.__create_tmp_dir():
-            try:
-                for fn in restore_functions:
-                    if not fn():
-                        return False
-                return True
-            except:
-                self.exceptions.update({'restore': traceback.format_exc()})
-                return False
-        else:
-            _print(F"{Fore.RED}Could not create temporary folder. Restore aborted.{Style.RESET_ALL}")
+        try:
+            return self.__run_restore(restore_functions)
+        finally:
+            self.__config_tar.close()
+            if shadow_restore:
+                self.__drop_shadow_databases()
+
+    # Swap the databases replaced by the last shadow restore back in. The restored tables take their place, so a second
+    # rollback undoes the first one. The config stays as it was restored.
+    def rollback_restore(self) -> bool:
+        self.__start_run('restore')
+        if not self.__lock_instance():
+            self.__finish_run(False)
             return False
+        try:
+            for fn in [self.__enable_maintenance_mode, self.__swap_previous_databases, self.__disable_maintenance_mode]:
+                if not self.metrics.run_step(fn):
+                    return False
+            self.__finish_run(True)
+            return True
+        except:
+            self.exceptions.update({'rollback_restore': traceback.format_exc()})
+            return False
+        finally:
+            self.__finish_run(False)
+            self.__unlock_instance()
+
+    # Restore a single table, given as "table" or "database.table", from a backup
+    def restore_table(self, backup_file_path, table) -> bool:
+        self.__prepare_restore(backup_file_path)
+        database, _, self.restore_table_name = table.rpartition('.')
+        self.restore_database = database or None
+        return self.__run_restore([
+            self.__verify_backup,
+            self.__enable_maintenance_mode,
+            self.__import_table,
+            self.__disable_maintenance_mode
+        ])
+
+    # Restore a single file of the Nextcloud directory, e.g. config/config.php, from a backup
+    def restore_file(self, backup_file_path, file_name) -> bool:
+        self.__prepare_restore(backup_file_path)
+        self.restore_file_name = file_name.strip('/')
+        return self.__run_restore([
+            self.__verify_backup,
+            self.__import_file
+        ])
+
+    def __prepare_restore(self, backup_file_path):
+        self.backup_file_path = backup_file_path
+        name = backup_name(backup_file_path)
+        self.restore_dump_file = name + ".sql"
+        self.restore_tar_file = os.path.basename(backup_file_path)
+        self.restore_tables_dir = name + ".tables"
+        self.restore_tar_file_path = backup_file_path
+        self.restore_shadow = False
+        self.__shadow_databases = []
+
+    def __run_restore(self, restore_functions) -> bool:
+        self.__start_run('restore')
+        if not self.__lock_instance():
+            self.__finish_run(False)
+            return False
+        try:
+            if not Repository.is_snapshot(self.backup_file_path):
+                self.metrics.bytes_read = os.path.getsize(self.backup_file_path)
+            for fn in restore_functions:
+                if not self.metrics.run_step(fn):
+                    return False
+            self.__finish_run(True)
+            return True
+        except:
+            self.exceptions.update({'restore': traceback.format_exc()})
+            return False
+        finally:
+            self.__finish_run(False)
+            self.__unlock_instance()
 
     def upgrade(self) -> int:
 
@@ -329,50 +1560,356 @@ class Container:
             self.__disable_maintenance_mode,
         ]
 
-        if self.__pull_images():
-            for fn in upgrade_functions:
-                if not fn():
+        self.__start_run('upgrade')
+        try:
+            update_required = self.metrics.run_step(self.__check_for_updates)
+            # The check itself failed, which is not the same as no update being available
+            if update_required is None:
+                if self.maintenance_enabled:
+                    self.metrics.run_step(self.__disable_maintenance_mode)
+                return 0
+            if update_required:
+                for fn in upgrade_functions:
+                    if not self.metrics.run_step(fn):
+                        return 0
+            else:
+                # Maintenance mode may still be enabled from the backup made before the upgrade
+                if self.maintenance_enabled and not self.metrics.run_step(self.__disable_maintenance_mode):
                     return 0
-        else:
-            return 2
-        return 1
+                self.__finish_run(True)
+                return 2
+            self.__finish_run(True)
+            return 1
+        finally:
+            self.__finish_run(False)
+
+    # Start collecting the metrics of a backup, restore or upgrade run
+    def __start_run(self, operation: str):
+        self.metrics = metrics.RunMetrics(self.name, operation)
+        self.maintenance_duration = 0.0
+
+    # Finish the metrics of the current run. Only the first call of a run counts.
+    def __finish_run(self, success: bool):
+        if self.metrics.finished:
+            return
+        self.__stop_maintenance_clock()
+        self.metrics.maintenance_duration = self.maintenance_duration
+        self.metrics.throttled_duration = self.throttle.waited
+        self.metrics.finish(success)
 
+    # Delete the backups the retention policy and the size budget of the backup dir don't keep. All of them are chosen
+    # in one pass over the catalog and removed in one batch; with --dryrun they are only listed.
     def cleanup(self):
         if not utils.no_cleanup:
-            deleted_files = 0
-            backup_dir = os.scandir(self.backup_dir)
-            backup_files = [file for file in backup_dir if
-                            file.is_file() and file.name.startswith(self.name) and file.name.endswith(".tar.gz")]
+            with backup_dir_lock(self.backup_dir):
+                keep, expired = self.retention_policy.apply(self.__catalog_backups())
+                if self.size_budget:
+                    expired_paths = {backup['path'] for backup in expired}
+                    archives = [backup for backup in self.catalog.backups()
+                                if backup['format'] != 'repository' and backup['path'] not in expired_paths]
+                    # Other instances in the same backup dir count towards the budget but clean up their own backups,
+                    # together with their data snapshots and binlog archives
+                    expired += retention.over_budget(archives, self.size_budget, self.name)
+                expired = self.__unreferenced(expired)
+                expired_binlogs = self.__expired_binlogs(expired) if self.binlog else []
+                expired_data = self.__expired_data(expired) if self.data else []
+
+                if utils.dry_run:
+                    for path in [backup['path'] for backup in expired + expired_binlogs] + expired_data:
+                        _print(F"{Fore.YELLOW}Would delete {path}{Style.RESET_ALL}")
+                    if self.target:
+                        self.__cleanup_target()
+                    return
+
+                paths = [backup['path'] for backup in expired]
+                failed = retention.remove_files(paths)
+                retention.remove_files([archive.checksum_path(path) for path in paths if path not in failed])
+                self.catalog.remove([path for path in paths if path not in failed])
+                deleted_files = len(paths) - len(failed)
+
+                binlog_paths = [backup['path'] for backup in expired_binlogs]
+                failed_binlogs = retention.remove_files(binlog_paths)
+                retention.remove_files([archive.checksum_path(path) for path in binlog_paths
+                                        if path not in failed_binlogs])
+                if binlog_paths:
+                    self.binlog_catalog.remove([path for path in binlog_paths if path not in failed_binlogs])
+                deleted_files += len(binlog_paths) - len(failed_binlogs)
+                failed += failed_binlogs
+
+                failed_data = retention.remove_trees(expired_data)
+                deleted_files += len(expired_data) - len(failed_data)
+                failed += failed_data
 
-            while len(backup_files) > self.number_of_backups:
-                del_file = min(backup_files, key=os.path.getctime)
-                backup_files.remove(del_file)
-                os.remove(del_file)
-                deleted_files += 1
+                # Delete the chunks only the removed snapshots referred to
+                if self.repository and deleted_files:
+                    deleted_chunks = self.repository.collect_garbage()
+                    _print(F"{Fore.YELLOW}Deleted {deleted_chunks} unreferenced chunks.{Style.RESET_ALL}")
 
             if deleted_files == 1:
                 _print(F"{Fore.YELLOW}Deleted 1 old backup file.{Style.RESET_ALL}")
             elif deleted_files >= 1:
                 _print(F"{Fore.YELLOW}Deleted {deleted_files} old backup files.{Style.RESET_ALL}")
+            for path in failed:
+                _print(F"{Fore.RED}Could not delete {path}{Style.RESET_ALL}")
+
+            if self.target:
+                self.__cleanup_target()
+
+    # The expired backups without those that hold unchanged tables of a backup that is kept
+    def __unreferenced(self, expired: list) -> list:
+        expired_paths = {backup['path'] for backup in expired}
+        referenced = {entry['archive'] for backup in self.catalog.backups() if backup['path'] not in expired_paths
+                      for entry in (backup['tables'] or {}).values()}
+        return [backup for backup in expired if backup['file_name'] not in referenced]
+
+    # Binlog archives made before the oldest full backup that is kept. The logs a full backup is replayed with are all
+    # closed after it was made, so they are in later archives.
+    def __expired_binlogs(self, expired: list) -> list:
+        expired_paths = {backup['path'] for backup in expired}
+        kept = [backup['created'] for backup in self.__catalog_backups() if backup['path'] not in expired_paths]
+        if not kept:
+            return []
+        return [backup for backup in self.__binlog_backups() if backup['created'] < min(kept)]
+
+    # Data snapshots of the expired backups, and snapshots left behind by failed backups that are older than every
+    # backup that is kept. The snapshot unchanged files are linked from next time is never chosen.
+    def __expired_data(self, expired: list) -> list:
+        folder = datadir.data_dir(self.backup_dir)
+        if not os.path.isdir(folder):
+            return []
+        expired_names = {backup_name(backup['path']) for backup in expired}
+        kept = {backup_name(backup['path']) for backup in self.__catalog_backups()} - expired_names
+        protected = kept | {self.data_index.snapshot()}
+        snapshots = []
+        for entry in sorted(os.scandir(folder), key=lambda entry: entry.name):
+            parsed = parse_name(entry.name)
+            if not entry.is_dir() or not parsed or parsed[0] != self.name or entry.name in protected:
+                continue
+            if entry.name in expired_names or (kept and entry.name < min(kept)):
+                snapshots.append(entry.path)
+        return snapshots
+
+    # Apply the retention policy and the size budget of the storage target to the backups stored there
+    def __cleanup_target(self):
+        try:
+            files = self.target.list()
+            backups = []
+            for file in files:
+                parsed = parse_name(archive.strip_extension(file['name'])) if archive.is_backup(file['name']) else None
+                if parsed:
+                    backups.append({'path': file['name'], 'instance': parsed[0], 'created': parsed[1],
+                                    'size': file['size']})
+            keep, expired = self.retention_policy.apply([backup for backup in backups
+                                                         if backup['instance'] == self.name])
+            if self.target.size_budget:
+                expired_names = {backup['path'] for backup in expired}
+                expired += retention.over_budget([backup for backup in backups if backup['path'] not in expired_names],
+                                                 self.target.size_budget, self.name)
+            # Archives the local catalog lists as holding unchanged tables of a kept backup are kept on the target too
+            expired_names = {backup['path'] for backup in expired}
+            referenced = {entry['archive'] for backup in self.catalog.backups()
+                          if backup['file_name'] not in expired_names for entry in (backup['tables'] or {}).values()}
+            names = [backup['path'] for backup in expired if backup['path'] not in referenced]
+            if utils.dry_run:
+                for name in names:
+                    _print(F"{Fore.YELLOW}Would delete {name} from {self.target.url}{Style.RESET_ALL}")
+                return
+            existing = {file['name'] for file in files}
+            failed = self.target.delete(names + [archive.checksum_path(name) for name in names
+                                                 if archive.checksum_path(name) in existing])
+            deleted = len([name for name in names if name not in failed])
+            if deleted:
+                _print(F"{Fore.YELLOW}Deleted {deleted} old backup files from {self.target.url}.{Style.RESET_ALL}")
+            for name in failed:
+                _print(F"{Fore.RED}Could not delete {name} from {self.target.url}{Style.RESET_ALL}")
+        except:
+            _print(F"{Fore.RED}Could not clean up {self.target.url}{Style.RESET_ALL}")
+            self.exceptions.update({'__cleanup_target': traceback.format_exc()})
+
+    # Return all backups of this instance as a dict of file name -> path
+    def backup_files(self) -> dict:
+        return {backup['file_name']: backup['path'] for backup in self.__catalog_backups()}
+
+    # Path of the last backup of this instance made before the given time, None if there is none
+    def last_backup_before(self, until: datetime.datetime):
+        backups = [backup for backup in self.__catalog_backups()
+                   if backup['created'] <= until.isoformat(timespec='seconds')]
+        return backups[-1]['path'] if backups else None
+
+    # Catalog entries of the binlog archives of this instance, oldest first
+    def __binlog_backups(self) -> list:
+        if not self.binlog_catalog.exists() and os.path.isdir(self.binlog_catalog.backup_dir):
+            self.binlog_catalog.reindex({self.name: self.encryption})
+        return self.binlog_catalog.backups(self.name)
+
+    # Catalog entries of the backups of this instance and layout, oldest first. A backup dir without a catalog is
+    # indexed on first use.
+    def __catalog_backups(self) -> list:
+        if not self.catalog.exists():
+            self.catalog.reindex({self.name: self.encryption})
+        return [backup for backup in self.catalog.backups(self.name)
+                if (backup['format'] == 'repository') == bool(self.repository)]
+
+    # Record the new backup in the catalog of the backup dir
+    def __add_to_catalog(self) -> bool:
+        try:
+            if self.repository:
+                members = [member['name'] for member in self.__snapshot_members]
+                compression_format = 'repository'
+            else:
+                members = self.__archive_members
+                compression_format = self.compression.format
+            # Backups made before the catalog existed are indexed first
+            if not self.catalog.exists():
+                self.catalog.reindex({self.name: self.encryption})
+            created = datetime.datetime.strptime(self.__datetime, DATETIME_FORMAT)
+            self.catalog.add(self.archive_file_path, self.name, created, compression_format, members, self.checksum,
+                             self.__tables)
+            self.__catalogued = True
+            _print(F"Add backup to catalog: {self.SUCCESS}")
+            return True
+        except:
+            _print(F"Add backup to catalog: {self.FAILED}")
+            self.exceptions.update({'__add_to_catalog': traceback.format_exc()})
+            return False
 
     @staticmethod
     def instantiate_containers(data: dict) -> dict:
-        containers = {}
-        for name, values in data['nextcloud_containers'].items():
-            containers.update({name: Container(
-                name,
-                values['mysql_root_password'],
-                values['app_container'],
-                values['db_container'],
-                values['backup_dir'],
-                values['docker_compose_file_path'],
-                values['number_of_backups'])
-            })
-        return containers
+        return {name: Container.instantiate_container(data, name) for name in data['nextcloud_containers']}
+
+    # Create the container of one instance from the config
+    @staticmethod
+    def instantiate_container(data: dict, name: str) -> 'Container':
+        values = data['nextcloud_containers'][name]
+        return Container(
+            name,
+            values['mysql_root_password'],
+            values['app_container'],
+            values['db_container'],
+            values['backup_dir'],
+            values['docker_compose_file_path'],
+            values['number_of_backups'],
+            values.get('stream_dump', False),
+            archive.Compression.from_config(values.get('compression')),
+            values.get('online_snapshot', False),
+            values.get('db_host'),
+            values.get('layout', 'archive'),
+            values.get('parallel_dump', 0),
+            retention.Policy.from_config(values.get('retention'), values['number_of_backups']),
+            Container.__size_budget(data, values['backup_dir']),
+            Throttle.from_config(values.get('throttle')),
+            storage.Target.from_config(values.get('target')),
+            crypto.Encryption.from_config(values.get('encryption')),
+            binlog.Binlog.from_config(values.get('binlog')),
+            datadir.DataBackup.from_config(values.get('data')),
+            values.get('skip_unchanged', False))
+
+    # Size budget configured for a backup dir
+    @staticmethod
+    def __size_budget(data: dict, backup_dir: str):
+        for path, budget in (data.get('size_budgets') or {}).items():
+            if os.path.realpath(path) == os.path.realpath(backup_dir):
+                return budget
+        return None
+
+
+# Feeds SQL into a mysql client in the database container. Writes go through a bounded queue to a feeder thread, so
+# several imports can be fed from one archive at the same time without buffering more than a few chunks each.
+class DatabaseImport:
+
+    def __init__(self, db_container, password, database=None, progress=None, prefix=b"", max_chunks=8) -> None:
+        self.progress = progress
+        command = ["mysql", "--user=root", "--password=" + password]
+        self.__process = docker_api.client().exec_stream(db_container, command + ([database] if database else []),
+                                                         stdin=True, echo_stderr=False)
+        self.__queue = queue.Queue(maxsize=max_chunks)
+        self.__broken = False
+        self.__feeder = threading.Thread(target=self.__feed, daemon=True)
+        self.__feeder.start()
+        if prefix:
+            self.write(prefix)
+
+    def __feed(self):
+        while True:
+            data = self.__queue.get()
+            if data is None:
+                break
+            if self.__broken:
+                continue
+            try:
+                self.__process.stdin.write(data)
+                if self.progress:
+                    self.progress.update(len(data))
+            except OSError:
+                # mysql gave up, its error message tells why
+                self.__broken = True
+        self.__process.stdin.close()
+
+    def write(self, data: bytes):
+        self.__queue.put(data)
+
+    # Wait for mysql to finish and raise if the import failed
+    def close(self):
+        self.__queue.put(None)
+        self.__feeder.join()
+        returncode = self.__process.wait()
+        errors = self.__process.stderr_output
+        if returncode != 0 or 'ERROR' in errors:
+            raise Exception(F"mysql import failed with exit code {returncode}: {errors}")
+
+    # Stop an unfinished import
+    def abort(self):
+        self.__broken = True
+        if self.__process.poll() is None:
+            self.__process.kill()
+        self.__queue.put(None)
+        self.__feeder.join()
+        self.__process.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+# Imports whose data has been read completely, mysql loads what is still queued while the archive is read on. At most
+# max_imports of them are waited for at once, add() blocks while that many are loading.
+class FinishingImports:
+
+    def __init__(self, max_imports: int) -> None:
+        self.__max_imports = max_imports
+        self.__executor = ThreadPoolExecutor(max_workers=max_imports)
+        self.__imports = []
+
+    def add(self, import_db: DatabaseImport):
+        self.__imports.append((import_db, self.__executor.submit(import_db.close)))
+        while len(self.__imports) > self.__max_imports:
+            self.__imports.pop(0)[1].result()
+
+    # Wait for all imports and raise if one of them failed
+    def close(self):
+        while self.__imports:
+            self.__imports.pop(0)[1].result()
+        self.__executor.shutdown()
+
+    # Stop the imports that are still loading
+    def abort(self):
+        for import_db, future in self.__imports:
+            if not future.done():
+                import_db.abort()
+        self.__imports = []
+        self.__executor.shutdown()
 
 
 class Log:
 
+    # Serializes log writes of concurrently running jobs within this process
+    __lock = threading.Lock()
+
     def __init__(self, log_dir):
         self.log_dir = log_dir
         self.__log_file = 'nextcloud_docker_scripts.log'
@@ -385,7 +1922,9 @@ class Log:
         entry = dt + "  ;  " + message + "\n"
         if self.__check_log_dir():
             try:
-                with open(self.__log_file_path, "a+") as log_file:
+                with Log.__lock, open(self.__log_file_path, "a+") as log_file:
+                    # Also lock the file against other processes writing to the same log
+                    fcntl.flock(log_file, fcntl.LOCK_EX)
                     log_file.writelines(entry)
                 return True
             except:
@@ -0,0 +1,203 @@
+import io
+import threading
+import traceback
+from collections import deque
+
+import utils
+
+# Chunks a channel holds before its producer has to wait
+MAX_CHUNKS = 8
+
+# Writes into a channel are collected into chunks of this size
+CHUNK_SIZE = 1024 * 1024
+
+
+# Raised in the stages of a pipeline that has been aborted because another stage failed
+class PipelineAborted(Exception):
+    pass
+
+
+# Bounded queue of byte chunks between two stages. An empty chunk marks the end of the stream.
+class Channel:
+
+    def __init__(self, pipeline: 'Pipeline', max_chunks: int = MAX_CHUNKS) -> None:
+        self.__pipeline = pipeline
+        self.__max_chunks = max_chunks
+        self.__chunks = deque()
+        self.__closed = False
+        self.__condition = threading.Condition()
+
+    def put(self, data):
+        if not data:
+            return
+        with self.__condition:
+            while len(self.__chunks) >= self.__max_chunks and not self.__pipeline.aborted:
+                self.__condition.wait()
+            if self.__pipeline.aborted:
+                raise PipelineAborted()
+            self.__chunks.append(data)
+            self.__condition.notify_all()
+
+    # Next chunk, b'' once the producer has closed the channel and everything was read
+    def get(self) -> bytes:
+        with self.__condition:
+            while not self.__chunks and not self.__closed and not self.__pipeline.aborted:
+                self.__condition.wait()
+            if self.__pipeline.aborted:
+                raise PipelineAborted()
+            if not self.__chunks:
+                return b''
+            data = self.__chunks.popleft()
+            self.__condition.notify_all()
+            return data
+
+    def close(self):
+        with self.__condition:
+            self.__closed = True
+            self.__condition.notify_all()
+
+    # Let waiting stages notice that the pipeline was aborted
+    def wake(self):
+        with self.__condition:
+            self.__condition.notify_all()
+
+    def __iter__(self):
+        return iter(self.get, b'')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+
+# Raw file object that reads from a channel, wrap it into an io.BufferedReader
+class ChannelReader(io.RawIOBase):
+
+    def __init__(self, channel: Channel) -> None:
+        super().__init__()
+        self.channel = channel
+        self.__chunk = memoryview(b'')
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        if not self.__chunk:
+            self.__chunk = memoryview(self.channel.get())
+        size = min(len(buffer), len(self.__chunk))
+        buffer[:size] = self.__chunk[:size]
+        self.__chunk = self.__chunk[size:]
+        return size
+
+
+# File object that writes into a channel. Small writes, e.g. of a compressor, are collected into larger chunks.
+class ChannelWriter:
+
+    def __init__(self, channel: Channel, chunk_size: int = CHUNK_SIZE) -> None:
+        self.channel = channel
+        self.chunk_size = chunk_size
+        self.__buffer = bytearray()
+        self.closed = False
+
+    def write(self, data) -> int:
+        self.__buffer += data
+        if len(self.__buffer) >= self.chunk_size:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if self.__buffer:
+            self.channel.put(self.__buffer)
+            self.__buffer = bytearray()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.flush()
+            self.channel.close()
+
+
+# Runs the stages of a backup at the same time, each in its own thread, connected by bounded channels. A stage is a
+# function that returns True on success. The traceback of a stage that raises is added to the exceptions dict under
+# its name. As soon as one stage fails, the pipeline is aborted: waiting stages raise PipelineAborted and the abort
+# callbacks stop work that doesn't wait on a channel, e.g. by killing a dump.
+class Pipeline:
+
+    def __init__(self, exceptions: dict) -> None:
+        self.exceptions = exceptions
+        self.aborted = False
+        self.__channels = []
+        self.__callbacks = []
+        self.__threads = []
+        self.__results = {}
+        self.__lock = threading.Lock()
+
+    def channel(self, max_chunks: int = MAX_CHUNKS) -> Channel:
+        channel = Channel(self, max_chunks)
+        with self.__lock:
+            self.__channels.append(channel)
+        return channel
+
+    # Call a function when the pipeline is aborted
+    def on_abort(self, callback):
+        with self.__lock:
+            self.__callbacks.append(callback)
+
+    def abort(self):
+        with self.__lock:
+            if self.aborted:
+                return
+            self.aborted = True
+            channels, callbacks = list(self.__channels), list(self.__callbacks)
+        for channel in channels:
+            channel.wake()
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                pass
+
+    def __run_stage(self, thread: threading.Thread, fn, args, name: str, buffer):
+        # The output of a stage belongs to the job that runs the pipeline
+        utils.set_output_buffer(buffer)
+        result = False
+        try:
+            result = bool(fn(*args))
+        except PipelineAborted:
+            pass
+        except Exception:
+            self.exceptions.update({name: traceback.format_exc()})
+        finally:
+            self.__results[thread] = result
+            if not result:
+                self.abort()
+
+    # Start a stage and return its thread
+    def start(self, fn, *args, name: str = None) -> threading.Thread:
+        buffer = utils.output_buffer()
+        thread = threading.Thread(target=lambda: self.__run_stage(thread, fn, args, name or fn.__name__, buffer),
+                                  daemon=True)
+        with self.__lock:
+            self.__threads.append(thread)
+        thread.start()
+        return thread
+
+    # Wait for a stage and return whether it succeeded
+    def join(self, thread: threading.Thread) -> bool:
+        thread.join()
+        return self.__results.get(thread, False)
+
+    # Run stages at the same time and wait for all of them. Returns True if all of them succeeded.
+    def run(self, stages: list) -> bool:
+        threads = [self.start(fn, *args, name=name) for name, fn, args in stages]
+        return all([self.join(thread) for thread in threads])
+
+    # Abort what is still running and wait for all stages to end
+    def shutdown(self):
+        with self.__lock:
+            threads = list(self.__threads)
+        if any(thread.is_alive() for thread in threads):
+            self.abort()
+        for thread in threads:
+            thread.join()
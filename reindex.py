@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+from pathlib import Path
+import yaml
+from colorama import Fore, Style
+import utils
+from utils import _print
+from catalog import Catalog
+from crypto import Encryption
+import binlog
+
+
+def reindex():
+
+    # Set flags
+    utils.set_flags(sys.argv)
+
+    # Load configuration
+    config = Path(__file__).parent / "config.yml"
+    with open(config) as file:
+        config_list = yaml.full_load(file)
+
+    # Rebuild the catalog of every backup dir once, even if several instances share it. If any container names were
+    # passed as parameters, only their backup dirs are reindexed.
+    containers = config_list['nextcloud_containers']
+    names = [name for name in containers if name in sys.argv] or list(containers)
+    backup_dirs = dict.fromkeys(os.path.realpath(containers[name]['backup_dir']) for name in names)
+    # Encrypted backups can only be read with the key of their instance
+    encryptions = {name: Encryption.from_config(values.get('encryption')) for name, values in containers.items()}
+
+    # Binlog archives have a catalog of their own
+    backup_dirs.update((binlog.binlog_dir(backup_dir), None) for backup_dir in list(backup_dirs)
+                       if os.path.isdir(binlog.binlog_dir(backup_dir)))
+
+    status = True
+    for backup_dir in backup_dirs:
+        try:
+            catalog = Catalog(backup_dir)
+            count = catalog.reindex(encryptions)
+            _print(F"{Fore.GREEN}Indexed {count} backups in {backup_dir}{Style.RESET_ALL}")
+            for path in catalog.skipped:
+                _print(F"{Fore.YELLOW}Skipped unreadable backup {path}{Style.RESET_ALL}")
+        except Exception as e:
+            _print(F"{Fore.RED}Could not index {backup_dir}: {e}{Style.RESET_ALL}")
+            status = False
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(0 if reindex() else 1)
@@ -0,0 +1,184 @@
+import datetime
+import hashlib
+import io
+import json
+import os
+import stat
+import tarfile
+import time
+import zlib
+
+from archive import rebase_name
+
+# Content defined chunking: a chunk ends after the first line whose checksum matches the mask once the chunk has
+# reached MIN_CHUNK_SIZE. Cutting at line boundaries chosen by their content keeps chunk boundaries stable when rows
+# are inserted or deleted elsewhere in a dump, so unchanged parts produce the same chunks every night.
+MIN_CHUNK_SIZE = 512 * 1024
+MAX_CHUNK_SIZE = 4 * 1024 * 1024
+CHUNK_MASK = 0xfff
+
+MANIFEST_VERSION = 1
+
+
+# Split a binary stream into content defined chunks
+def chunk_stream(stream):
+    buffer = bytearray()
+    while True:
+        line = stream.readline(MAX_CHUNK_SIZE)
+        if not line:
+            break
+        buffer += line
+        if len(buffer) >= MAX_CHUNK_SIZE or (
+                len(buffer) >= MIN_CHUNK_SIZE and zlib.crc32(line) & CHUNK_MASK == 0):
+            yield bytes(buffer)
+            buffer.clear()
+    if buffer:
+        yield bytes(buffer)
+
+
+# Content addressed backup repository. Every chunk is stored once under its SHA-256 and every backup is a snapshot
+# manifest listing the chunks of its files. The layout inside the backup dir is:
+#   chunks/<first two hex digits>/<sha256>   zlib compressed chunk
+#   snapshots/<instance>_<datetime>.json     snapshot manifest
+class Repository:
+
+    def __init__(self, path, compression_level=6) -> None:
+        self.path = path
+        self.chunks_dir = os.path.join(path, 'chunks')
+        self.snapshots_dir = os.path.join(path, 'snapshots')
+        self.compression_level = compression_level
+        self.new_chunks = 0
+        self.new_bytes = 0
+
+    def __chunk_path(self, chunk_id: str) -> str:
+        return os.path.join(self.chunks_dir, chunk_id[:2], chunk_id)
+
+    def snapshot_path(self, name: str) -> str:
+        return os.path.join(self.snapshots_dir, name + '.json')
+
+    # Store a chunk unless it is already in the repository and return its id
+    def put_chunk(self, data: bytes) -> str:
+        chunk_id = hashlib.sha256(data).hexdigest()
+        chunk_path = self.__chunk_path(chunk_id)
+        if not os.path.isfile(chunk_path):
+            os.makedirs(os.path.dirname(chunk_path), exist_ok=True)
+            compressed = zlib.compress(data, self.compression_level)
+            tmp_path = chunk_path + '.tmp'
+            with open(tmp_path, 'wb') as chunk_file:
+                chunk_file.write(compressed)
+            os.chmod(tmp_path, stat.S_IREAD)
+            os.replace(tmp_path, chunk_path)
+            self.new_chunks += 1
+            self.new_bytes += len(compressed)
+        return chunk_id
+
+    def get_chunk(self, chunk_id: str) -> bytes:
+        with open(self.__chunk_path(chunk_id), 'rb') as chunk_file:
+            data = zlib.decompress(chunk_file.read())
+        if hashlib.sha256(data).hexdigest() != chunk_id:
+            raise Exception(F"Chunk {chunk_id} is corrupt")
+        return data
+
+    # Store a stream and return the manifest entry of a file with its content
+    def put_stream(self, name: str, stream, mode=0o600) -> dict:
+        chunks = []
+        size = 0
+        for data in chunk_stream(stream):
+            chunks.append(self.put_chunk(data))
+            size += len(data)
+        return {'name': name, 'type': 'file', 'mode': mode, 'size': size, 'chunks': chunks}
+
+    # Store the members of a tarball that is read sequentially and return their manifest entries, named below arcname
+    # instead of their top level directory
+    def put_tar(self, tarball: tarfile.TarFile, arcname: str) -> list:
+        members = []
+        for member in tarball:
+            name = rebase_name(member.name, arcname)
+            if member.isdir():
+                members.append({'name': name, 'type': 'dir', 'mode': member.mode})
+            elif member.isfile():
+                members.append(self.put_stream(name, tarball.extractfile(member), member.mode))
+        return members
+
+    # Yield the content of a file member chunk by chunk
+    def read_member(self, member: dict):
+        for chunk_id in member['chunks']:
+            yield self.get_chunk(chunk_id)
+
+    # Add all members whose name starts with prefix to a tarball and return the number of members added
+    def write_tar(self, manifest: dict, tarball: tarfile.TarFile, prefix: str = '') -> int:
+        count = 0
+        for member in manifest['members']:
+            if not member['name'].startswith(prefix):
+                continue
+            info = tarfile.TarInfo(member['name'].lstrip('/'))
+            info.mode = member['mode']
+            info.mtime = int(time.time())
+            if member['type'] == 'dir':
+                info.type = tarfile.DIRTYPE
+                tarball.addfile(info)
+            else:
+                info.size = member['size']
+                tarball.addfile(info, io.BytesIO(b''.join(self.read_member(member))))
+            count += 1
+        return count
+
+    # Return the chunks of a snapshot that are missing, or with deep=True also the ones that are corrupt
+    def check(self, manifest: dict, deep: bool = False) -> list:
+        bad = []
+        for chunk_id in dict.fromkeys(c for member in manifest['members'] for c in member.get('chunks', [])):
+            try:
+                if deep:
+                    self.get_chunk(chunk_id)
+                elif not os.path.isfile(self.__chunk_path(chunk_id)):
+                    bad.append(chunk_id)
+            except Exception:
+                bad.append(chunk_id)
+        return bad
+
+    def write_snapshot(self, name: str, instance: str, members: list) -> str:
+        os.makedirs(self.snapshots_dir, exist_ok=True)
+        manifest = {
+            'version': MANIFEST_VERSION,
+            'instance': instance,
+            'created': datetime.datetime.now().isoformat(timespec='seconds'),
+            'members': members,
+        }
+        snapshot_path = self.snapshot_path(name)
+        with open(snapshot_path + '.tmp', 'w') as snapshot_file:
+            json.dump(manifest, snapshot_file)
+        os.replace(snapshot_path + '.tmp', snapshot_path)
+        return snapshot_path
+
+    @staticmethod
+    def read_snapshot(snapshot_path: str) -> dict:
+        with open(snapshot_path) as snapshot_file:
+            return json.load(snapshot_file)
+
+    # Snapshot manifest paths of all instances or of one instance only
+    def snapshots(self, instance: str = None) -> list:
+        if not os.path.isdir(self.snapshots_dir):
+            return []
+        return [entry.path for entry in os.scandir(self.snapshots_dir)
+                if entry.is_file() and entry.name.endswith('.json')
+                and (instance is None or self.read_snapshot(entry.path)['instance'] == instance)]
+
+    # Delete all chunks no snapshot refers to any more and return the number of deleted chunks
+    def collect_garbage(self) -> int:
+        referenced = set()
+        for snapshot_path in self.snapshots():
+            for member in self.read_snapshot(snapshot_path)['members']:
+                referenced.update(member.get('chunks', []))
+        deleted = 0
+        if not os.path.isdir(self.chunks_dir):
+            return deleted
+        for prefix in os.scandir(self.chunks_dir):
+            for chunk in os.scandir(prefix.path):
+                if chunk.name not in referenced:
+                    os.remove(chunk.path)
+                    deleted += 1
+        return deleted
+
+    @staticmethod
+    def is_snapshot(path: str) -> bool:
+        return path.endswith('.json') and os.path.basename(os.path.dirname(path)) == 'snapshots'
@@ -8,6 +8,8 @@ import utils
 from utils import _print
 from models import Container
 from models import Log
+import backup
+import binlog
 from simple_term_menu import TerminalMenu
 
 
@@ -15,6 +17,17 @@ def restore():
 
     # Set flags
     utils.set_flags(sys.argv)
+    # With --table or --file only that table or file is restored from the backup
+    table = utils.get_option(sys.argv, "--table")
+    file_name = utils.get_option(sys.argv, "--file")
+    # With --shadow the backup is loaded while the instance keeps running, --rollback swaps back what it replaced
+    shadow_restore = "--shadow" in sys.argv
+    rollback = "--rollback" in sys.argv
+    # Both swap whole databases, which a restore of a single table or file doesn't load
+    if (shadow_restore or rollback) and (table or file_name):
+        _print(F"{Fore.RED}{'--shadow' if shadow_restore else '--rollback'} can't be combined with "
+               F"{'--table' if table else '--file'}.{Style.RESET_ALL}")
+        sys.exit(1)
 
     # Load config
     config = Path(__file__).parent / "config.yml"
@@ -36,6 +49,10 @@ def restore():
         choice_index = terminal_menu.show()
         containers = {containers_to_choose_from[choice_index]: containers.get(containers_to_choose_from[choice_index])}
 
+    # With --until the last backup before that time is restored and the binary logs are replayed up to it
+    until = utils.get_option(sys.argv, "--until")
+    until = binlog.parse_until(until) if until else None
+
     container: Container
     for container in containers.values():
 
@@ -43,21 +60,48 @@ def restore():
         _print("----------------------------------------------")
         _print(F"Restore backup for {container.name}")
 
-        backup_dir = os.scandir(container.backup_dir)
-        backup_files = {file.name: file for file in backup_dir if
-                        file.is_file() and file.name.startswith(container.name) and file.name.endswith(".tar.gz")}
+        if rollback:
+            if not utils.no_confirm and input(F"Are you sure that you want to swap back the databases replaced by the "
+                                              F"last restore of {container.name}? (Type: yes)\n").lower() != "yes":
+                break
+            if container.rollback_restore():
+                _print(F"{Fore.GREEN}Last restore for {container.name} successfully rolled back.{Style.RESET_ALL}")
+                _print(F"Maintenance mode was enabled for {round(container.maintenance_duration, 1)} seconds")
+                if not utils.no_log and config_list['log']['logging']:
+                    log.log(F"Roll back restore ; {container.name} ; SUCCESS")
+            else:
+                _print(F"{Fore.RED}Could not roll back the last restore for {container.name}.{Style.RESET_ALL}")
+                for func, traceback in container.exceptions.items():
+                    _print()
+                    _print(F"{Fore.YELLOW}Exception occurred in method: Container.{func}(){Style.RESET_ALL}")
+                    _print(traceback)
+                    _print()
+                if not utils.no_log and config_list['log']['logging']:
+                    log.log(F"Roll back restore ; {container.name} ; FAIL")
+            backup.write_metrics(container, config_list)
+            continue
+
+        backup_files = container.backup_files()
         if len(backup_files) < 1:
             _print(F"{Fore.YELLOW}No backups found for {container.name}{Style.RESET_ALL}")
             break
-        backup_files_to_choose_from = [file.name for file in backup_files.values()]
+        backup_files_to_choose_from = list(backup_files.keys())
         backup_files_to_choose_from.sort(reverse=True)
         _print()
 
         # Choose backup to restore from
-        terminal_menu = TerminalMenu(backup_files_to_choose_from, title="Which backup do you want to restore?")
-        choice_index = terminal_menu.show()
-        backup_file = backup_files.get(backup_files_to_choose_from[choice_index])
-        print(backup_file.path)
+        if until:
+            backup_file = container.last_backup_before(until)
+            if backup_file is None:
+                _print(F"{Fore.YELLOW}No backup of {container.name} was made before {until}{Style.RESET_ALL}")
+                break
+            backup_files_to_choose_from, choice_index = [os.path.basename(backup_file)], 0
+            _print(F"Replay the binary logs up to {until} on top of:")
+        else:
+            terminal_menu = TerminalMenu(backup_files_to_choose_from, title="Which backup do you want to restore?")
+            choice_index = terminal_menu.show()
+            backup_file = backup_files.get(backup_files_to_choose_from[choice_index])
+        print(backup_file)
 
         # Confirm restore
         if not utils.no_confirm:
@@ -66,15 +110,21 @@ def restore():
         else:
             confirm = False
 
-        # Do the restore
-        if confirm or utils.no_confirm:
-            result = container.restore_backup(backup_file.path)
-        else:
+        # Do the restore, of a single table or file if --table or --file is given
+        if not (confirm or utils.no_confirm):
             break
+        elif table:
+            result = container.restore_table(backup_file, table)
+        elif file_name:
+            result = container.restore_file(backup_file, file_name)
+        else:
+            result = container.restore_backup(backup_file, until, shadow_restore)
 
         # Print result and log
         if result:
             _print(F"{Fore.GREEN}Backup {container.restore_tar_file} for {container.name} successfully restored.{Style.RESET_ALL}")
+            if shadow_restore:
+                _print(F"Maintenance mode was enabled for {round(container.maintenance_duration, 1)} seconds")
             if not utils.no_log and config_list['log']['logging']:
                 log.log(F"Restore backup ; {container.name} ; {container.restore_tar_file_path} ; SUCCESS")
         else:
@@ -87,6 +137,8 @@ def restore():
             if not utils.no_log and config_list['log']['logging']:
                 log.log(F"Restore backup ; {container.name} ; {container.restore_tar_file_path} ; FAIL")
 
+        backup.write_metrics(container, config_list)
+
 
 if __name__ == '__main__':
     restore()
@@ -0,0 +1,114 @@
+import datetime
+import os
+import re
+import shutil
+import stat
+
+# Retention classes and the period a backup falls into for each of them
+PERIODS = {
+    'daily': lambda created: created.date(),
+    'weekly': lambda created: created.isocalendar()[:2],
+    'monthly': lambda created: (created.year, created.month),
+    'yearly': lambda created: created.year,
+}
+
+UNITS = {'': 1, 'K': 1000, 'M': 1000 ** 2, 'G': 1000 ** 3, 'T': 1000 ** 4,
+         'KI': 1024, 'MI': 1024 ** 2, 'GI': 1024 ** 3, 'TI': 1024 ** 4}
+
+
+# Parse a size like 500000, "500 MB", "1.5T" or "20 GiB" into bytes
+def parse_size(size) -> int:
+    if size is None or isinstance(size, (int, float)):
+        return size
+    match = re.fullmatch(r'\s*([0-9.]+)\s*([KMGT]I?)?B?\s*', str(size).upper())
+    if not match:
+        raise Exception(F"Invalid size: {size}")
+    return int(float(match.group(1)) * UNITS[match.group(2) or ''])
+
+
+# Grandfather-father-son retention: the newest `last` backups are kept, and for each retention class the newest backup
+# of each of the most recent `daily` days, `weekly` weeks, `monthly` months and `yearly` years.
+class Policy:
+
+    def __init__(self, last=0, daily=0, weekly=0, monthly=0, yearly=0) -> None:
+        self.last = last or 0
+        self.counts = {'daily': daily or 0, 'weekly': weekly or 0, 'monthly': monthly or 0, 'yearly': yearly or 0}
+
+    # Split backups (dicts with a 'created' datetime or ISO string) into the ones to keep and the ones to delete in a
+    # single pass from the newest to the oldest. Both lists are returned oldest first.
+    def apply(self, backups: list) -> tuple:
+        keep, delete = [], []
+        seen = {name: set() for name in PERIODS}
+        for index, backup in enumerate(sorted(backups, key=created, reverse=True)):
+            keeping = index < self.last
+            for name, period in PERIODS.items():
+                key = period(created(backup))
+                if key not in seen[name] and len(seen[name]) < self.counts[name]:
+                    seen[name].add(key)
+                    keeping = True
+            (keep if keeping else delete).append(backup)
+        return keep[::-1], delete[::-1]
+
+    @staticmethod
+    def from_config(values, number_of_backups) -> 'Policy':
+        values = values or {}
+        return Policy(values.get('last', number_of_backups), values.get('daily'), values.get('weekly'),
+                      values.get('monthly'), values.get('yearly'))
+
+
+def created(backup: dict) -> datetime.datetime:
+    value = backup['created']
+    return value if isinstance(value, datetime.datetime) else datetime.datetime.fromisoformat(value)
+
+
+# Choose the oldest backups to delete until the backups in a backup dir fit into budget bytes. The newest backup of
+# every instance is never chosen. If an instance is given, only its backups are chosen; the others still count
+# towards the budget.
+def over_budget(backups: list, budget: int, instance: str = None) -> list:
+    total = sum(backup['size'] for backup in backups)
+    if not budget or total <= budget:
+        return []
+    newest = {}
+    for backup in backups:
+        if backup['instance'] not in newest or created(backup) > created(newest[backup['instance']]):
+            newest[backup['instance']] = backup
+    protected = {id(backup) for backup in newest.values()}
+    delete = []
+    for backup in sorted(backups, key=created):
+        if total <= budget:
+            break
+        if id(backup) not in protected and instance in (None, backup['instance']):
+            delete.append(backup)
+            total -= backup['size']
+    return delete
+
+
+# Delete files and return the ones that could not be deleted. Backups are made read-only after they are written; on
+# file systems that refuse to delete read-only files they are made writable first.
+def remove_files(paths: list) -> list:
+    failed = []
+    for path in paths:
+        try:
+            try:
+                os.remove(path)
+            except PermissionError:
+                os.chmod(path, stat.S_IREAD | stat.S_IWRITE)
+                os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError:
+            failed.append(path)
+    return failed
+
+
+# Delete directory trees and return the ones that could not be deleted
+def remove_trees(paths: list) -> list:
+    failed = []
+    for path in paths:
+        try:
+            shutil.rmtree(path)
+        except FileNotFoundError:
+            pass
+        except OSError:
+            failed.append(path)
+    return failed
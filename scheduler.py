@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+
+import datetime
+import os
+import signal
+import sys
+import threading
+from pathlib import Path
+import yaml
+from colorama import Fore, Style
+import utils
+from utils import _print
+from models import Log
+from models import Container
+import backup
+from cron import CronSchedule, parse_duration, spread_offset
+from jobs import JobRunner
+from binlog import Binlog
+
+# What a schedule runs and how it is called in the output
+OPERATIONS = {'backup': "backup", 'binlog': "binlog backup"}
+
+# Seconds between two checks whether the config.yml has changed
+CONFIG_CHECK_INTERVAL = 30
+
+
+# Long-running replacement for cron jobs calling backup.py: backs up every instance that has a schedule in the
+# config.yml when it is due, and the binary logs of instances in binlog mode on their binlog schedule. Jobs are run
+# with the same concurrency limits as backup.py --jobs, an instance whose previous backup is still queued or running is
+# skipped, and the config is reloaded when it changes or on SIGHUP.
+class Scheduler:
+
+    def __init__(self, config_path: Path) -> None:
+        self.config_path = config_path
+        self.config_list = None
+        self.log = None
+        self.schedules = {}
+        self.next_runs = {}
+        self.active = set()
+        self.runner = JobRunner()
+        self.__mtime = None
+        self.__threads = []
+        self.__lock = threading.Lock()
+        self.__wake = threading.Event()
+        self.__stopping = False
+        self.__reload = False
+
+    # Load the config.yml. A broken config is reported and the previous one is kept.
+    def load(self) -> bool:
+        try:
+            mtime = os.path.getmtime(self.config_path)
+            with open(self.config_path) as file:
+                config_list = yaml.full_load(file)
+            scheduler_config = config_list.get('scheduler') or {}
+            spread = parse_duration(scheduler_config.get('spread', 0))
+            # Instances passed as parameters are scheduled alone, otherwise all instances with a schedule
+            containers = config_list['nextcloud_containers']
+            wanted = [name for name in containers if name in sys.argv] or list(containers)
+            schedules = {}
+            for name, values in containers.items():
+                offset = datetime.timedelta(seconds=spread_offset(name, spread))
+                binlog = Binlog.from_config(values.get('binlog'))
+                if values.get('schedule') and name in wanted:
+                    schedules[(name, 'backup')] = (CronSchedule(values['schedule']), offset)
+                if binlog and binlog.schedule and name in wanted:
+                    schedules[(name, 'binlog')] = (CronSchedule(binlog.schedule), offset)
+            log = Log(config_list['log']['log_dir'])
+        except Exception as e:
+            if self.config_list is None:
+                raise
+            _print(F"{Fore.RED}Could not reload {self.config_path}, keeping the previous config: {e}{Style.RESET_ALL}")
+            self.__mtime = os.path.getmtime(self.config_path) if os.path.isfile(self.config_path) else self.__mtime
+            return False
+
+        with self.__lock:
+            self.config_list, self.log, self.__mtime = config_list, log, mtime
+            # Instances whose schedule didn't change keep their next run
+            now = datetime.datetime.now()
+            next_runs = {}
+            for key, (schedule, offset) in schedules.items():
+                previous = self.schedules.get(key)
+                if previous and previous[0].expression == schedule.expression and previous[1] == offset:
+                    next_runs[key] = self.next_runs[key]
+                else:
+                    next_runs[key] = schedule.next_after(now - offset) + offset
+            self.schedules, self.next_runs = schedules, next_runs
+            concurrency = config_list.get('concurrency') or {}
+            if utils.get_option(sys.argv, "--jobs") is None:
+                utils.jobs = scheduler_config.get('jobs', 1)
+            self.runner.jobs = max(1, utils.jobs)
+            self.runner.limits = {
+                'backup_dir': concurrency.get('backup_dir', 1),
+                'db_host': concurrency.get('db_host', 1),
+            }
+        for (name, operation), moment in sorted(self.next_runs.items(), key=lambda item: item[1]):
+            _print(F"{name}: next {OPERATIONS[operation]} at {moment.strftime('%Y-%m-%d %H:%M:%S')} "
+                   F"({self.schedules[(name, operation)][0].expression})")
+        return True
+
+    def __config_changed(self) -> bool:
+        try:
+            return os.path.getmtime(self.config_path) != self.__mtime
+        except OSError:
+            return False
+
+    # Queue a backup of an instance unless one of its backups is queued or running already
+    def __queue(self, name: str, operation: str):
+        with self.__lock:
+            if name in self.active:
+                _print(F"{Fore.YELLOW}Skip {OPERATIONS[operation]} of {name}, the previous backup is still running"
+                       F"{Style.RESET_ALL}")
+                return
+            self.active.add(name)
+            thread = threading.Thread(target=self.__run, args=(name, operation, self.config_list, self.log),
+                                      daemon=True)
+            self.__threads = [t for t in self.__threads if t.is_alive()] + [thread]
+        thread.start()
+
+    def __run(self, name: str, operation: str, config_list: dict, log: Log):
+        values = config_list['nextcloud_containers'][name]
+        try:
+            # The container is only created when the job starts, so the backup is named after its real start time
+            self.runner.run(
+                [name],
+                lambda item: backup.backup_container(Container.instantiate_container(config_list, item), config_list,
+                                                     log, operation == 'binlog'),
+                lambda item: [('backup_dir', os.path.realpath(values['backup_dir'])),
+                              ('db_host', values.get('db_host') or values['db_container'])])
+        except Exception as e:
+            _print(F"{Fore.RED}{OPERATIONS[operation].capitalize()} of {name} failed: {e}{Style.RESET_ALL}")
+        finally:
+            with self.__lock:
+                self.active.discard(name)
+
+    def stop(self, *args):
+        self.__stopping = True
+        self.__wake.set()
+
+    def reload(self, *args):
+        self.__reload = True
+        self.__wake.set()
+
+    def run(self):
+        self.load()
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGHUP, self.reload)
+        _print(F"Scheduler started for {len({name for name, operation in self.schedules})} instances")
+        while not self.__stopping:
+            if self.__reload or self.__config_changed():
+                self.__reload = False
+                _print(F"Reload {self.config_path}")
+                self.load()
+            now = datetime.datetime.now()
+            for (name, operation), moment in list(self.next_runs.items()):
+                if moment <= now:
+                    self.__queue(name, operation)
+                    schedule, offset = self.schedules[(name, operation)]
+                    self.next_runs[(name, operation)] = schedule.next_after(now - offset) + offset
+            timeout = min([(moment - now).total_seconds() for moment in self.next_runs.values()] +
+                          [CONFIG_CHECK_INTERVAL])
+            self.__wake.wait(max(timeout, 0))
+            self.__wake.clear()
+
+        # Let running backups finish, so no half written archive is left behind
+        _print("Scheduler stopping, waiting for running backups")
+        for thread in self.__threads:
+            thread.join()
+
+
+def scheduler():
+
+    # Set flags
+    utils.set_flags(sys.argv)
+
+    Scheduler(Path(__file__).parent / "config.yml").run()
+
+
+if __name__ == '__main__':
+    scheduler()
@@ -0,0 +1,128 @@
+import re
+
+from archive import DUMP_SECTION, SECTION_KINDS
+
+# A shadow restore loads the backup into <database>__shadow while the instance keeps running, then swaps it in and
+# keeps the tables it replaced in <database>__previous for a rollback
+SHADOW_SUFFIX = '__shadow'
+PREVIOUS_SUFFIX = '__previous'
+
+# Databases of the server itself, they are not restored into a shadow
+SYSTEM_SCHEMAS = ('mysql', 'information_schema', 'performance_schema', 'sys')
+
+# Statements of a dump that name a database
+DATABASE_STATEMENT = re.compile(rb'^(CREATE DATABASE (?:/\*!32312 IF NOT EXISTS\*/ |IF NOT EXISTS )?|USE )'
+                                rb'`((?:[^`]|``)+)`', re.MULTILINE)
+
+# Name qualified by a database or table name, like `nextcloud`.`oc_users`
+QUALIFIED_NAME = re.compile(rb'`((?:[^`\n]|``)+)`\.`')
+
+# Start of the statements mysqldump writes the rows of a table with, the names in their values are data
+ROW_STATEMENT = re.compile(rb'(?:INSERT|REPLACE)(?: IGNORE)? INTO `(?:[^`\n]|``)+` (?:\([^)\n]*\) )?VALUES ')
+
+# MySQL limits names to 64 characters
+MAX_NAME_LENGTH = 64
+
+
+def quote(name: str) -> str:
+    return '`' + name.replace('`', '``') + '`'
+
+
+# String literal for a query
+def literal(value: str) -> str:
+    return "'" + value.replace('\\', '\\\\').replace("'", "''") + "'"
+
+
+def shadow_name(database: str) -> str:
+    return _suffixed(database, SHADOW_SUFFIX)
+
+
+def previous_name(database: str) -> str:
+    return _suffixed(database, PREVIOUS_SUFFIX)
+
+
+def _suffixed(database: str, suffix: str) -> str:
+    if len(database) + len(suffix) > MAX_NAME_LENGTH:
+        raise Exception(F"The name of database {database} is too long for a shadow restore")
+    return database + suffix
+
+
+# Moves that swap a restored database in: the live tables go to <database>__previous and the restored tables from
+# the shadow into the live database
+def swap_moves(database: str, live_tables: list, shadow_tables: list) -> list:
+    return ([(database, table, previous_name(database)) for table in live_tables]
+            + [(shadow_name(database), table, database) for table in shadow_tables])
+
+
+# Moves that swap a database with <database>__previous. The live tables are parked in the shadow, which is empty after a
+# swap, until the previous tables have left their place.
+def rollback_moves(database: str, live_tables: list, previous_tables: list) -> list:
+    parked = shadow_name(database)
+    return ([(database, table, parked) for table in live_tables]
+            + [(previous_name(database), table, database) for table in previous_tables]
+            + [(parked, table, previous_name(database)) for table in live_tables])
+
+
+# One RENAME TABLE statement for a list of (database, table, new database) moves. MySQL runs all renames of a
+# statement atomically, and later renames may use names freed by earlier ones.
+def rename_statement(moves: list) -> str:
+    return "RENAME TABLE " + ", ".join(F"{quote(database)}.{quote(table)} TO {quote(target)}.{quote(table)}"
+                                       for database, table, target in moves)
+
+
+# Passes a dump on with every database renamed to its shadow, so it is loaded next to the live databases. Each shadow
+# is dropped before it is created, which removes the leftovers of an earlier shadow restore that failed. The sections
+# of system databases are left out. The names of the databases found are added to the given list. A statement that
+# names one of them explicitly, like a view, trigger or routine, would act on the live database instead of the shadow,
+# so such a dump is refused before the statement is passed on. The dump is fed in pieces of any size.
+class ShadowFilter:
+
+    def __init__(self, write, databases: list) -> None:
+        self.write = write
+        self.databases = databases
+        self.__skipping = False
+        self.__rest = b''
+
+    def feed(self, data: bytes):
+        data = self.__rest + data
+        end = data.rfind(b'\n') + 1
+        self.__rest = data[end:]
+        self.__process(data[:end])
+
+    def close(self):
+        self.__process(self.__rest)
+        self.__rest = b''
+
+    def __process(self, data: bytes):
+        position = 0
+        for match in DUMP_SECTION.finditer(data):
+            self.__emit(data[position:match.start()])
+            position = match.start()
+            if SECTION_KINDS.get(match.group(1)) == 'database':
+                self.__skipping = match.group(2).replace(b'``', b'`').decode('utf-8') in SYSTEM_SCHEMAS
+        self.__emit(data[position:])
+
+    def __emit(self, data: bytes):
+        if data and not self.__skipping:
+            data = DATABASE_STATEMENT.sub(self.__rename, data)
+            self.__check(data)
+            self.write(data)
+
+    def __check(self, data: bytes):
+        for match in QUALIFIED_NAME.finditer(data):
+            row = ROW_STATEMENT.match(data, data.rfind(b'\n', 0, match.start()) + 1)
+            if row and row.end() <= match.start():
+                continue
+            database = match.group(1).replace(b'``', b'`').decode('utf-8', 'replace')
+            if database in self.databases:
+                raise Exception(F"The dump names the database {database} in a statement like a view, trigger or "
+                                F"routine, which would change the live database; restore it without --shadow")
+
+    def __rename(self, match) -> bytes:
+        database = match.group(2).replace(b'``', b'`').decode('utf-8')
+        if database not in self.databases:
+            self.databases.append(database)
+        name = quote(shadow_name(database)).encode('utf-8')
+        if match.group(1).startswith(b'CREATE'):
+            return b"DROP DATABASE IF EXISTS " + name + b";\n" + match.group(1) + name
+        return match.group(1) + name
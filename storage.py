@@ -0,0 +1,590 @@
+import json
+import os
+import posixpath
+import queue
+import stat
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import boto3
+    from botocore.config import Config as BotoConfig
+    from botocore.exceptions import ClientError
+except ImportError:
+    boto3 = None
+
+try:
+    import paramiko
+except ImportError:
+    paramiko = None
+
+from retention import parse_size
+
+# Size of the parts of multipart uploads. S3 allows 10000 parts per object, so this limits backups to 160 GB unless a
+# larger part_size is configured.
+PART_SIZE = 16 * 1024 * 1024
+
+# Attempts to finish an upload before giving up until the next backup
+ATTEMPTS = 3
+
+# Pieces an upload may hold in memory while the target is slower than the compression
+MAX_QUEUED = 16
+
+
+# Path of the file recording an unfinished upload of a backup
+def state_path(path: str) -> str:
+    return path + '.upload'
+
+
+def read_state(path: str) -> dict:
+    try:
+        with open(state_path(path)) as file:
+            return json.load(file)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def write_state(path: str, state: dict):
+    with open(state_path(path) + '.tmp', 'w') as file:
+        json.dump(state, file)
+    os.replace(state_path(path) + '.tmp', state_path(path))
+
+
+def remove_state(path: str):
+    try:
+        os.remove(state_path(path))
+    except FileNotFoundError:
+        pass
+
+
+# Call fn until it succeeds, waiting longer after each failed attempt
+def retry(fn, attempts: int = ATTEMPTS, delay: float = 2):
+    for attempt in range(attempts):
+        try:
+            return fn()
+        except Exception:
+            if attempt == attempts - 1:
+                raise
+            time.sleep(delay * 2 ** attempt)
+
+
+# Upload of a backup that is fed while the archive is written. A failing upload never fails the backup: the error is
+# kept, further writes are ignored and the upload is resumed from the finished archive later.
+class Upload:
+
+    def __init__(self, target, path: str, name: str) -> None:
+        self.target = target
+        self.path = path
+        self.name = name
+        self.error = None
+        self.size = 0
+        try:
+            self._start()
+        except Exception as e:
+            self.error = e
+
+    def _start(self):
+        pass
+
+    def _write(self, data: bytes):
+        raise NotImplementedError
+
+    def _close(self):
+        raise NotImplementedError
+
+    # Stop uploading, keep what was uploaded so far for a resume
+    def _stop(self):
+        pass
+
+    # Remove what was uploaded so far
+    def _discard(self):
+        pass
+
+    def write(self, data) -> int:
+        if self.error is None:
+            try:
+                self._write(bytes(data))
+                self.size += len(data)
+            except Exception as e:
+                self.error = e
+                self._stop()
+        return len(data)
+
+    # Finish the upload and return whether it is complete
+    def close(self) -> bool:
+        if self.error is None:
+            try:
+                self._close()
+                remove_state(self.path)
+                return True
+            except Exception as e:
+                self.error = e
+        self._stop()
+        return False
+
+    # Drop the upload of a backup that was discarded
+    def cancel(self):
+        self._stop()
+        try:
+            self._discard()
+        except Exception:
+            pass
+        remove_state(self.path)
+
+
+# Passes writes through to a file and to an upload
+class Tee:
+
+    def __init__(self, fileobj, upload: Upload) -> None:
+        self.fileobj = fileobj
+        self.upload = upload
+
+    def write(self, data) -> int:
+        written = self.fileobj.write(data)
+        self.upload.write(data)
+        return written
+
+    def flush(self):
+        self.fileobj.flush()
+
+
+# A place backups are copied to besides the backup dir
+class Target:
+
+    url = ''
+
+    def __init__(self, size_budget=None) -> None:
+        self.size_budget = parse_size(size_budget)
+
+    # Start an upload that is fed with the archive while it is written to path
+    def upload(self, path: str, name: str) -> Upload:
+        raise NotImplementedError
+
+    # Upload a finished file, continuing an interrupted upload of it where possible
+    def resume(self, path: str, name: str):
+        raise NotImplementedError
+
+    # Upload a small file in one piece
+    def put_file(self, path: str, name: str):
+        raise NotImplementedError
+
+    # Files stored in the target as dicts with name and size
+    def list(self) -> list:
+        raise NotImplementedError
+
+    # Delete files and return the names that could not be deleted
+    def delete(self, names: list) -> list:
+        raise NotImplementedError
+
+    @staticmethod
+    def from_config(values):
+        if not values:
+            return None
+        kind = values.get('type', 'local')
+        budget = values.get('size_budget')
+        if kind == 'local':
+            return LocalTarget(values['path'], budget)
+        elif kind == 's3':
+            return S3Target(values['bucket'], values.get('prefix', ''), values.get('endpoint_url'),
+                            values.get('access_key'), values.get('secret_key'), values.get('region'),
+                            values.get('part_size', PART_SIZE), values.get('upload_jobs', 4), budget)
+        elif kind == 'sftp':
+            return SftpTarget(values['host'], values.get('path', '.'), values.get('port', 22), values.get('username'),
+                              values.get('password'), values.get('key_file'), values.get('host_key_check', True),
+                              budget)
+        raise Exception(F"Unknown storage target type '{kind}', choose one of: local, s3, sftp")
+
+
+# Upload into a target that stores files, written to <name>.partial and renamed once complete. A feeder thread writes
+# to the target, so sending overlaps with the compression. An interrupted upload is continued at the size of the
+# partial file.
+class FileUpload(Upload):
+
+    def __init__(self, target, path: str, name: str) -> None:
+        self.__file = None
+        self.__feeder = None
+        self.__feeder_error = None
+        self.__queue = queue.Queue(maxsize=MAX_QUEUED)
+        super().__init__(target, path, name)
+
+    def _start(self):
+        write_state(self.path, {'target': self.target.url, 'name': self.name})
+        self.__file = self.target.open(self.name + '.partial', 'wb')
+        self.__feeder = threading.Thread(target=self.__feed, daemon=True)
+        self.__feeder.start()
+
+    def __feed(self):
+        while True:
+            data = self.__queue.get()
+            if data is None:
+                break
+            if self.__feeder_error is None:
+                try:
+                    self.__file.write(data)
+                except Exception as e:
+                    self.__feeder_error = e
+
+    def _write(self, data: bytes):
+        if self.__feeder_error is not None:
+            raise self.__feeder_error
+        self.__queue.put(data)
+
+    def _close(self):
+        self.__queue.put(None)
+        self.__feeder.join()
+        if self.__feeder_error is not None:
+            raise self.__feeder_error
+        self.__file.close()
+        self.target.rename(self.name + '.partial', self.name)
+
+    def _stop(self):
+        if self.__feeder is not None and self.__feeder.is_alive():
+            self.__feeder_error = self.__feeder_error or Exception("Upload stopped")
+            self.__queue.put(None)
+            self.__feeder.join()
+        try:
+            if self.__file is not None:
+                self.__file.close()
+        except Exception:
+            pass
+
+    def _discard(self):
+        self.target.delete([self.name + '.partial'])
+
+
+# Base of the targets that store files: a directory on a local or mounted file system, or on an SFTP server
+class FileTarget(Target):
+
+    def open(self, name: str, mode: str):
+        raise NotImplementedError
+
+    def size(self, name: str):
+        raise NotImplementedError
+
+    def rename(self, source: str, target: str):
+        raise NotImplementedError
+
+    def upload(self, path: str, name: str) -> Upload:
+        return FileUpload(self, path, name)
+
+    def resume(self, path: str, name: str):
+        size = os.path.getsize(path)
+        if self.size(name) == size:
+            remove_state(path)
+            return
+        write_state(path, {'target': self.url, 'name': name})
+        offset = self.size(name + '.partial') or 0
+        if offset > size:
+            offset = 0
+        with open(path, 'rb') as source, self.open(name + '.partial', 'r+b' if offset else 'wb') as target:
+            source.seek(offset)
+            target.seek(offset)
+            for data in iter(lambda: source.read(1024 * 1024), b''):
+                target.write(data)
+        self.rename(name + '.partial', name)
+        remove_state(path)
+
+    def put_file(self, path: str, name: str):
+        with open(path, 'rb') as source, self.open(name, 'wb') as target:
+            target.write(source.read())
+
+
+class LocalTarget(FileTarget):
+
+    def __init__(self, path: str, size_budget=None) -> None:
+        super().__init__(size_budget)
+        self.path = path
+        self.url = path
+
+    def open(self, name: str, mode: str):
+        os.makedirs(self.path, exist_ok=True)
+        return open(os.path.join(self.path, name), mode)
+
+    def size(self, name: str):
+        try:
+            return os.path.getsize(os.path.join(self.path, name))
+        except FileNotFoundError:
+            return None
+
+    def rename(self, source: str, target: str):
+        os.replace(os.path.join(self.path, source), os.path.join(self.path, target))
+
+    def list(self) -> list:
+        if not os.path.isdir(self.path):
+            return []
+        return [{'name': entry.name, 'size': entry.stat().st_size} for entry in os.scandir(self.path)
+                if entry.is_file()]
+
+    def delete(self, names: list) -> list:
+        failed = []
+        for name in names:
+            try:
+                os.remove(os.path.join(self.path, name))
+            except FileNotFoundError:
+                pass
+            except OSError:
+                failed.append(name)
+        return failed
+
+
+# Directory on an SFTP server. All uploads share one SSH connection, each on its own channel.
+class SftpTarget(FileTarget):
+
+    def __init__(self, host: str, path: str = '.', port: int = 22, username: str = None, password: str = None,
+                 key_file: str = None, host_key_check: bool = True, size_budget=None) -> None:
+        if paramiko is None:
+            raise Exception("The sftp storage target requires the paramiko package: pip3 install paramiko")
+        super().__init__(size_budget)
+        self.host = host
+        self.port = port
+        self.path = path
+        self.username = username
+        self.password = password
+        self.key_file = key_file
+        self.host_key_check = host_key_check
+        self.url = F"sftp://{host}:{port}{path if path.startswith('/') else '/~/' + path}"
+        self.__client = None
+        self.__lock = threading.Lock()
+
+    # Open a new channel on the shared connection, reconnecting if it was lost
+    def __sftp(self):
+        with self.__lock:
+            transport = self.__client.get_transport() if self.__client else None
+            if transport is None or not transport.is_active():
+                self.__client = paramiko.SSHClient()
+                self.__client.load_system_host_keys()
+                if not self.host_key_check:
+                    self.__client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+                self.__client.connect(self.host, self.port, self.username, self.password, key_filename=self.key_file,
+                                      timeout=30)
+            sftp = self.__client.open_sftp()
+        try:
+            sftp.stat(self.path)
+        except FileNotFoundError:
+            sftp.mkdir(self.path)
+        return sftp
+
+    def __remote(self, name: str) -> str:
+        return posixpath.join(self.path, name)
+
+    def open(self, name: str, mode: str):
+        sftp = self.__sftp()
+        file = sftp.open(self.__remote(name), mode.replace('b', ''))
+        file.set_pipelined(True)
+        # The channel is closed together with the file
+        close = file.close
+
+        def close_all():
+            try:
+                close()
+            finally:
+                sftp.close()
+        file.close = close_all
+        return file
+
+    def size(self, name: str):
+        sftp = self.__sftp()
+        try:
+            return sftp.stat(self.__remote(name)).st_size
+        except FileNotFoundError:
+            return None
+        finally:
+            sftp.close()
+
+    def rename(self, source: str, target: str):
+        sftp = self.__sftp()
+        try:
+            sftp.posix_rename(self.__remote(source), self.__remote(target))
+        finally:
+            sftp.close()
+
+    def list(self) -> list:
+        sftp = self.__sftp()
+        try:
+            return [{'name': entry.filename, 'size': entry.st_size} for entry in sftp.listdir_attr(self.path)
+                    if stat.S_ISREG(entry.st_mode)]
+        finally:
+            sftp.close()
+
+    def delete(self, names: list) -> list:
+        sftp = self.__sftp()
+        failed = []
+        try:
+            for name in names:
+                try:
+                    sftp.remove(self.__remote(name))
+                except FileNotFoundError:
+                    pass
+                except OSError:
+                    failed.append(name)
+        finally:
+            sftp.close()
+        return failed
+
+
+# Multipart upload to S3 compatible object storage. Parts are sent on a pool of connections while later parts are
+# still being compressed; the upload id is kept in the state file, so an interrupted upload only sends missing parts.
+class S3Upload(Upload):
+
+    def __init__(self, target, path: str, name: str) -> None:
+        self.__parts = {}
+        self.__buffer = bytearray()
+        self.__pending = deque()
+        self.__upload_id = None
+        super().__init__(target, path, name)
+
+    def _start(self):
+        self.__upload_id = self.target.create_upload(self.name)
+        self.__save_state()
+
+    def __save_state(self):
+        write_state(self.path, {'target': self.target.url, 'name': self.name, 'upload_id': self.__upload_id,
+                                'part_size': self.target.part_size})
+
+    def _write(self, data: bytes):
+        self.__buffer += data
+        while len(self.__buffer) >= self.target.part_size:
+            self.__submit(bytes(self.__buffer[:self.target.part_size]))
+            del self.__buffer[:self.target.part_size]
+
+    def __submit(self, data: bytes):
+        number = len(self.__parts) + len(self.__pending) + 1
+        self.__pending.append(self.target.executor.submit(self.target.upload_part, self.name, self.__upload_id,
+                                                          number, data))
+        while len(self.__pending) > self.target.upload_jobs * 2:
+            self.__collect()
+
+    def __collect(self):
+        number, etag = self.__pending.popleft().result()
+        self.__parts[number] = etag
+
+    def _close(self):
+        if self.__buffer or not self.__parts and not self.__pending:
+            self.__submit(bytes(self.__buffer))
+            self.__buffer.clear()
+        while self.__pending:
+            self.__collect()
+        self.target.complete_upload(self.name, self.__upload_id, self.__parts)
+
+    def _stop(self):
+        for future in self.__pending:
+            future.cancel()
+
+    def _discard(self):
+        if self.__upload_id:
+            self.target.client.abort_multipart_upload(Bucket=self.target.bucket, Key=self.target.key(self.name),
+                                                      UploadId=self.__upload_id)
+
+
+class S3Target(Target):
+
+    def __init__(self, bucket: str, prefix: str = '', endpoint_url: str = None, access_key: str = None,
+                 secret_key: str = None, region: str = None, part_size=PART_SIZE, upload_jobs: int = 4,
+                 size_budget=None) -> None:
+        if boto3 is None:
+            raise Exception("The s3 storage target requires the boto3 package: pip3 install boto3")
+        super().__init__(size_budget)
+        self.bucket = bucket
+        self.prefix = prefix
+        self.part_size = max(parse_size(part_size), 5 * 1024 * 1024)
+        self.upload_jobs = upload_jobs
+        self.url = F"s3://{bucket}/{prefix}"
+        # botocore retries failed requests itself; the pool has a connection for every upload thread
+        self.client = boto3.client(
+            's3', endpoint_url=endpoint_url, aws_access_key_id=access_key, aws_secret_access_key=secret_key,
+            region_name=region, config=BotoConfig(max_pool_connections=upload_jobs + 2,
+                                                  retries={'max_attempts': 5, 'mode': 'standard'}))
+        self.executor = ThreadPoolExecutor(max_workers=upload_jobs)
+
+    def key(self, name: str) -> str:
+        return self.prefix + name
+
+    def create_upload(self, name: str) -> str:
+        return self.client.create_multipart_upload(Bucket=self.bucket, Key=self.key(name))['UploadId']
+
+    def upload_part(self, name: str, upload_id: str, number: int, data: bytes) -> tuple:
+        response = self.client.upload_part(Bucket=self.bucket, Key=self.key(name), UploadId=upload_id,
+                                           PartNumber=number, Body=data)
+        return number, response['ETag']
+
+    def complete_upload(self, name: str, upload_id: str, parts: dict):
+        self.client.complete_multipart_upload(
+            Bucket=self.bucket, Key=self.key(name), UploadId=upload_id,
+            MultipartUpload={'Parts': [{'PartNumber': number, 'ETag': parts[number]} for number in sorted(parts)]})
+
+    def upload(self, path: str, name: str) -> Upload:
+        return S3Upload(self, path, name)
+
+    # Parts of an unfinished multipart upload, None if the upload doesn't exist any more
+    def __uploaded_parts(self, name: str, upload_id: str):
+        parts = {}
+        try:
+            for page in self.client.get_paginator('list_parts').paginate(Bucket=self.bucket, Key=self.key(name),
+                                                                         UploadId=upload_id):
+                for part in page.get('Parts', []):
+                    parts[part['PartNumber']] = (part['ETag'], part['Size'])
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') == 'NoSuchUpload':
+                return None
+            raise
+        return parts
+
+    def __object_size(self, name: str):
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self.key(name))['ContentLength']
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+
+    def resume(self, path: str, name: str):
+        size = os.path.getsize(path)
+        state = read_state(path)
+        if self.__object_size(name) == size:
+            remove_state(path)
+            return
+        part_size = state.get('part_size', self.part_size)
+        parts = None
+        upload_id = state.get('upload_id')
+        if upload_id:
+            parts = self.__uploaded_parts(name, upload_id)
+        if parts is None:
+            upload_id = self.create_upload(name)
+            parts = {}
+            write_state(path, {'target': self.url, 'name': name, 'upload_id': upload_id, 'part_size': part_size})
+        count = max(1, -(-size // part_size))
+
+        def send(number):
+            with open(path, 'rb') as file:
+                file.seek((number - 1) * part_size)
+                return self.upload_part(name, upload_id, number, file.read(part_size))
+
+        expected = {number: min(part_size, size - (number - 1) * part_size) for number in range(1, count + 1)}
+        missing = [number for number in expected if number not in parts or parts[number][1] != expected[number]]
+        etags = {number: parts[number][0] for number in expected if number not in missing}
+        etags.update(dict(self.executor.map(send, missing)))
+        self.complete_upload(name, upload_id, etags)
+        remove_state(path)
+
+    def put_file(self, path: str, name: str):
+        with open(path, 'rb') as file:
+            self.client.put_object(Bucket=self.bucket, Key=self.key(name), Body=file.read())
+
+    def list(self) -> list:
+        files = []
+        for page in self.client.get_paginator('list_objects_v2').paginate(Bucket=self.bucket, Prefix=self.prefix):
+            for item in page.get('Contents', []):
+                name = item['Key'][len(self.prefix):]
+                if '/' not in name:
+                    files.append({'name': name, 'size': item['Size']})
+        return files
+
+    def delete(self, names: list) -> list:
+        failed = []
+        for start in range(0, len(names), 1000):
+            response = self.client.delete_objects(Bucket=self.bucket, Delete={
+                'Objects': [{'Key': self.key(name)} for name in names[start:start + 1000]], 'Quiet': True})
+            failed += [error['Key'][len(self.prefix):] for error in response.get('Errors', [])]
+        return failed
@@ -0,0 +1,27 @@
+import os
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import benchmark
+import docker_api
+
+
+# Fake Docker Engine on a unix socket in the tmp dir, recording what is imported into mysql and uploaded into the
+# containers. The scripts talk to it through DOCKER_HOST.
+@pytest.fixture
+def docker(tmp_path, monkeypatch):
+    socket_path = str(tmp_path / 'docker.sock')
+    server = benchmark.FakeDockerServer(socket_path, 256 * 1024, 16 * 1024, 0)
+    server.imports = []
+    server.uploads = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setenv('DOCKER_HOST', F"unix://{socket_path}")
+    monkeypatch.setattr(docker_api, '_client', None)
+    yield server
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,68 @@
+import io
+import tarfile
+
+import pytest
+
+import benchmark
+import docker_api
+
+
+def test_exec_run_returns_output_and_exit_code(docker):
+    exit_code, output, errors = docker_api.client().exec_run(
+        benchmark.DB_CONTAINER, ["mysql", "--execute", "SELECT schema_name FROM information_schema.schemata"])
+    assert exit_code == 0
+    assert output == F"{benchmark.DATABASE}\tutf8mb4\tutf8mb4_general_ci\n"
+    assert errors == ""
+
+
+def test_exec_run_reports_failed_commands(docker):
+    exit_code, output, errors = docker_api.client().exec_run(benchmark.APP_CONTAINER, ["missing-command"])
+    assert exit_code == 127
+    assert output == ""
+    assert "command not found" in errors
+
+
+def test_exec_stream_feeds_stdin(docker):
+    process = docker_api.client().exec_stream(benchmark.DB_CONTAINER, ["mysql", "nextcloud"], stdin=True)
+    for piece in (b"CREATE TABLE `t` (`id` int);\n", b"INSERT INTO `t` VALUES (1);\n"):
+        process.stdin.write(piece)
+    process.stdin.close()
+    assert process.wait() == 0
+    assert docker.imports == [(["mysql", "nextcloud"], b"CREATE TABLE `t` (`id` int);\nINSERT INTO `t` VALUES (1);\n")]
+
+
+def test_exec_stream_streams_stdout(docker):
+    process = docker_api.client().exec_stream(benchmark.DB_CONTAINER, ["mysqldump", "--all-databases"])
+    dump = process.stdout.read()
+    assert process.wait() == 0
+    assert dump == b"".join(docker.dump.database())
+
+
+def test_get_archive_streams_a_tar(docker):
+    with tarfile.open(fileobj=docker_api.client().get_archive(benchmark.APP_CONTAINER, "/var/www/html/config"),
+                      mode='r|') as tarball:
+        files = {member.name: tarball.extractfile(member).read() for member in tarball if member.isfile()}
+    assert files == dict(benchmark.config_files(docker.config_size, docker.seed))
+
+
+def test_get_archive_of_a_missing_path_raises(docker):
+    with pytest.raises(docker_api.DockerError) as error:
+        docker_api.client().get_archive(benchmark.APP_CONTAINER, "/nonexistent")
+    assert error.value.status == 404
+
+
+@pytest.mark.parametrize('as_file', [False, True])
+def test_put_archive_uploads_the_tar(docker, as_file):
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode='w') as tarball:
+        info = tarfile.TarInfo("config/config.php")
+        info.size = 5
+        tarball.addfile(info, io.BytesIO(b"<?php"))
+    docker_api.client().put_archive(benchmark.APP_CONTAINER, "/var/www/html",
+                                    io.BytesIO(data.getvalue()) if as_file else data.getvalue())
+    assert docker.uploads == [(benchmark.APP_CONTAINER, "/var/www/html", data.getvalue())]
+
+
+def test_inspect_container(docker):
+    assert docker_api.client().inspect_container(benchmark.APP_CONTAINER)['Name'] == "/" + benchmark.APP_CONTAINER
+
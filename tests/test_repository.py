@@ -0,0 +1,21 @@
+import benchmark
+import models
+from models import Container
+from repository import Repository
+
+
+def test_chunks_are_written_under_the_lock_of_the_backup_dir(docker, tmp_path, monkeypatch):
+    config = benchmark._config('repository', str(tmp_path / 'backups'))
+    container = Container.instantiate_container(config, benchmark.INSTANCE)
+    lock = models.backup_dir_lock(container.backup_dir)
+    locked = []
+    put_chunk = Repository.put_chunk
+
+    # The garbage collection of another instance's cleanup takes the same lock
+    def checked_put_chunk(repository, data):
+        locked.append(lock.locked())
+        return put_chunk(repository, data)
+
+    monkeypatch.setattr(Repository, 'put_chunk', checked_put_chunk)
+    assert container.create_backup() is not False, container.exceptions
+    assert locked and all(locked)
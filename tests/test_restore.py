@@ -0,0 +1,142 @@
+import io
+import re
+import tarfile
+import threading
+
+import pytest
+
+import benchmark
+import models
+import restore
+from models import Container
+
+# Scenarios of the benchmark and the optional package each one needs
+SCENARIOS = [
+    ('spool', None),
+    ('stream', None),
+    ('online', None),
+    ('parallel', None),
+    ('indexed', None),
+    ('xz', None),
+    ('zstd', 'zstandard'),
+    ('repository', None),
+    ('encrypted', 'cryptography'),
+]
+
+
+def instance(scenario: str, tmp_path) -> Container:
+    config = benchmark._config(scenario, str(tmp_path / scenario))
+    return Container.instantiate_container(config, benchmark.INSTANCE)
+
+
+def backup(scenario: str, tmp_path) -> str:
+    container = instance(scenario, tmp_path)
+    assert container.create_backup() is not False, container.exceptions
+    return container.archive_file_path
+
+
+def imported_tables(imports: list) -> dict:
+    tables = {}
+    for command, data in imports:
+        match = re.search(rb"^CREATE TABLE `([^`]+)`", data, re.MULTILINE)
+        if match:
+            tables[match.group(1).decode()] = (command, data)
+    return tables
+
+
+def uploaded_config(uploads: list) -> dict:
+    container, path, data = uploads[-1]
+    assert (container, path) == (benchmark.APP_CONTAINER, models.NEXTCLOUD_DIR)
+    with tarfile.open(fileobj=io.BytesIO(data)) as tarball:
+        return {member.name: tarball.extractfile(member).read() for member in tarball if member.isfile()}
+
+
+@pytest.mark.parametrize('scenario, package', SCENARIOS)
+def test_restore_imports_the_dump_and_config(docker, tmp_path, scenario, package):
+    if package:
+        pytest.importorskip(package)
+    backup_file_path = backup(scenario, tmp_path)
+    container = instance(scenario, tmp_path)
+    assert container.restore_backup(backup_file_path), container.exceptions
+
+    if scenario == 'parallel':
+        # One import creates the database, then every table is loaded into it by a client of its own
+        tables = imported_tables(docker.imports)
+        assert sorted(tables) == sorted(table for table, _ in benchmark.TABLES)
+        for table, (command, data) in tables.items():
+            assert command[-1] == benchmark.DATABASE
+            assert data == models.TABLE_IMPORT_PREFIX + b"".join(docker.dump.table(table))
+        assert b"CREATE DATABASE IF NOT EXISTS `nextcloud`" in docker.imports[0][1]
+    else:
+        # The dump of the repository layout has one row per INSERT and no date
+        extended = scenario != 'repository'
+        assert [data for _, data in docker.imports] == [b"".join(docker.dump.database(extended, extended))]
+    assert uploaded_config(docker.uploads) == dict(benchmark.config_files(docker.config_size, docker.seed))
+
+
+@pytest.mark.parametrize('scenario', ['spool', 'indexed', 'parallel'])
+def test_restore_table_imports_only_that_table(docker, tmp_path, scenario):
+    backup_file_path = backup(scenario, tmp_path)
+    container = instance(scenario, tmp_path)
+    assert container.restore_table(backup_file_path, 'oc_share'), container.exceptions
+    tables = imported_tables(docker.imports)
+    assert list(tables) == ['oc_share']
+    assert b"".join(docker.dump.table('oc_share')) in tables['oc_share'][1]
+
+
+def test_restore_file_uploads_only_that_file(docker, tmp_path):
+    backup_file_path = backup('indexed', tmp_path)
+    container = instance('indexed', tmp_path)
+    assert container.restore_file(backup_file_path, 'config/config.php'), container.exceptions
+    assert uploaded_config(docker.uploads) == {
+        'config/config.php': dict(benchmark.config_files(docker.config_size, docker.seed))['config/config.php']}
+    assert docker.imports == []
+
+
+def test_restore_refuses_a_corrupt_backup(docker, tmp_path):
+    backup_file_path = backup('spool', tmp_path)
+    with open(backup_file_path, 'r+b') as file:
+        file.seek(1000)
+        file.write(b"corrupt")
+    container = instance('spool', tmp_path)
+    assert not container.restore_backup(backup_file_path)
+    assert docker.imports == [] and docker.uploads == []
+
+
+@pytest.mark.parametrize('argv', [['--shadow', '--table', 'oc_users'], ['--rollback', '--file=config/config.php']])
+def test_shadow_restore_of_a_single_table_or_file_is_refused(monkeypatch, argv):
+    monkeypatch.setattr(restore.sys, 'argv', ['restore.py', benchmark.INSTANCE] + argv)
+    with pytest.raises(SystemExit) as exit_info:
+        restore.restore()
+    assert exit_info.value.code == 1
+
+
+class SlowImport:
+
+    def __init__(self, done: threading.Event) -> None:
+        self.done = done
+        self.closed = False
+
+    def close(self):
+        assert self.done.wait(5)
+        self.closed = True
+
+    def abort(self):
+        self.done.set()
+
+
+def test_finished_imports_load_while_the_next_tables_are_read():
+    done = threading.Event()
+    finishing = models.FinishingImports(2)
+    imports = [SlowImport(done) for _ in range(3)]
+    # The reader isn't held up by the tables mysql is still loading, up to the limit
+    finishing.add(imports[0])
+    finishing.add(imports[1])
+    blocked = threading.Thread(target=finishing.add, args=(imports[2],))
+    blocked.start()
+    blocked.join(0.2)
+    assert blocked.is_alive() and not any(import_db.closed for import_db in imports)
+    done.set()
+    blocked.join(5)
+    finishing.close()
+    assert all(import_db.closed for import_db in imports)
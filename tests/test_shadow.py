@@ -0,0 +1,107 @@
+import pytest
+
+import shadow
+
+DUMP = b"""--
+-- Current Database: `mysql`
+--
+
+CREATE DATABASE /*!32312 IF NOT EXISTS*/ `mysql`;
+
+USE `mysql`;
+INSERT INTO `user` VALUES ('root');
+
+--
+-- Current Database: `nextcloud`
+--
+
+CREATE DATABASE /*!32312 IF NOT EXISTS*/ `nextcloud` /*!40100 DEFAULT CHARACTER SET utf8mb4 */;
+
+USE `nextcloud`;
+
+--
+-- Table structure for table `oc_users`
+--
+
+CREATE TABLE `oc_users` (
+  `uid` varchar(64) NOT NULL
+);
+INSERT INTO `oc_users` VALUES ('see `nextcloud`.`oc_users`');
+INSERT INTO `oc_users` (`uid`) VALUES ('`nextcloud`.`oc_users`');
+"""
+
+
+def run_filter(dump: bytes, piece_size: int) -> tuple:
+    output = []
+    databases = []
+    dump_filter = shadow.ShadowFilter(output.append, databases)
+    for start in range(0, len(dump), piece_size):
+        dump_filter.feed(dump[start:start + piece_size])
+    dump_filter.close()
+    return b"".join(output), databases
+
+
+@pytest.mark.parametrize('piece_size', [1, 7, 1024 * 1024])
+def test_databases_are_renamed_to_their_shadows(piece_size):
+    output, databases = run_filter(DUMP, piece_size)
+    assert databases == ['nextcloud']
+    assert b"DROP DATABASE IF EXISTS `nextcloud__shadow`;\nCREATE DATABASE /*!32312 IF NOT EXISTS*/ " \
+           b"`nextcloud__shadow` /*!40100" in output
+    assert b"USE `nextcloud__shadow`;" in output
+    # The system databases are left out, names in the rows are data
+    assert b"mysql" not in output and b"root" not in output
+    assert b"INSERT INTO `oc_users` VALUES ('see `nextcloud`.`oc_users`');" in output
+
+
+@pytest.mark.parametrize('statement', [
+    b"/*!50001 VIEW `oc_view` AS select `uid` from `nextcloud`.`oc_users` */;\n",
+    b"/*!50003 CREATE*/ /*!50003 TRIGGER `oc_log` AFTER INSERT ON `oc_users` FOR EACH ROW\n"
+    b"INSERT INTO `nextcloud`.`oc_log` VALUES (NEW.uid) */;;\n",
+])
+def test_statements_naming_a_restored_database_are_refused(statement):
+    output = []
+    dump_filter = shadow.ShadowFilter(output.append, [])
+    with pytest.raises(Exception, match='nextcloud'):
+        dump_filter.feed(DUMP + statement)
+        dump_filter.close()
+    assert statement not in b"".join(output)
+
+
+def test_tables_of_a_parallel_dump_are_checked_as_well():
+    dump_filter = shadow.ShadowFilter([].append, ['nextcloud'])
+    dump_filter.feed(b"CREATE TABLE `oc_users` (\n  `uid` varchar(64)\n);\nINSERT INTO `oc_users` VALUES "
+                     b"('`nextcloud`.`x`');\n")
+    with pytest.raises(Exception):
+        dump_filter.feed(b"CREATE TRIGGER `t` AFTER DELETE ON `oc_users` FOR EACH ROW DELETE FROM `nextcloud`.`x`;\n")
+
+
+# Apply the moves of a RENAME TABLE statement one after another like the server does, and fail like it would
+def rename(databases: dict, moves: list):
+    for database, table, target in moves:
+        assert table in databases[database] and table not in databases[target]
+        databases[database].remove(table)
+        databases[target].add(table)
+
+
+def test_swap_moves_the_restored_tables_in():
+    databases = {'nextcloud': {'oc_users', 'oc_old'}, 'nextcloud__shadow': {'oc_users', 'oc_new'},
+                 'nextcloud__previous': set()}
+    moves = shadow.swap_moves('nextcloud', sorted(databases['nextcloud']), sorted(databases['nextcloud__shadow']))
+    rename(databases, moves)
+    assert databases == {'nextcloud': {'oc_users', 'oc_new'}, 'nextcloud__shadow': set(),
+                         'nextcloud__previous': {'oc_users', 'oc_old'}}
+    assert shadow.rename_statement(moves[:1]) == "RENAME TABLE `nextcloud`.`oc_old` TO `nextcloud__previous`.`oc_old`"
+
+
+def test_rollback_swaps_the_previous_tables_back():
+    databases = {'nextcloud': {'oc_users', 'oc_new'}, 'nextcloud__shadow': set(),
+                 'nextcloud__previous': {'oc_users', 'oc_old'}}
+    rename(databases, shadow.rollback_moves('nextcloud', sorted(databases['nextcloud']),
+                                            sorted(databases['nextcloud__previous'])))
+    assert databases == {'nextcloud': {'oc_users', 'oc_old'}, 'nextcloud__shadow': set(),
+                         'nextcloud__previous': {'oc_users', 'oc_new'}}
+
+
+def test_names_are_quoted():
+    assert shadow.rename_statement([('next`cloud', 'oc_users', 'next`cloud__previous')]) == \
+        "RENAME TABLE `next``cloud`.`oc_users` TO `next``cloud__previous`.`oc_users`"
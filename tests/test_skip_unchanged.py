@@ -0,0 +1,82 @@
+import time
+
+import benchmark
+from models import Container
+
+TABLES = sorted(table for table, _ in benchmark.TABLES)
+
+
+def backup(tmp_path, number_of_backups: int = 5) -> Container:
+    config = benchmark._config('parallel', str(tmp_path / 'backups'))
+    config['nextcloud_containers'][benchmark.INSTANCE].update(skip_unchanged=True,
+                                                              number_of_backups=number_of_backups)
+    # Backups are named by the second they were made in
+    time.sleep(1.1)
+    container = Container.instantiate_container(config, benchmark.INSTANCE)
+    assert container.create_backup() is not False, container.exceptions
+    return container
+
+
+def dumped(container: Container) -> list:
+    backup = container.catalog.backups(benchmark.INSTANCE)[-1]
+    return sorted(key.split('/')[1] for key, entry in backup['tables'].items()
+                  if entry['archive'] == container.archive_file)
+
+
+def test_tables_with_an_unchanged_update_time_are_not_dumped(docker, tmp_path):
+    docker.update_times = {table: "2024-01-01 00:00:00" for table in TABLES}
+    docker.now = "2024-01-02 00:00:00"
+    assert dumped(backup(tmp_path)) == TABLES
+    assert dumped(backup(tmp_path)) == []
+    docker.update_times['oc_share'] = "2024-01-02 00:00:05"
+    docker.now = "2024-01-03 00:00:00"
+    assert dumped(backup(tmp_path)) == ['oc_share']
+    # No table is read to compare its checksum
+    assert not any(command[-1].startswith('CHECKSUM') for command, _ in docker.imports)
+
+
+def test_update_time_of_the_second_the_tables_were_looked_at_is_not_trusted(docker, tmp_path):
+    docker.update_times = {table: "2024-01-02 00:00:00" for table in TABLES}
+    docker.now = "2024-01-02 00:00:00"
+    assert dumped(backup(tmp_path)) == TABLES
+    assert dumped(backup(tmp_path)) == TABLES
+
+
+def test_checksums_are_compared_without_update_times(docker, tmp_path):
+    docker.checksums = {table: "100" for table in TABLES}
+    assert dumped(backup(tmp_path)) == TABLES
+    docker.checksums['oc_appconfig'] = "200"
+    assert dumped(backup(tmp_path)) == ['oc_appconfig']
+
+
+def test_tables_are_dumped_again_before_their_archive_expires(docker, tmp_path):
+    docker.update_times = {table: "2024-01-01 00:00:00" for table in TABLES}
+    docker.now = "2024-01-02 00:00:00"
+    first = backup(tmp_path, number_of_backups=2)
+    assert dumped(first) == TABLES
+    second = backup(tmp_path, number_of_backups=2)
+    assert dumped(second) == []
+    # With the next backup the first one falls out of the last two, so nothing may refer to it any more
+    third = backup(tmp_path, number_of_backups=2)
+    assert dumped(third) == TABLES
+    fourth = backup(tmp_path, number_of_backups=2)
+    assert dumped(fourth) == []
+    # The second backup referred to the first one, neither is needed any more
+    fourth.cleanup()
+    assert [backup['file_name'] for backup in fourth.catalog.backups(benchmark.INSTANCE)] == \
+        [third.archive_file, fourth.archive_file]
+
+
+def test_restore_loads_the_referenced_tables(docker, tmp_path):
+    docker.update_times = {table: "2024-01-01 00:00:00" for table in TABLES}
+    docker.now = "2024-01-02 00:00:00"
+    backup(tmp_path)
+    docker.update_times['oc_share'] = "2024-01-02 00:00:05"
+    docker.now = "2024-01-03 00:00:00"
+    last = backup(tmp_path)
+    docker.imports.clear()
+    container = Container.instantiate_container(benchmark._config('parallel', str(tmp_path / 'backups')),
+                                                benchmark.INSTANCE)
+    assert container.restore_backup(last.archive_file_path), container.exceptions
+    for table in TABLES:
+        assert any(b"".join(docker.dump.table(table)) in data for _, data in docker.imports)
@@ -0,0 +1,166 @@
+import os
+import time
+
+import pytest
+
+import archive
+import benchmark
+import storage
+from models import Container
+
+
+def instance(tmp_path, target: dict, number_of_backups: int = 1) -> Container:
+    config = benchmark._config('stream', str(tmp_path / 'backups'))
+    config['nextcloud_containers'][benchmark.INSTANCE].update(target=target, number_of_backups=number_of_backups)
+    return Container.instantiate_container(config, benchmark.INSTANCE)
+
+
+def read(path: str) -> bytes:
+    with open(path, 'rb') as file:
+        return file.read()
+
+
+def test_backup_is_uploaded_to_a_local_target(docker, tmp_path):
+    target = tmp_path / 'target'
+    container = instance(tmp_path, {'type': 'local', 'path': str(target)})
+    assert container.create_backup() is not False, container.exceptions
+    assert sorted(os.listdir(target)) == [container.archive_file, container.archive_file + '.sha256']
+    assert read(str(target / container.archive_file)) == read(container.archive_file_path)
+    assert not os.path.exists(storage.state_path(container.archive_file_path))
+
+
+def test_cleanup_applies_the_retention_to_the_target(docker, tmp_path):
+    target = tmp_path / 'target'
+    archives = []
+    for _ in range(2):
+        container = instance(tmp_path, {'type': 'local', 'path': str(target)})
+        assert container.create_backup() is not False, container.exceptions
+        archives.append(container.archive_file)
+        # Backups are named by the second they were made in
+        time.sleep(1.1)
+    container.cleanup()
+    assert sorted(os.listdir(target)) == [archives[-1], archives[-1] + '.sha256']
+    assert [backup['file_name'] for backup in container.catalog.backups(benchmark.INSTANCE)] == [archives[-1]]
+
+
+def test_only_interrupted_uploads_of_the_instance_are_resumed(docker, tmp_path):
+    target = tmp_path / 'target'
+    os.makedirs(tmp_path / 'backups')
+    pending = {}
+    # Another instance in the same backup dir whose name starts with the name of this one
+    for name in (benchmark.INSTANCE, benchmark.INSTANCE + '_2'):
+        path = str(tmp_path / 'backups' / F"{name}_2024-01-01_000000.tar.gz")
+        with open(path, 'wb') as file:
+            file.write(os.urandom(1024))
+        upload = storage.LocalTarget(str(target)).upload(path, os.path.basename(path))
+        upload._stop()
+        pending[name] = path
+    container = instance(tmp_path, {'type': 'local', 'path': str(target)})
+    assert container.create_backup() is not False, container.exceptions
+    assert os.path.basename(pending[benchmark.INSTANCE]) in os.listdir(target)
+    assert not os.path.exists(storage.state_path(pending[benchmark.INSTANCE]))
+    assert os.path.basename(pending[benchmark.INSTANCE + '_2']) not in os.listdir(target)
+    assert storage.read_state(pending[benchmark.INSTANCE + '_2'])['name'] == \
+        os.path.basename(pending[benchmark.INSTANCE + '_2'])
+
+
+def test_interrupted_file_upload_is_resumed(tmp_path):
+    path = str(tmp_path / 'cloud_2024-01-01_000000.tar.gz')
+    data = os.urandom(3 * 1024 * 1024 + 17)
+    with open(path, 'wb') as file:
+        file.write(data)
+    target = storage.LocalTarget(str(tmp_path / 'target'))
+    upload = target.upload(path, os.path.basename(path))
+    upload.write(data[:1024 * 1024])
+    upload._stop()
+    assert storage.read_state(path)['name'] == os.path.basename(path)
+    target.resume(path, os.path.basename(path))
+    assert read(str(tmp_path / 'target' / os.path.basename(path))) == data
+    assert storage.read_state(path) == {}
+
+
+# In-process stand-in for the S3 API calls of S3Target
+class FakeS3:
+
+    def __init__(self) -> None:
+        self.objects = {}
+        self.uploads = {}
+        self.sent_parts = []
+
+    def create_multipart_upload(self, Bucket, Key):
+        upload_id = F"upload-{len(self.uploads)}"
+        self.uploads[upload_id] = (Key, {})
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self.uploads[UploadId][1][PartNumber] = bytes(Body)
+        self.sent_parts.append(PartNumber)
+        return {'ETag': F"etag-{PartNumber}"}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        key, parts = self.uploads.pop(UploadId)
+        assert [part['ETag'] for part in MultipartUpload['Parts']] == [F"etag-{number}" for number in sorted(parts)]
+        self.objects[key] = b"".join(parts[number] for number in sorted(parts))
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.uploads.pop(UploadId, None)
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[Key] = Body
+
+    def head_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise storage.ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+        return {'ContentLength': len(self.objects[Key])}
+
+    def delete_objects(self, Bucket, Delete):
+        for item in Delete['Objects']:
+            self.objects.pop(item['Key'], None)
+        return {}
+
+    def get_paginator(self, operation):
+        return self
+
+    def paginate(self, Bucket, Prefix=None, Key=None, UploadId=None):
+        if UploadId is not None:
+            if UploadId not in self.uploads:
+                raise storage.ClientError({'Error': {'Code': 'NoSuchUpload'}}, 'ListParts')
+            parts = self.uploads[UploadId][1]
+            return [{'Parts': [{'PartNumber': number, 'ETag': F"etag-{number}", 'Size': len(data)}
+                               for number, data in sorted(parts.items())]}]
+        return [{'Contents': [{'Key': key, 'Size': len(data)} for key, data in sorted(self.objects.items())
+                              if key.startswith(Prefix)]}]
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    pytest.importorskip('boto3')
+    client = FakeS3()
+    monkeypatch.setattr(storage.boto3, 'client', lambda *args, **kwargs: client)
+    return client
+
+
+def test_backup_is_uploaded_to_s3(docker, tmp_path, s3):
+    container = instance(tmp_path, {'type': 's3', 'bucket': 'backups', 'prefix': 'cloud1/'})
+    assert container.create_backup() is not False, container.exceptions
+    assert s3.objects['cloud1/' + container.archive_file] == read(container.archive_file_path)
+    assert s3.objects['cloud1/' + container.archive_file + '.sha256'] == \
+        read(archive.checksum_path(container.archive_file_path))
+    assert s3.uploads == {}
+
+
+def test_interrupted_s3_upload_only_sends_missing_parts(tmp_path, s3):
+    target = storage.S3Target('backups', 'cloud1/', part_size='5 MB')
+    path = str(tmp_path / 'cloud_2024-01-01_000000.tar.gz')
+    data = os.urandom(12 * 1024 * 1024)
+    with open(path, 'wb') as file:
+        file.write(data)
+    # The first part made it before the upload was interrupted
+    upload_id = target.create_upload(os.path.basename(path))
+    target.upload_part(os.path.basename(path), upload_id, 1, data[:target.part_size])
+    storage.write_state(path, {'target': target.url, 'name': os.path.basename(path), 'upload_id': upload_id,
+                               'part_size': target.part_size})
+    target.resume(path, os.path.basename(path))
+    assert sorted(s3.sent_parts) == [1, 2, 3] and s3.sent_parts[0] == 1
+    assert s3.objects['cloud1/' + os.path.basename(path)] == data
+    assert storage.read_state(path) == {}
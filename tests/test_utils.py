@@ -0,0 +1,20 @@
+import pytest
+
+import utils
+
+
+def test_jobs_are_read_from_the_flags(monkeypatch):
+    monkeypatch.setattr(utils, 'jobs', 1)
+    utils.set_flags(['backup.py', '--jobs', '4'])
+    assert utils.jobs == 4
+    utils.set_flags(['backup.py'])
+    assert utils.jobs == 1
+
+
+@pytest.mark.parametrize('value', ['x', '0', '-2', '1.5'])
+def test_invalid_jobs_are_refused(monkeypatch, capsys, value):
+    monkeypatch.setattr(utils, 'jobs', 1)
+    with pytest.raises(SystemExit) as exit_info:
+        utils.set_flags(['backup.py', F"--jobs={value}"])
+    assert exit_info.value.code == 1
+    assert '--jobs' in capsys.readouterr().out
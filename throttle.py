@@ -0,0 +1,268 @@
+import os
+import subprocess
+import threading
+import time
+import urllib.error
+import urllib.request
+from contextlib import contextmanager
+
+from retention import parse_size
+
+# Reads and writes are passed through the rate limit in pieces of this size, so large reads don't come in bursts
+PIECE_SIZE = 1024 * 1024
+
+# I/O scheduling classes of ionice
+IONICE_CLASSES = {'none': '0', 'realtime': '1', 'best-effort': '2', 'idle': '3'}
+
+
+# Token bucket that limits the bytes per second passed through it. A rate of None doesn't limit anything but still
+# counts the bytes, so the adaptive mode knows the current throughput. The bucket can be shared by several threads.
+class TokenBucket:
+
+    def __init__(self, rate=None) -> None:
+        self.limit = rate
+        self.rate = rate
+        self.consumed = 0
+        self.waited = 0.0
+        self.__tokens = 0.0
+        self.__time = time.monotonic()
+        self.__last_consumed = 0
+        self.__lock = threading.Lock()
+
+    # Take n bytes out of the bucket and sleep until they are paid for
+    def consume(self, n: int):
+        with self.__lock:
+            self.consumed += n
+            now = time.monotonic()
+            rate = self.rate
+            if not rate:
+                self.__tokens, self.__time = 0.0, now
+                return
+            # At most one second worth of bytes may pile up while nothing is read
+            self.__tokens = min(rate, self.__tokens + (now - self.__time) * rate) - n
+            self.__time = now
+            wait = -self.__tokens / rate if self.__tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+            with self.__lock:
+                self.waited += wait
+
+    # Bytes per second passed through since the last call
+    def throughput(self, interval: float) -> float:
+        consumed, self.__last_consumed = self.consumed - self.__last_consumed, self.consumed
+        return consumed / interval if interval > 0 else 0.0
+
+    # Halve the rate, starting from the current throughput if the bucket isn't limited yet
+    def back_off(self, throughput: float, floor: int):
+        current = self.rate or throughput
+        if current:
+            self.rate = max(floor, current / 2)
+
+    # Raise the rate again by half, until the configured limit is reached or the bucket no longer slows anything down
+    def recover(self, throughput: float):
+        if self.rate is None or self.rate == self.limit:
+            return
+        if self.limit is None and throughput < self.rate * 0.8:
+            self.rate = None
+        else:
+            self.rate = self.rate * 1.5 if self.limit is None else min(self.limit, self.rate * 1.5)
+
+
+# Stream whose reads are limited by a token bucket
+class ThrottledReader:
+
+    def __init__(self, stream, bucket: TokenBucket) -> None:
+        self.stream = stream
+        self.bucket = bucket
+
+    def read(self, size=-1) -> bytes:
+        pieces = []
+        remaining = size if size is not None and size >= 0 else None
+        while remaining is None or remaining > 0:
+            data = self.stream.read(PIECE_SIZE if remaining is None else min(PIECE_SIZE, remaining))
+            if not data:
+                break
+            self.bucket.consume(len(data))
+            pieces.append(data)
+            if remaining is not None:
+                remaining -= len(data)
+        return b''.join(pieces)
+
+    def readline(self, size=-1) -> bytes:
+        data = self.stream.readline(size)
+        self.bucket.consume(len(data))
+        return data
+
+
+# File object whose writes are limited by a token bucket
+class ThrottledWriter:
+
+    def __init__(self, fileobj, bucket: TokenBucket) -> None:
+        self.fileobj = fileobj
+        self.bucket = bucket
+
+    def write(self, data) -> int:
+        view = memoryview(data)
+        for start in range(0, len(view), PIECE_SIZE):
+            piece = view[start:start + PIECE_SIZE]
+            self.bucket.consume(len(piece))
+            self.fileobj.write(piece)
+        return len(view)
+
+    def flush(self):
+        self.fileobj.flush()
+
+
+# Measures the response time of the Nextcloud instance with a request of its status page. A failed request counts as
+# slow as the timeout.
+class LatencyProbe:
+
+    def __init__(self, url: str, timeout: float = 10) -> None:
+        self.url = url
+        self.timeout = timeout
+        self.failures = 0
+
+    def measure(self) -> float:
+        start = time.monotonic()
+        try:
+            with urllib.request.urlopen(self.url, timeout=self.timeout) as response:
+                response.read()
+        except urllib.error.HTTPError:
+            # The instance answered, e.g. while maintenance mode is enabled
+            pass
+        except OSError:
+            self.failures += 1
+            return self.timeout
+        return time.monotonic() - start
+
+
+# Limits the resources a backup takes from the production instance: the bytes per second read from mysqldump and
+# written to the backup dir, the number of compression threads, and the CPU and I/O priority of the processes spawned.
+# In adaptive mode the rates are halved whenever the response time of the instance goes above max_latency and raised
+# again once it is back below.
+class Throttle:
+
+    def __init__(self, dump_rate=None, write_rate=None, compression_threads=None, nice=None, ionice=None,
+                 max_latency=None, probe_url=None, interval=5, min_rate=1024 * 1024) -> None:
+        self.dump = TokenBucket(parse_size(dump_rate))
+        self.write = TokenBucket(parse_size(write_rate))
+        self.compression_threads = compression_threads
+        self.nice = nice
+        self.ionice = self.__parse_ionice(ionice)
+        self.max_latency = max_latency
+        self.probe_url = probe_url
+        self.interval = interval
+        self.min_rate = parse_size(min_rate)
+        self.latencies = []
+        self.back_offs = 0
+        self.__stop = threading.Event()
+
+    @staticmethod
+    def from_config(values) -> 'Throttle':
+        values = values or {}
+        adaptive = values.get('adaptive') or {}
+        return Throttle(values.get('dump_rate'), values.get('write_rate'), values.get('compression_threads'),
+                        values.get('nice'), values.get('ionice'), adaptive.get('max_latency'),
+                        adaptive.get('probe_url'), adaptive.get('interval', 5), adaptive.get('min_rate', '1 MB'))
+
+    # Parse an ionice setting like "idle", "best-effort" or "best-effort:7" into class and level
+    @staticmethod
+    def __parse_ionice(value):
+        if not value:
+            return None
+        name, _, level = str(value).partition(':')
+        if name not in IONICE_CLASSES:
+            raise Exception(F"Unknown ionice class '{name}', choose one of: {', '.join(IONICE_CLASSES.keys())}")
+        return IONICE_CLASSES[name], level or None
+
+    @property
+    def adaptive(self) -> bool:
+        return bool(self.max_latency)
+
+    # Seconds reads and writes were held back
+    @property
+    def waited(self) -> float:
+        return self.dump.waited + self.write.waited
+
+    def reader(self, stream):
+        return ThrottledReader(stream, self.dump) if self.dump.limit or self.adaptive else stream
+
+    def writer(self, fileobj):
+        return ThrottledWriter(fileobj, self.write) if self.write.limit or self.adaptive else fileobj
+
+    # Run a command in a container with the configured CPU and I/O priority
+    def command(self, command: list) -> list:
+        prefix = []
+        if self.nice is not None:
+            prefix += ["nice", "-n", str(self.nice)]
+        if self.ionice:
+            prefix += ["ionice", "-c", self.ionice[0]] + (["-n", self.ionice[1]] if self.ionice[1] else [])
+        return prefix + command
+
+    # Lower the priority of the calling thread, and with it of the compression threads it starts, and run the adaptive
+    # rate control in the background while a backup runs
+    @contextmanager
+    def active(self, probe_url: str = None):
+        controller = None
+        if self.adaptive and (self.probe_url or probe_url):
+            self.__stop.clear()
+            controller = threading.Thread(target=self.__adapt, args=(LatencyProbe(self.probe_url or probe_url),),
+                                          daemon=True)
+            controller.start()
+        thread_id = threading.get_native_id()
+        previous_nice = previous_ionice = None
+        try:
+            if self.nice is not None:
+                previous_nice = os.getpriority(os.PRIO_PROCESS, thread_id)
+                os.setpriority(os.PRIO_PROCESS, thread_id, max(previous_nice, self.nice))
+            if self.ionice:
+                previous_ionice = _get_ionice(thread_id)
+                _set_ionice(thread_id, *self.ionice)
+            yield self
+        finally:
+            self.__stop.set()
+            if controller:
+                controller.join()
+            try:
+                if previous_nice is not None:
+                    os.setpriority(os.PRIO_PROCESS, thread_id, previous_nice)
+                if previous_ionice:
+                    _set_ionice(thread_id, *previous_ionice)
+            except OSError:
+                # Raising the priority again needs root; the thread just stays at the lower one
+                pass
+
+    def __adapt(self, probe: LatencyProbe):
+        last = time.monotonic()
+        while not self.__stop.wait(self.interval):
+            latency = probe.measure()
+            now = time.monotonic()
+            elapsed, last = now - last, now
+            self.latencies.append(round(latency, 3))
+            for bucket in (self.dump, self.write):
+                throughput = bucket.throughput(elapsed)
+                if latency > self.max_latency:
+                    bucket.back_off(throughput, self.min_rate)
+                else:
+                    bucket.recover(throughput)
+            if latency > self.max_latency:
+                self.back_offs += 1
+
+
+# I/O scheduling class and level of a thread, as reported by ionice
+def _get_ionice(thread_id: int):
+    try:
+        output = subprocess.run(["ionice", "-p", str(thread_id)], capture_output=True, text=True).stdout
+    except OSError:
+        return None
+    name, _, level = output.strip().partition(': prio ')
+    return (IONICE_CLASSES[name], level or None) if name in IONICE_CLASSES else None
+
+
+def _set_ionice(thread_id: int, io_class: str, level: str = None):
+    try:
+        subprocess.run(["ionice", "-c", io_class] + (["-n", level] if level else []) + ["-p", str(thread_id)],
+                       capture_output=True)
+    except OSError:
+        # ionice isn't installed, the writes run with the default I/O priority
+        pass
@@ -1,8 +1,10 @@
 #!/usr/bin/env python3
 
+import contextlib
 import datetime
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import yaml
 from colorama import Fore, Style
@@ -11,6 +13,8 @@ from utils import _print
 from models import Container
 from models import Log
 import backup
+import docker_api
+from jobs import JobRunner
 from simple_term_menu import TerminalMenu
 
 
@@ -40,45 +44,103 @@ def upgrade():
         choice_index = terminal_menu.show()
         containers = {containers_to_choose_from[choice_index]: containers.get(containers_to_choose_from[choice_index])}
 
-    # Loop through Nextcloud container instances
-    container: Container
+    upgrade_config = config_list.get('upgrade') or {}
+
+    # Pull every image used by the selected instances once, even if several instances share it
+    images = {}
     for container in containers.values():
-        go_on = True
-        # Make a backup
+        try:
+            for image in container.compose_images():
+                images.setdefault(image, []).append(container.name)
+        except Exception as e:
+            _print(F"{Fore.RED}Could not read the docker-compose project of {container.name}: {e}{Style.RESET_ALL}")
+            containers = {name: c for name, c in containers.items() if c is not container}
+    failed_pulls = pull_images(images, upgrade_config.get('pull_jobs', 4))
+    for image in failed_pulls:
+        for name in images[image]:
+            if name in containers:
+                _print(F"{Fore.RED}Skip upgrade of {name}, {image} could not be pulled{Style.RESET_ALL}")
+                del containers[name]
+
+    # Back up and upgrade the instances, several at once if a rollout width above 1 is configured or --jobs is set
+    concurrency = config_list.get('concurrency') or {}
+    width = utils.jobs if utils.jobs > 1 else upgrade_config.get('rollout_width', 1)
+    runner = JobRunner(width, {
+        'backup_dir': concurrency.get('backup_dir', 1),
+        'db_host': concurrency.get('db_host', 1),
+    })
+    results = runner.run(
+        containers.values(),
+        lambda container: upgrade_container(container, config_list, log, width > 1),
+        lambda container: [('backup_dir', os.path.realpath(container.backup_dir)), ('db_host', container.db_host)])
+
+    return all(result is True for result in results.values())
+
+
+# Pull the images in parallel and return the ones that could not be pulled
+def pull_images(images: dict, jobs: int) -> list:
+    docker = docker_api.client()
+
+    def pull(image):
+        try:
+            updated = docker.pull(image)
+            _print(F"Pull {image}: {Fore.GREEN}{'newer image downloaded' if updated else 'up to date'}{Style.RESET_ALL}")
+            return True
+        except Exception as e:
+            _print(F"Pull {image}: {Fore.RED}failed{Style.RESET_ALL} ({e})")
+            return False
+
+    _print("----------------------------------------------")
+    _print(F"Pull {len(images)} docker images")
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        results = dict(zip(images, executor.map(pull, images)))
+    return [image for image, status in results.items() if not status]
+
+
+def upgrade_container(container: Container, config_list: dict, log: Log, buffered: bool) -> bool:
+    with utils.buffered_output() if buffered else contextlib.nullcontext():
+        # Make a backup and keep maintenance mode enabled for the upgrade. If the backup fails, the instance is skipped.
         if not utils.no_backup:
-            utils.keep_maintenance_mode = True
-            go_on = backup.backup()
-        if go_on:
-            # Make the upgrade
-            utils.keep_maintenance_mode = True if "--maintenance" in sys.argv else False
-            _print("----------------------------------------------")
-            _print(F"Start upgrade for {container.name} at {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-            result = container.upgrade()
-            if result == 1:
-                _print(F"{Fore.GREEN}{container.name} upgraded successfully{Style.RESET_ALL}")
-                upgrade_status = True
-            elif result == 2:
-                _print(F"{Fore.GREEN}No upgrades available for {container.name}.{Style.RESET_ALL}")
-                upgrade_status = True
+            container.keep_maintenance_mode = True
+            if not backup.backup_container(container, config_list, log):
+                _print(F"{Fore.RED}Skip upgrade of {container.name}, its backup failed{Style.RESET_ALL}")
+                return False
+
+        # Make the upgrade
+        container.keep_maintenance_mode = "--maintenance" in sys.argv
+        _print("----------------------------------------------")
+        _print(F"Start upgrade for {container.name} at {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+        result = container.upgrade()
+        if result == 1:
+            _print(F"{Fore.GREEN}{container.name} upgraded successfully{Style.RESET_ALL}")
+            upgrade_status = True
+        elif result == 2:
+            _print(F"{Fore.GREEN}No upgrades available for {container.name}.{Style.RESET_ALL}")
+            upgrade_status = True
+        else:
+            _print(F"{Fore.RED}Upgrade for {container.name} failed{Style.RESET_ALL}")
+            for func, traceback in container.exceptions.items():
+                _print()
+                _print(F"{Fore.YELLOW}Exception occurred in method: Container.{func}(){Style.RESET_ALL}")
+                _print(traceback)
+                _print()
+            upgrade_status = False
+
+        # Log upgrade
+        if not utils.no_log and config_list['log']['logging']:
+            if upgrade_status:
+                log.log(F"Upgrade ; {container.name} ; SUCCESS")
             else:
-                _print(F"{Fore.RED}Upgrade for {container.name} failed{Style.RESET_ALL}")
-                for func, traceback in container.exceptions.items():
-                    _print()
-                    _print(F"{Fore.YELLOW}Exception occurred in method: Container.{func}(){Style.RESET_ALL}")
-                    _print(traceback)
-                    _print()
-            # Log upgrade
-            if not utils.no_log and config_list['log']['logging']:
-                if upgrade_status:
-                    log.log(F"Upgrade ; {container.name} ; SUCCESS")
-                else:
-                    log.log(F"Upgrade ; {container.name} ; FAIL")
-                    if len(log.exceptions) > 0:
-                        for func, traceback in log.exceptions.items():
-                            _print()
-                            _print(F"{Fore.YELLOW}Exception occurred in method: Log.{func}(){Style.RESET_ALL}")
-                            _print(traceback)
-                            _print()
+                log.log(F"Upgrade ; {container.name} ; FAIL")
+                if len(log.exceptions) > 0:
+                    for func, traceback in log.exceptions.items():
+                        _print()
+                        _print(F"{Fore.YELLOW}Exception occurred in method: Log.{func}(){Style.RESET_ALL}")
+                        _print(traceback)
+                        _print()
+        backup.write_metrics(container, config_list)
+
+    return upgrade_status
 
 
 if __name__ == '__main__':
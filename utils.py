@@ -1,3 +1,9 @@
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from colorama import Fore, Style
+
 # Flags
 quiet_mode = False
 no_log = False
@@ -5,9 +11,12 @@ no_cleanup = False
 all_containers = False
 no_confirm = False
 no_backup = False
+dry_run = False
+jobs = 1
 
-# intern Flags
-keep_maintenance_mode = False
+# Output of concurrently running jobs is collected per thread and printed as a whole
+_output = threading.local()
+_print_lock = threading.Lock()
 
 
 def set_flags(flags=list):
@@ -17,6 +26,8 @@ def set_flags(flags=list):
     global no_log
     global no_cleanup
     global no_backup
+    global dry_run
+    global jobs
 
     no_confirm = "--yes" in flags
     all_containers = "--all" in flags
@@ -24,12 +35,88 @@ def set_flags(flags=list):
     no_log = "--nolog" in flags
     no_cleanup = "--nocleanup" in flags
     no_backup = "--nobackup" in flags
+    dry_run = "--dryrun" in flags
+    jobs = get_option(flags, "--jobs", "1")
+    if not jobs.isdigit() or int(jobs) < 1:
+        _print(F"{Fore.RED}--jobs needs a number of at least 1: --jobs N{Style.RESET_ALL}")
+        sys.exit(1)
+    jobs = int(jobs)
+
+
+# Get the value of an option passed as "--option value" or "--option=value"
+def get_option(flags: list, option: str, default=None):
+    for i, flag in enumerate(flags):
+        if flag == option and i + 1 < len(flags):
+            return flags[i + 1]
+        elif flag.startswith(option + "="):
+            return flag[len(option) + 1:]
+    return default
 
 
 def _print(text=None):
     global quiet_mode
     if not quiet_mode:
-        if not text is None:
-            print(text)
+        buffer = getattr(_output, 'buffer', None)
+        if buffer is not None:
+            buffer.append(text if text is not None else "")
         else:
-            print()
+            with _print_lock:
+                if not text is None:
+                    print(text)
+                else:
+                    print()
+
+
+# Collect everything printed by the current thread and print it in one piece at the end. Nested calls add to the
+# buffer of the outermost one.
+@contextmanager
+def buffered_output():
+    if getattr(_output, 'buffer', None) is not None:
+        yield
+        return
+    _output.buffer = []
+    try:
+        yield
+    finally:
+        buffer, _output.buffer = _output.buffer, None
+        with _print_lock:
+            for text in buffer:
+                print(text)
+
+
+# Buffer the output of the current thread is collected in, None if it is printed right away
+def output_buffer():
+    return getattr(_output, 'buffer', None)
+
+
+# Collect the output of the current thread in the buffer of another one, e.g. of the job that started it
+def set_output_buffer(buffer):
+    _output.buffer = buffer
+
+
+# Counts the bytes of a long running transfer and prints its throughput every few seconds
+class Throughput:
+
+    def __init__(self, label: str, interval: float = 10) -> None:
+        self.label = label
+        self.interval = interval
+        self.bytes = 0
+        self.__start = time.monotonic()
+        self.__last_print = self.__start
+        self.__lock = threading.Lock()
+
+    def update(self, n: int):
+        with self.__lock:
+            self.bytes += n
+            now = time.monotonic()
+            if now - self.__last_print >= self.interval:
+                self.__last_print = now
+                _print(F"{self.label}: {self.bytes / 1000000:.0f} MB ({self.rate():.1f} MB/s)")
+
+    # Average throughput in MB/s
+    def rate(self) -> float:
+        return self.bytes / 1000000 / max(time.monotonic() - self.__start, 1e-6)
+
+    def finish(self):
+        _print(F"{self.label}: {self.bytes / 1000000:.1f} MB in {time.monotonic() - self.__start:.1f} s "
+               F"({self.rate():.1f} MB/s)")
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import tarfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import yaml
+from colorama import Fore, Style
+import utils
+from utils import _print
+import archive
+from catalog import Catalog
+from crypto import Encryption
+import binlog
+from repository import Repository
+
+
+# Check one catalog entry and return its state: ok, unverified (no checksum recorded but readable), missing,
+# truncated, corrupt or incomplete (an archive holding unchanged tables it refers to is gone)
+def verify_backup(backup_dir: str, backup: dict, encryption: Encryption = None) -> str:
+    path = backup['path']
+    if not os.path.isfile(path):
+        return 'missing'
+    if any(not os.path.isfile(os.path.join(os.path.dirname(path), entry['archive']))
+           for entry in (backup.get('tables') or {}).values()):
+        return 'incomplete'
+    expected = archive.read_checksum(path) or backup['checksum']
+    if expected is not None and archive.file_checksum(path) != expected:
+        return 'truncated' if os.path.getsize(path) < backup['size'] else 'corrupt'
+    if backup['format'] == 'repository':
+        return 'corrupt' if Repository(backup_dir).check(Repository.read_snapshot(path), deep=True) else 'ok'
+    if expected is None:
+        if encryption is None and archive.is_encrypted(path):
+            return 'unverified'
+        # Without a checksum at least make sure the archive can be read to its end
+        try:
+            with archive.open_file(path, encryption) as file:
+                decompressor = archive.reader(file, archive.detect_format(path, encryption))
+                with tarfile.open(fileobj=decompressor, mode='r|') as tarball:
+                    for member in tarball:
+                        if member.isfile():
+                            archive.copy_member(tarball, member, lambda data: None)
+                # Read on to the end of the compressed stream, so a missing trailer is noticed as well
+                while decompressor.read(1024 * 1024):
+                    pass
+        except Exception:
+            return 'corrupt'
+        return 'unverified'
+    return 'ok'
+
+
+def verify():
+
+    # Set flags
+    utils.set_flags(sys.argv)
+
+    # Load configuration
+    config = Path(__file__).parent / "config.yml"
+    with open(config) as file:
+        config_list = yaml.full_load(file)
+
+    # Verify the backups of the instances passed as parameters or of all instances
+    containers = config_list['nextcloud_containers']
+    names = [name for name in containers if name in sys.argv] or list(containers)
+    encryptions = {name: Encryption.from_config(values.get('encryption')) for name, values in containers.items()}
+    backups = []
+    for name in names:
+        catalogs = [Catalog(containers[name]['backup_dir'])]
+        # Binlog archives have a catalog of their own
+        if os.path.isdir(binlog.binlog_dir(containers[name]['backup_dir'])):
+            catalogs.append(Catalog(binlog.binlog_dir(containers[name]['backup_dir'])))
+        for catalog in catalogs:
+            if not catalog.exists():
+                catalog.reindex(encryptions)
+            backups.extend((catalog.backup_dir, backup, encryptions[name]) for backup in catalog.backups(name))
+
+    # Hashing and decompressing release the GIL, so the backups are checked on all cores at once
+    with ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as executor:
+        results = list(executor.map(lambda item: verify_backup(*item), backups))
+
+    status = True
+    for (backup_dir, backup, encryption), result in zip(backups, results):
+        if result == 'ok':
+            _print(F"{backup['file_name']}: {Fore.GREEN}ok{Style.RESET_ALL}")
+        elif result == 'unverified':
+            _print(F"{backup['file_name']}: {Fore.YELLOW}readable, but no checksum recorded{Style.RESET_ALL}")
+        elif result == 'incomplete':
+            _print(F"{backup['file_name']}: {Fore.RED}refers to unchanged tables in a missing backup{Style.RESET_ALL}")
+            status = False
+        else:
+            _print(F"{backup['file_name']}: {Fore.RED}{result}{Style.RESET_ALL}")
+            status = False
+    _print(F"Verified {len(backups)} backups")
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(0 if verify() else 1)